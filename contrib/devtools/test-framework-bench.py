@@ -0,0 +1,877 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026-present The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for hot paths of the Python functional test framework.
+
+These do not need a running node. Each benchmark compares the current code
+against the straightforward implementation it replaced, so that regressions
+in framework performance are easy to spot."""
+
+import argparse
+from io import BytesIO
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../test/functional'))
+
+from test_framework.blocktools import (  # noqa: E402
+    create_block,
+    create_coinbase,
+    create_tx_with_script,
+)
+from test_framework.auxpow_testing import computeAuxpow  # noqa: E402
+from test_framework.crypto import bip324_cipher, secp256k1  # noqa: E402
+from test_framework.crypto.chacha20 import (  # noqa: E402
+    FSChaCha20,
+    chacha20_block,
+    chacha20_crypt,
+)
+from test_framework.crypto.siphash import siphash  # noqa: E402
+from test_framework.key import (  # noqa: E402
+    ECKey,
+    compute_xonly_pubkey,
+    compute_xonly_pubkey_many,
+    generate_privkey,
+    sign_schnorr,
+    verify_ecdsa_batch,
+    verify_schnorr,
+    verify_schnorr_batch,
+)
+from test_framework.message_capture import capture_record, read_capture  # noqa: E402
+from test_framework.messages import (  # noqa: E402
+    CAuxPow,
+    CBlock,
+    CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    HeaderAndShortIDs,
+    MAX_HEADERS_RESULTS,
+    MSG_WTX,
+    PartiallyDownloadedBlock,
+    check_proof_of_work_many,
+    msg_block,
+    msg_cmpctblock,
+    msg_feefilter,
+    msg_getdata,
+    msg_getheaders,
+    msg_headers,
+    msg_inv,
+    msg_ping,
+    msg_pong,
+    msg_sendcmpct,
+    msg_tx,
+    ser_vector,
+)
+from test_framework.p2p import (  # noqa: E402
+    MESSAGEMAP,
+    MESSAGE_DECODERS,
+    InventoryStore,
+    MessageCache,
+    NetworkThread,
+    P2PConnection,
+    P2PDataStore,
+)
+from test_framework.v2_p2p import EncryptedP2PState  # noqa: E402
+from test_framework.script import (  # noqa: E402
+    CScript,
+    LegacySignatureHash,
+    OP_DROP,
+    OP_TRUE,
+    SIGHASH_ALL,
+)
+
+# Benchmark functions by name
+BENCHMARKS: dict[str, Callable[[argparse.Namespace], None]] = {}
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def best_of(func, repeat):
+    """Return the fastest wall-clock time of repeat runs of func."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(label, before, after):
+    print(f"{label}: before {before * 1000:.1f} ms, after {after * 1000:.1f} ms, speedup {before / after:.2f}x")
+
+
+class uncached_tx_hashes:
+    """Context manager that restores the pre-cache behavior of recomputing
+    transaction hashes and sizes on every access."""
+    def __enter__(self):
+        self.saved = CTransaction._cached
+        CTransaction._cached = lambda tx, _slot, compute: compute()
+
+    def __exit__(self, *args):
+        CTransaction._cached = self.saved
+
+
+@benchmark("txid")
+def bench_txid(args):
+    """Build a chain of blocks the way feature_block.py does."""
+    output_script = CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])
+
+    def build_chain():
+        spendable = []
+        tip = 1  # stand-in for the genesis block hash
+        for height in range(1, args.blocks + 1):
+            coinbase = create_coinbase(height)
+            txs = []
+            if spendable:
+                prevtx = spendable.pop(0)
+                for _ in range(args.txs):
+                    prev = create_tx_with_script(prevtx, 0, amount=prevtx.vout[0].nValue - 1000, output_script=output_script)
+                    txs.append(prev)
+                    prevtx = prev
+            block = create_block(tip, coinbase, ntime=height, txlist=txs)
+            # Like update_block(), extend the block and recompute the root.
+            block.vtx.append(create_tx_with_script(block.vtx[-1], 0, amount=1, output_script=output_script))
+            block.hashMerkleRoot = block.calc_merkle_root()
+            # Like P2PDataStore, index all transactions by txid.
+            tx_store = {tx.txid_int: tx for tx in block.vtx}
+            assert len(tx_store) == len(block.vtx)
+            block.solve()
+            tip = block.hash_int
+            spendable.append(coinbase)
+
+    with uncached_tx_hashes():
+        before = best_of(build_chain, args.repeat)
+    after = best_of(build_chain, args.repeat)
+    report(f"build {args.blocks} blocks with {args.txs} chained txs each", before, after)
+
+
+@benchmark("weight")
+def bench_weight(args):
+    """Compute block weight and transaction vsizes the way mempool and block tests do."""
+    output_script = CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])
+    prevtx = create_coinbase(1)
+    txs = []
+    for _ in range(args.txs):
+        prevtx = create_tx_with_script(prevtx, 0, amount=prevtx.vout[0].nValue - 1000, output_script=output_script)
+        txs.append(prevtx)
+    block = create_block(1, create_coinbase(2), ntime=2, txlist=txs)
+
+    def serialized_weight():
+        # What CBlock.get_weight() and CTransaction.get_vsize() used to do
+        vsizes = [(3 * len(tx.serialize_without_witness()) + len(tx.serialize_with_witness()) + 3) // 4 for tx in block.vtx]
+        return 3 * len(block.serialize(with_witness=False)) + len(block.serialize()), vsizes
+
+    def weight():
+        return block.get_weight(), [tx.get_vsize() for tx in block.vtx]
+
+    assert serialized_weight() == weight()
+
+    def repeat(func):
+        return lambda: [func() for _ in range(100)]
+
+    report(f"weigh a block with {args.txs} txs 100 times", best_of(repeat(serialized_weight), args.repeat), best_of(repeat(weight), args.repeat))
+
+
+class deep_tx_copies:
+    """Context manager that makes CTransaction(tx) deepcopy its inputs, outputs
+    and witnesses, as it used to."""
+    def __enter__(self):
+        self.saved = CTransaction.__init__
+        CTransaction.__init__ = lambda self_, tx=None: self.saved(self_, tx, deep=True)
+
+    def __exit__(self, *args):
+        CTransaction.__init__ = self.saved
+
+
+@benchmark("taproot")
+def bench_taproot(args):
+    """Generate feature_taproot.py's spenders and sign a spend of each, as test_spenders() does."""
+    import feature_taproot
+
+    start = time.perf_counter()
+    spenders = feature_taproot.spenders_taproot_active()
+    print(f"generate {len(spenders)} spenders: {(time.perf_counter() - start) * 1000:.1f} ms")
+    # Signing all of them takes minutes; spread a sample over all kinds of spenders.
+    spenders = spenders[::max(1, len(spenders) // args.spenders)]
+
+    def sign_all():
+        random.seed(1)
+        for spender in spenders:
+            # Like test_spenders(), sign with the spender's input next to another one, and with a
+            # single output when the spender needs a missing corresponding output.
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(i, 0)) for i in range(2)]
+            tx.wit.vtxinwit = [CTxInWitness() for _ in range(2)]
+            tx.vout = [CTxOut(1000, CScript([OP_TRUE])) for _ in range(1 if spender.need_vin_vout_mismatch else 2)]
+            index = 1 if spender.need_vin_vout_mismatch else 0
+            utxos = [CTxOut(100000, spender.script) for _ in range(2)]
+            spender.sat_function(tx, index, utxos, True)
+            if not spender.no_fail:
+                spender.sat_function(tx, index, utxos, False)
+
+    with deep_tx_copies():
+        before = best_of(sign_all, args.repeat)
+    report(f"sign a spend of {len(spenders)} spenders", before, best_of(sign_all, args.repeat))
+
+    # The copy is made by LegacySignatureMsg() for each legacy signature.
+    tx = CTransaction()
+    tx.vin = [CTxIn(COutPoint(i, 0), CScript([b"\x00" * 72, b"\x02" * 33])) for i in range(50)]
+    tx.vout = [CTxOut(1000, CScript([OP_TRUE])) for _ in range(50)]
+
+    def sign_legacy():
+        for i in range(len(tx.vin)):
+            LegacySignatureHash(CScript([OP_TRUE]), tx, i, SIGHASH_ALL)
+
+    with deep_tx_copies():
+        before = best_of(sign_legacy, args.repeat)
+    report("compute legacy sighashes of all inputs of a 50-input tx", before, best_of(sign_legacy, args.repeat))
+
+
+def affine_mul(*aps):
+    """What GE.mul() used to do"""
+    naps = [(a % secp256k1.GE.ORDER, p) for a, p in aps]
+    r = secp256k1.GE()
+    for i in range(255, -1, -1):
+        r = r + r
+        for (a, p) in naps:
+            if (a >> i) & 1:
+                r += p
+    return r
+
+
+class PowersOfTwoTable:
+    """What FastGEMul used to be: a table of 2^i * P, with a point addition
+    for each bit set in the scalar"""
+    def __init__(self, p):
+        self.table = [p]
+        for _ in range(255):
+            p = p + p
+            self.table.append(p)
+        self.coords = [(int(p.x), int(p.y)) for p in self.table]
+
+    def mul(self, a):
+        result = secp256k1.GE()
+        a = a % secp256k1.GE.ORDER
+        for bit in range(a.bit_length()):
+            if a & (1 << bit):
+                result += self.table[bit]
+        return result
+
+    def mul_jacobian(self, a):
+        result = secp256k1.JACOBIAN_INFINITY
+        a = a % secp256k1.GE.ORDER
+        for bit in range(a.bit_length()):
+            if a & (1 << bit):
+                result = secp256k1.jacobian_add_affine(result, *self.coords[bit])
+        return result
+
+
+G_POWERS_OF_TWO = PowersOfTwoTable(secp256k1.G)
+G_COORDS = (int(secp256k1.G.x), int(secp256k1.G.y))
+
+
+class affine_point_arithmetic:
+    """Context manager that restores the scalar multiplication with affine
+    point additions, and the powers of two table for G."""
+    def __enter__(self):
+        self.saved = secp256k1.GE.mul, secp256k1.GE.__rmul__
+        secp256k1.GE.mul = staticmethod(affine_mul)
+        secp256k1.GE.__rmul__ = lambda p, a: G_POWERS_OF_TWO.mul(a) if p is secp256k1.G else affine_mul((a, p))
+
+    def __exit__(self, *args):
+        secp256k1.GE.mul, secp256k1.GE.__rmul__ = self.saved
+
+
+class powers_of_two_g_table:
+    """Context manager that restores the powers of two table for G (with
+    Jacobian point arithmetic) instead of the comb table."""
+    def __enter__(self):
+        secp256k1.FAST_MUL_TABLES[G_COORDS] = G_POWERS_OF_TWO
+
+    def __exit__(self, *args):
+        secp256k1.FAST_MUL_TABLES[G_COORDS] = secp256k1.FAST_G
+
+
+def bitwise_mul(terms):
+    """What GE.mul() did for the points without a table before it used
+    Strauss' and Pippenger's algorithms"""
+    r = secp256k1.JACOBIAN_INFINITY
+    for i in range(max((a.bit_length() for a, _, _ in terms), default=0) - 1, -1, -1):
+        r = secp256k1.jacobian_double(r)
+        for (a, x, y) in terms:
+            if (a >> i) & 1:
+                r = secp256k1.jacobian_add_affine(r, x, y)
+    return r
+
+
+class bitwise_multi_mul:
+    """Context manager that restores the bitwise double-and-add in GE.mul()."""
+    def __enter__(self):
+        self.saved = secp256k1.strauss_mul, secp256k1.pippenger_mul
+        secp256k1.strauss_mul = secp256k1.pippenger_mul = bitwise_mul
+
+    def __exit__(self, *args):
+        secp256k1.strauss_mul, secp256k1.pippenger_mul = self.saved
+
+
+@benchmark("secp256k1")
+def bench_secp256k1(args):
+    """Sign and verify ECDSA and Schnorr signatures, and derive x-only public keys."""
+    random.seed(1)
+    count = 20
+    keys = []
+    for _ in range(count):
+        key = ECKey()
+        key.generate()
+        keys.append(key)
+    msgs = [random.randbytes(32) for _ in range(count)]
+    ecdsa_sigs = [key.sign_ecdsa(msg) for key, msg in zip(keys, msgs)]
+    seckeys = [key.get_bytes() for key in keys]
+    xonly_keys = [compute_xonly_pubkey(seckey)[0] for seckey in seckeys]
+    schnorr_sigs = [sign_schnorr(seckey, msg) for seckey, msg in zip(seckeys, msgs)]
+
+    cases = [
+        ("sign", "ECDSA signatures", lambda: [key.sign_ecdsa(msg) for key, msg in zip(keys, msgs)]),
+        ("verify", "ECDSA signatures", lambda: [key.get_pubkey().verify_ecdsa(sig, msg) for key, sig, msg in zip(keys, ecdsa_sigs, msgs)]),
+        ("sign", "Schnorr signatures", lambda: [sign_schnorr(seckey, msg) for seckey, msg in zip(seckeys, msgs)]),
+        ("verify", "Schnorr signatures", lambda: [verify_schnorr(key, sig, msg) for key, sig, msg in zip(xonly_keys, schnorr_sigs, msgs)]),
+        ("derive", "x-only public keys", lambda: [compute_xonly_pubkey(seckey) for seckey in seckeys]),
+    ]
+    for action, what, func in cases:
+        assert all(func())
+        with affine_point_arithmetic():
+            assert all(func())
+            before = best_of(func, args.repeat)
+        after = best_of(func, args.repeat)
+        report(f"{action} {count} {what} ({count / after:.0f}/s)", before, after)
+
+    print("With the comb table for G instead of the powers of two table:")
+    for action, what, func in cases:
+        with powers_of_two_g_table():
+            assert all(func())
+            before = best_of(func, args.repeat)
+        report(f"{action} {count} {what}", before, best_of(func, args.repeat))
+
+    print("With Strauss' and Pippenger's algorithms instead of the bitwise double-and-add:")
+    for action, what, func in cases:
+        with bitwise_multi_mul():
+            assert all(func())
+            before = best_of(func, args.repeat)
+        report(f"{action} {count} {what}", before, best_of(func, args.repeat))
+    for terms in [1, 2, 16, secp256k1.PIPPENGER_MIN_TERMS, 256]:
+        aps = [(random.randrange(secp256k1.GE.ORDER), random.choice(keys).get_pubkey().p) for _ in range(terms)]
+        func = lambda: secp256k1.GE.mul(*aps)
+        with bitwise_multi_mul():
+            expected = repr(func())
+            before = best_of(func, args.repeat)
+        assert repr(func()) == expected
+        report(f"GE.mul() with {terms} terms", before, best_of(func, args.repeat))
+
+    start = time.perf_counter()
+    secp256k1.FastGEMul(secp256k1.G).table
+    print(f"compute the comb table for G: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+@benchmark("batchverify")
+def bench_batchverify(args):
+    """Verify batches of Schnorr and ECDSA signatures, one by one and with the batch functions."""
+    random.seed(1)
+    keys = []
+    for _ in range(256):
+        key = ECKey()
+        key.generate()
+        keys.append(key)
+    msgs = [random.randbytes(32) for _ in keys]
+    schnorr_entries = [(key.get_pubkey().get_bytes()[1:], sign_schnorr(key.get_bytes(), msg), msg) for key, msg in zip(keys, msgs)]
+    ecdsa_entries = [(key.get_pubkey(), key.sign_ecdsa(msg), msg) for key, msg in zip(keys, msgs)]
+
+    for count in [4, 32, 256]:
+        entries = schnorr_entries[:count]
+        one_by_one = lambda: [verify_schnorr(*entry) for entry in entries]
+        batch = lambda: verify_schnorr_batch(entries)
+        assert all(one_by_one()) and all(batch())
+        before, after = best_of(one_by_one, args.repeat), best_of(batch, args.repeat)
+        report(f"verify {count} Schnorr signatures ({count / before:.0f}/s -> {count / after:.0f}/s)", before, after)
+    # With an invalid signature, the batch is split in halves until it is found.
+    entries = schnorr_entries[:32]
+    entries[5] = (entries[5][0], entries[6][1], entries[5][2])
+    one_by_one = lambda: [verify_schnorr(*entry) for entry in entries]
+    batch = lambda: verify_schnorr_batch(entries)
+    assert one_by_one() == batch() == [i != 5 for i in range(32)]
+    before, after = best_of(one_by_one, args.repeat), best_of(batch, args.repeat)
+    report("verify 32 Schnorr signatures with 1 invalid one", before, after)
+
+    entries = ecdsa_entries[:32]
+    one_by_one = lambda: [pubkey.verify_ecdsa(sig, msg) for pubkey, sig, msg in entries]
+    batch = lambda: verify_ecdsa_batch(entries)
+    assert all(one_by_one()) and all(batch())
+    before, after = best_of(one_by_one, args.repeat), best_of(batch, args.repeat)
+    report(f"verify 32 ECDSA signatures ({32 / before:.0f}/s -> {32 / after:.0f}/s)", before, after)
+
+
+@benchmark("xonly")
+def bench_xonly(args):
+    """Serialize many points and derive many x-only public keys, one by one and at once."""
+    random.seed(1)
+    points = [random.randrange(1, secp256k1.GE.ORDER) * secp256k1.G for _ in range(200)]
+
+    def sums():
+        """Points with denominators in their coordinates, as additions result in"""
+        return [p + q for p, q in zip(points, points[1:])]
+
+    def one_by_one(sums):
+        return [p.to_bytes_xonly() for p in sums]
+
+    expected = one_by_one(sums())
+    assert secp256k1.GE.to_bytes_xonly_many(sums()) == expected
+    # (The additions themselves take the same time in both.)
+    before = best_of(lambda: one_by_one(sums()), args.repeat)
+    after = best_of(lambda: secp256k1.GE.to_bytes_xonly_many(sums()), args.repeat)
+    report(f"add and serialize {len(expected)} points xonly", before, after)
+
+    keys = [generate_privkey() for _ in range(200)]
+    assert compute_xonly_pubkey_many(keys) == [compute_xonly_pubkey(key) for key in keys]
+    before = best_of(lambda: [compute_xonly_pubkey(key) for key in keys], args.repeat)
+    report(f"compute {len(keys)} x-only public keys", before, best_of(lambda: compute_xonly_pubkey_many(keys), args.repeat))
+
+
+@benchmark("auxpow")
+def bench_auxpow(args):
+    """Validate the auxpow of merge-mined headers, as a blk file scanner would."""
+    headers = []
+    for i in range(1000):
+        header = CBlockHeader()
+        header.nBits = 0x207fffff
+        header.nTime = i
+        header.mark_auxpow()
+        header.auxpow = CAuxPow()
+        coinbase = bytes.fromhex(computeAuxpow(header.hash_hex, b"7f" + b"ff" * 31, True))
+        header.auxpow.deserialize(BytesIO(coinbase))
+        headers.append(header)
+    assert check_proof_of_work_many(headers) == [None] * len(headers)
+    elapsed = best_of(lambda: check_proof_of_work_many(headers), args.repeat)
+    print(f"validate {len(headers)} auxpow headers: {elapsed * 1000:.1f} ms ({len(headers) / elapsed:.0f} headers/s)")
+
+
+@benchmark("shortids")
+def bench_shortids(args):
+    """Build a compact block for a large block and reconstruct it from a mempool."""
+    block = CBlock()
+    block.vtx = [CTransaction() for _ in range(5000)]
+    for i, tx in enumerate(block.vtx):
+        tx.vin = [CTxIn(COutPoint(i, 0))]
+    block.hashMerkleRoot = block.calc_merkle_root()
+    wtxids = [tx.wtxid_int for tx in block.vtx]
+
+    def shortids_one_by_one():
+        # What HeaderAndShortIDs.initialize_from_block() used to do
+        k0, k1 = cmpct.get_siphash_keys()
+        return [siphash(k0, k1, h.to_bytes(32, 'little')) & 0x0000ffffffffffff for h in wtxids[1:]]
+
+    cmpct = HeaderAndShortIDs()
+    cmpct.initialize_from_block(block, use_witness=True)
+    assert shortids_one_by_one() == cmpct.shortids
+    report(f"compute short IDs for {len(block.vtx)} txs", best_of(shortids_one_by_one, args.repeat),
+           best_of(lambda: cmpct.initialize_from_block(block, use_witness=True), args.repeat))
+    start = time.perf_counter()
+    PartiallyDownloadedBlock(cmpct, block.vtx[1:]).fill_block([])
+    print(f"reconstruct the block from a mempool: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def mixed_capture(count):
+    """Return message capture data with a mix of the messages exchanged in
+    functional tests."""
+    coinbase = create_coinbase(1)
+    txs = [create_tx_with_script(coinbase, 0, amount=1000 - i, output_script=CScript([OP_TRUE])) for i in range(20)]
+    block = create_block(1, coinbase, ntime=1, txlist=txs)
+    cmpct = HeaderAndShortIDs()
+    cmpct.initialize_from_block(block, use_witness=True)
+    headers = msg_headers([CBlockHeader(block) for _ in range(20)])
+    inv = [CInv(MSG_WTX, tx.wtxid_int) for tx in txs]
+    cycle = [msg_inv(inv), msg_getdata(inv), msg_tx(txs[0]), msg_tx(txs[1]), msg_ping(1), msg_pong(1),
+             headers, msg_block(block), msg_cmpctblock(cmpct.to_p2p()), msg_sendcmpct(True, 2), msg_feefilter(1000)]
+    messages = (cycle[i % len(cycle)] for i in range(count))
+    return b"".join(capture_record(i, msg.msgtype, msg.serialize()) for i, msg in enumerate(messages))
+
+
+@benchmark("decode")
+def bench_decode(args):
+    """Decode a recorded mixed message stream, as P2PConnection does for received messages."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.capture
+        if path is None:
+            path = os.path.join(tmpdir, "msgs_recv.dat")
+            with open(path, "wb") as f:
+                f.write(mixed_capture(2000))
+        messages = [(msgtype, payload) for _, msgtype, payload in read_capture(path) if msgtype in MESSAGEMAP]
+
+    def decode_from_stream():
+        # What P2PConnection._on_data used to do
+        for msgtype, payload in messages:
+            t = MESSAGEMAP[msgtype]()
+            t.deserialize(BytesIO(payload))
+
+    def decode():
+        for msgtype, payload in messages:
+            MESSAGE_DECODERS[msgtype](payload)
+
+    before = best_of(decode_from_stream, args.repeat)
+    after = best_of(decode, args.repeat)
+    report(f"decode {len(messages)} messages", before, after)
+    print(f"{len(messages) / after:.0f} messages/s")
+
+
+class CountingReceiver(P2PConnection):
+    def __init__(self, v2_state=None):
+        super().__init__()
+        self.peer_connect_helper("0", 0, "regtest", 1)
+        self.v2_state = v2_state
+        self.count = 0
+
+    def on_message(self, message):
+        self.count += 1
+
+
+@benchmark("recv")
+def bench_recv(args):
+    """Receive a large block in 64 KB chunks and a burst of 10k small messages in one read, over v1 and v2."""
+    block = CBlock()
+    block.vtx = [CTransaction() for _ in range(2000)]
+    for i, tx in enumerate(block.vtx):
+        tx.vin = [CTxIn(COutPoint(i, 0), b"\x00" * 2000)]
+    burst = [msg_inv([CInv(MSG_WTX, i)]) for i in range(10000)]
+
+    for version in [1, 2]:
+        def connect():
+            sender = P2PConnection()
+            sender.peer_connect_helper("0", 0, "regtest", 1)
+            if version == 1:
+                return sender, CountingReceiver()
+            states = [EncryptedP2PState(initiating=initiating, net="regtest") for initiating in [True, False]]
+            for state in states:
+                state.initialize_v2_transport(bytes(32))
+                state.tried_v2_handshake = True
+            sender.v2_state = states[0]
+            return sender, CountingReceiver(states[1])
+
+        sender, receiver = connect()
+        data = sender.build_message(msg_block(block))
+        chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+        start = time.perf_counter()
+        for chunk in chunks:
+            receiver.data_received(chunk)
+        elapsed = time.perf_counter() - start
+        assert receiver.count == 1
+        print(f"v{version}: receive a {len(data) / 1e6:.1f} MB block in {len(chunks)} chunks: {elapsed * 1000:.1f} ms ({len(data) / 1e6 / elapsed:.1f} MB/s)")
+
+        sender, receiver = connect()
+        data = b"".join(sender.build_message(msg) for msg in burst)
+        start = time.perf_counter()
+        receiver.data_received(data)
+        elapsed = time.perf_counter() - start
+        assert receiver.count == len(burst)
+        print(f"v{version}: receive {len(burst)} inv messages in one read: {elapsed * 1000:.1f} ms ({len(burst) / elapsed:.0f} messages/s)")
+
+
+@benchmark("broadcast")
+def bench_broadcast(args):
+    """Build the messages to relay a 1 MB block to 50 v1 peers and a 100 kB block to 8 v2 peers."""
+    for version, count, tx_count in [(1, 50, 2000), (2, 8, 200)]:
+        block = CBlock()
+        block.vtx = [CTransaction() for _ in range(tx_count)]
+        for i, tx in enumerate(block.vtx):
+            tx.vin = [CTxIn(COutPoint(i, 0), b"\x00" * 500)]
+        msg = msg_block(block)
+        peers = []
+        for _ in range(count):
+            peer = P2PConnection()
+            peer.peer_connect_helper("0", 0, "regtest", 1)
+            if version == 2:
+                peer.v2_state = EncryptedP2PState(initiating=True, net="regtest")
+                peer.v2_state.initialize_v2_transport(bytes(32))
+            peers.append(peer)
+
+        def build_cached():
+            cache = MessageCache(max_messages=1)
+            return [peer.build_message(msg, cache=cache) for peer in peers]
+
+        before = best_of(lambda: [peer.build_message(msg) for peer in peers], args.repeat)
+        report(f"v{version}: build a {len(msg.serialize()) / 1e6:.1f} MB block message for {count} peers", before, best_of(build_cached, args.repeat))
+
+
+def per_byte_chacha20_crypt(key, nonce, cnt, data):
+    """What the ChaCha20Poly1305 AEAD used to do to encrypt"""
+    ret = bytearray()
+    for i in range((len(data) + 63) // 64):
+        keystream = chacha20_block(key, nonce, cnt + i)
+        for j in range(min(64, len(data) - 64 * i)):
+            ret.append(data[j + 64 * i] ^ keystream[j])
+    return bytes(ret)
+
+
+def per_block_get_keystream_bytes(self, nbytes):
+    """What FSChaCha20._get_keystream_bytes() used to do"""
+    while len(self._keystream) < nbytes:
+        nonce = ((0).to_bytes(4, 'little') + (self._chunk_counter // self._rekey_interval).to_bytes(8, 'little'))
+        self._keystream += chacha20_block(self._key, nonce, self._block_counter)
+        self._block_counter += 1
+    ret = self._keystream[:nbytes]
+    self._keystream = self._keystream[nbytes:]
+    return ret
+
+
+def per_byte_fschacha20_crypt(self, chunk):
+    """What FSChaCha20.crypt() used to do"""
+    ks = self._get_keystream_bytes(len(chunk))
+    ret = bytes([ks[i] ^ chunk[i] for i in range(len(chunk))])
+    if ((self._chunk_counter + 1) % self._rekey_interval) == 0:
+        self._key = self._get_keystream_bytes(32)
+        self._block_counter = 0
+        self._keystream = b''
+    self._chunk_counter += 1
+    return ret
+
+
+class per_block_chacha20:
+    """Context manager that restores the keystream generation one block at a time
+    and the bytewise XOR."""
+    def __enter__(self):
+        self.saved = bip324_cipher.chacha20_crypt, FSChaCha20._get_keystream_bytes, FSChaCha20.crypt
+        bip324_cipher.chacha20_crypt = per_byte_chacha20_crypt
+        FSChaCha20._get_keystream_bytes = per_block_get_keystream_bytes
+        FSChaCha20.crypt = per_byte_fschacha20_crypt
+
+    def __exit__(self, *args):
+        bip324_cipher.chacha20_crypt, FSChaCha20._get_keystream_bytes, FSChaCha20.crypt = self.saved
+
+
+@benchmark("chacha20")
+def bench_chacha20(args):
+    """Encrypt with ChaCha20, and send and receive a 1 MB block message over v2."""
+    key, nonce = random.randbytes(32), random.randbytes(12)
+    data = random.randbytes(1000000)
+    assert per_byte_chacha20_crypt(key, nonce, 1, data) == chacha20_crypt(key, nonce, 1, data)
+    before = best_of(lambda: per_byte_chacha20_crypt(key, nonce, 1, data), 1)
+    report("encrypt 1 MB with ChaCha20", before, best_of(lambda: chacha20_crypt(key, nonce, 1, data), args.repeat))
+
+    def crypt_lengths():
+        cipher = FSChaCha20(key)
+        return [cipher.crypt(b"\x00\x10\x00") for _ in range(10000)]
+    with per_block_chacha20():
+        expected = crypt_lengths()
+        before = best_of(crypt_lengths, args.repeat)
+    assert crypt_lengths() == expected
+    report("encrypt 10k v2 packet lengths with FSChaCha20", before, best_of(crypt_lengths, args.repeat))
+
+    block = CBlock()
+    block.vtx = [CTransaction() for _ in range(2000)]
+    for i, tx in enumerate(block.vtx):
+        tx.vin = [CTxIn(COutPoint(i, 0), b"\x00" * 500)]
+    msg = msg_block(block)
+
+    def send_and_receive():
+        states = [EncryptedP2PState(initiating=initiating, net="regtest") for initiating in [True, False]]
+        for state in states:
+            state.initialize_v2_transport(bytes(32))
+            state.tried_v2_handshake = True
+        sender = P2PConnection()
+        sender.peer_connect_helper("0", 0, "regtest", 1)
+        sender.v2_state = states[0]
+        receiver = CountingReceiver(states[1])
+        receiver.data_received(sender.build_message(msg))
+        assert receiver.count == 1
+    with per_block_chacha20():
+        before = best_of(send_and_receive, 1)
+    report(f"send and receive a {len(msg.serialize()) / 1e6:.1f} MB block message over v2", before, best_of(send_and_receive, args.repeat))
+
+
+class HeadersStore(P2PDataStore):
+    def send_without_ping(self, message, is_decoy=False):
+        message.serialize()
+
+
+def walk_getheaders(store, message):
+    """What P2PDataStore.on_getheaders() used to do"""
+    headers_list = [store.block_store[store.last_block_hash]]
+    while headers_list[-1].hash_int not in message.locator.vHave:
+        prev_block_hash = headers_list[-1].hashPrevBlock
+        if prev_block_hash in store.block_store:
+            prev_block_header = CBlockHeader(store.block_store[prev_block_hash])
+            headers_list.append(prev_block_header)
+            if prev_block_header.hash_int == message.hashstop:
+                break
+        else:
+            break
+    store.send_without_ping(msg_headers(headers_list[:-MAX_HEADERS_RESULTS - 1:-1]))
+
+
+@benchmark("getheaders")
+def bench_getheaders(args):
+    """Serve getheaders requests of a syncing and a synced peer from a P2PDataStore with a long chain."""
+    store = HeadersStore()
+    prev_hash = 0
+    for i in range(args.blocks * 100):
+        block = CBlock()
+        block.hashPrevBlock = prev_hash
+        block.nNonce = i
+        prev_hash = block.hash_int
+        store.block_store[prev_hash] = block
+    store.last_block_hash = prev_hash
+    chain = list(store.block_store)
+
+    for label, locator in [("syncing from genesis", [chain[0]]), ("synced up to 10 blocks before the tip", chain[-11::-1][:10])]:
+        request = msg_getheaders()
+        request.locator.vHave = locator
+        store.on_getheaders(request)  # (build the index)
+        before = best_of(lambda: walk_getheaders(store, request), args.repeat)
+        report(f"getheaders {label} with {len(chain)} blocks", before, best_of(lambda: store.on_getheaders(request), args.repeat))
+
+
+class CountingTransport:
+    """Transport that discards the data written to it, but counts the messages."""
+    def __init__(self):
+        self.written = 0
+        self.done = threading.Event()
+        self.expected = None
+
+    def is_closing(self):
+        return False
+
+    def writelines(self, data):
+        self.written += len(data)
+        if self.written == self.expected:
+            self.done.set()
+
+
+@benchmark("send")
+def bench_send(args):
+    """Send 10k inv messages from the test thread to the network thread, one by one and with send_many()."""
+    network_thread = NetworkThread()
+    network_thread.start()
+    while not (network_thread.network_event_loop and network_thread.network_event_loop.is_running()):
+        time.sleep(0.01)
+    messages = [msg_inv([CInv(MSG_WTX, i)]) for i in range(10000)]
+
+    def send(send_all):
+        sender = P2PConnection()
+        sender.peer_connect_helper("0", 0, "regtest", 1)
+        sender._transport = CountingTransport()
+        sender._transport.expected = len(messages)
+        send_all(sender)
+        sender._transport.done.wait()
+
+    def send_one_by_one(sender):
+        for msg in messages:
+            sender.send_without_ping(msg)
+
+    try:
+        report(f"send {len(messages)} inv messages", best_of(lambda: send(send_one_by_one), args.repeat),
+               best_of(lambda: send(lambda sender: sender.send_many(messages)), args.repeat))
+    finally:
+        network_thread.close(timeout=10)
+
+
+@benchmark("invstore")
+def bench_invstore(args):
+    """Check the wait_for_broadcast() condition for 10 txids against 50k announced txids."""
+    hashes = [random.getrandbits(256) for _ in range(50000)]
+    txns = [f"{h:064x}" for h in hashes[-10:]]
+    invs_dict = {h: 1 for h in hashes}
+    invs = InventoryStore()
+    for h in hashes:
+        invs.add(h, MSG_WTX)
+
+    def check_set():
+        # What wait_for_broadcast() used to check
+        return set(invs_dict.keys()) == set([int(tx, 16) for tx in txns])
+
+    wanted = {int(tx, 16) for tx in txns}
+
+    def check_indexed():
+        return len(invs) == len(wanted) and all(tx in invs for tx in wanted)
+
+    assert check_set() == check_indexed()
+    report("100 checks", best_of(lambda: [check_set() for _ in range(100)], args.repeat), best_of(lambda: [check_indexed() for _ in range(100)], args.repeat))
+
+
+class generic_vector_codec:
+    """Context manager that disables the fixed-size fast path for vectors of
+    the given classes."""
+    def __init__(self, *classes):
+        self.classes = classes
+
+    def __enter__(self):
+        self.saved = [c._fixed_struct for c in self.classes]
+        for c in self.classes:
+            c._fixed_struct = None
+
+    def __exit__(self, *args):
+        for c, codec in zip(self.classes, self.saved):
+            c._fixed_struct = codec
+
+
+@benchmark("vector")
+def bench_vector(args):
+    """Serialize and deserialize large inventory and headers messages."""
+    inv = msg_inv([CInv(MSG_WTX, i * 0x1234567890abcdef) for i in range(50000)])
+    inv_ser = inv.serialize()
+
+    with generic_vector_codec(CInv):
+        before_ser = best_of(inv.serialize, args.repeat)
+        before_deser = best_of(lambda: msg_inv.from_buffer(inv_ser), args.repeat)
+    report("serialize msg_inv with 50000 entries", before_ser, best_of(inv.serialize, args.repeat))
+    report("deserialize msg_inv with 50000 entries", before_deser, best_of(lambda: msg_inv.from_buffer(inv_ser), args.repeat))
+
+    headers = msg_headers()
+    for i in range(2000):
+        header = CBlockHeader()
+        header.hashPrevBlock = i
+        header.nNonce = i
+        headers.headers.append(header)
+    headers_ser = headers.serialize()
+
+    def serialize_as_blocks():
+        # What msg_headers.serialize() used to do
+        return ser_vector([CBlock(x) for x in headers.headers])
+
+    assert serialize_as_blocks() == headers_ser
+    report("serialize msg_headers with 2000 headers", best_of(serialize_as_blocks, args.repeat), best_of(headers.serialize, args.repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK", help=f"benchmarks to run: {', '.join(sorted(BENCHMARKS))} (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs to take the best time of (default: %(default)s)")
+    parser.add_argument("--blocks", type=int, default=100, help="number of blocks for block building benchmarks (default: %(default)s)")
+    parser.add_argument("--txs", type=int, default=50, help="number of transactions per block (default: %(default)s)")
+    parser.add_argument("--capture", help="message capture file (from -capturemessages) to decode instead of a generated one")
+    parser.add_argument("--spenders", type=int, default=200, help="number of feature_taproot.py spenders to sign for (default: %(default)s)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print(f"[{name}] {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
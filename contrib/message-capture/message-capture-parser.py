@@ -76,6 +76,9 @@ def to_jsonable(obj: Any) -> Any:
     elif hasattr(obj, "__slots__"):
         ret = {}    # type: Any
         for slot in obj.__slots__:
+            if slot.startswith("_"):
+                # Internal state such as cached hashes
+                continue
             val = getattr(obj, slot, None)
             if slot in HASH_INTS and isinstance(val, int):
                 ret[slot] = ser_uint256(val).hex()
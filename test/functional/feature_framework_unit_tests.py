@@ -23,14 +23,17 @@ TEST_FRAMEWORK_MODULES = [
     "crypto.ellswift",
     "extendedkey",
     "key",
+    "message_capture",
     "messages",
     "crypto.muhash",
+    "p2p",
     "crypto.poly1305",
     "crypto.ripemd160",
     "crypto.secp256k1",
     "script",
     "script_util",
     "segwit_addr",
+    "crypto.siphash",
     "wallet_util",
 ]
 
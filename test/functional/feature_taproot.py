@@ -104,6 +104,7 @@ from test_framework.wallet_util import generate_keypair
 from test_framework.key import (
     generate_privkey,
     compute_xonly_pubkey,
+    compute_xonly_pubkey_many,
     sign_schnorr,
     tweak_add_privkey,
     ECKey,
@@ -679,7 +680,7 @@ def spenders_taproot_active():
     """Return a list of Spenders for testing post-Taproot activation behavior."""
 
     secs = [generate_privkey() for _ in range(8)]
-    pubs = [compute_xonly_pubkey(sec)[0] for sec in secs]
+    pubs = [pub for pub, _ in compute_xonly_pubkey_many(secs)]
 
     spenders = []
 
@@ -1331,7 +1332,7 @@ def sample_spenders():
 
     # Create key(s) for output creation, as well as key and script-spends
     secs = [generate_privkey() for _ in range(2)]
-    pubs = [compute_xonly_pubkey(sec)[0] for sec in secs]
+    pubs = [pub for pub, _ in compute_xonly_pubkey_many(secs)]
 
     # Create a list of scripts which will be built into a taptree
     scripts = [
@@ -1671,7 +1672,7 @@ class TaprootTest(BitcoinTestFramework):
         # Generate private keys
         prvs = [hashlib.sha256(SEED.to_bytes(2, 'big') + bytes([i])).digest() for i in range(100)]
         # Generate corresponding public x-only pubkeys
-        pubs = [compute_xonly_pubkey(prv)[0] for prv in prvs]
+        pubs = [pub for pub, _ in compute_xonly_pubkey_many(prvs)]
         # Generate taproot objects
         inner_keys = [pubs[i] for i in range(7)]
 
@@ -20,6 +20,7 @@ from test_framework.p2p import (
         msg_block,
         msg_headers,
         P2PDataStore,
+        broadcast_message,
 )
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import (
@@ -94,8 +95,7 @@ class P2PIBDStallingTest(BitcoinTestFramework):
         self.log.info("Check that increasing the window beyond 1024 blocks triggers stalling logic")
         headers_message.headers = [CBlockHeader(b) for b in blocks]
         with node.assert_debug_log(expected_msgs=['Stall started']):
-            for p in peers:
-                p.send_without_ping(headers_message)
+            broadcast_message(peers, headers_message)
             self.all_sync_send_with_ping(peers)
 
         self.log.info("Check that the stalling peer is disconnected after 2 seconds")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026-present The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test the node with many inbound peers at once.
+
+- Open increasing numbers of inbound connections concurrently, and log how
+  the handshake time and the ping round trip time of each peer degrade as
+  the number of peers grows. All peers must be served.
+- Open more inbound connections than the node has slots for, and check that
+  it keeps the number of inbound peers within its limit.
+"""
+
+from test_framework.p2p import (
+    P2PInterface,
+    latency_stats,
+    sync_with_ping_many,
+)
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal
+
+# Numbers of simultaneous inbound peers to measure the latency with
+PEER_COUNTS = [10, 50, 150]
+# Round trips to measure for each number of peers
+PING_ROUNDS = 5
+# maxconnections=32 results in a maximum of 21 inbound connections
+# (32 - 10 outbound - 1 feeler)
+MAX_CONNECTIONS_LIMITED = 32
+MAX_INBOUND_LIMITED = 21
+
+
+class InboundPeer(P2PInterface):
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
+    def on_close(self):
+        self.closed = True
+
+
+def format_stats(stats):
+    return "median {:.1f} ms, p90 {:.1f} ms, max {:.1f} ms".format(*(stats[key] * 1000 for key in ("median", "p90", "max")))
+
+
+class P2PManyInboundTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 1
+        self.extra_args = [[f"-maxconnections={max(PEER_COUNTS) + 50}"]]
+
+    def run_test(self):
+        self.test_latency()
+        self.test_inbound_limit()
+
+    def test_latency(self):
+        node = self.nodes[0]
+        for count in PEER_COUNTS:
+            self.log.info(f"Connect {count} peers at once")
+            peers = node.add_p2p_connections(P2PInterface() for _ in range(count))
+            assert_equal(len(node.getpeerinfo()), count)
+            handshake = latency_stats(peer.handshake_time for peer in peers)
+            self.log.info(f"{count} peers: handshake {format_stats(handshake)}")
+
+            round_trip_times = []
+            for _ in range(PING_ROUNDS):
+                round_trip_times += sync_with_ping_many(peers)
+            ping = latency_stats(round_trip_times)
+            assert_equal(ping["count"], count * PING_ROUNDS)
+            self.log.info(f"{count} peers: ping {format_stats(ping)}")
+
+            node.disconnect_p2ps()
+
+    def test_inbound_limit(self):
+        self.log.info(f"Restart with -maxconnections={MAX_CONNECTIONS_LIMITED} and connect twice as many inbound peers")
+        self.restart_node(0, extra_args=[f"-maxconnections={MAX_CONNECTIONS_LIMITED}"])
+        node = self.nodes[0]
+        peers = node.add_p2p_connections((InboundPeer() for _ in range(2 * MAX_INBOUND_LIMITED)), expect_success=False)
+        # Every connection either completes the handshake or is evicted (or rejected) by the node
+        self.wait_until(lambda: all("verack" in peer.last_message or peer.closed for peer in peers))
+        self.wait_until(lambda: sum(peer.is_connected for peer in peers) == node.getconnectioncount())
+        connected = [peer for peer in peers if peer.is_connected]
+        assert 0 < len(connected) <= MAX_INBOUND_LIMITED
+        self.log.info(f"{len(connected)} of {len(peers)} peers are connected")
+        sync_with_ping_many(connected)
+
+
+if __name__ == '__main__':
+    P2PManyInboundTest(__file__).main()
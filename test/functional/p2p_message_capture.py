@@ -4,14 +4,27 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Test per-peer message capture capability.
 
+Also test recording a session of the test framework in the same format, and
+replaying the captured messages into another node.
+
 Additionally, the output of contrib/message-capture/message-capture-parser.py should be verified manually.
 """
 
 import glob
 from io import BytesIO
 import os
+import time
 
-from test_framework.p2p import P2PDataStore, MESSAGEMAP
+from test_framework.message_capture import (
+    read_capture,
+    replay_capture,
+)
+from test_framework.messages import msg_ping
+from test_framework.p2p import (
+    MESSAGEMAP,
+    P2PDataStore,
+    P2PInterface,
+)
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal
 
@@ -51,22 +64,58 @@ def mini_parser(dat_file: str) -> None:
 
 
 
+def messages(capture):
+    return [(msgtype, payload) for _, msgtype, payload in capture]
+
+
 class MessageCaptureTest(BitcoinTestFramework):
     def set_test_params(self):
-        self.num_nodes = 1
-        self.extra_args = [["-capturemessages"]]
+        self.num_nodes = 2
+        self.extra_args = [["-capturemessages"], []]
         self.setup_clean_chain = True
 
+    def setup_network(self):
+        # The nodes are not connected, so that the only captured peer is the test framework
+        self.setup_nodes()
+
     def run_test(self):
         capturedir = self.nodes[0].chain_path / "message_capture"
-        # Connect a node so that the handshake occurs
-        self.nodes[0].add_p2p_connection(P2PDataStore())
+        sessiondir = os.path.join(self.options.tmpdir, "session")
+        # Connect a node so that the handshake occurs, and record the session
+        conn = P2PDataStore()
+        conn.start_recording(sessiondir, node=self.nodes[0])
+        self.nodes[0].add_p2p_connection(conn)
+        conn.send_many(msg_ping(nonce) for nonce in range(1, 201))
+        conn.sync_with_ping()
         self.nodes[0].disconnect_p2ps()
+        conn.stop_recording()
         recv_file = glob.glob(os.path.join(capturedir, "*/msgs_recv.dat"))[0]
         mini_parser(recv_file)
         sent_file = glob.glob(os.path.join(capturedir, "*/msgs_sent.dat"))[0]
         mini_parser(sent_file)
 
+        self.log.info("Check that the recorded session matches the node's capture")
+        mini_parser(os.path.join(sessiondir, "msgs_sent.dat"))
+        assert_equal(messages(read_capture(os.path.join(sessiondir, "msgs_sent.dat"))), messages(read_capture(recv_file)))
+        # (the node may have sent more messages before it noticed the disconnection)
+        session_recv = messages(read_capture(os.path.join(sessiondir, "msgs_recv.dat")))
+        assert_equal(session_recv, messages(read_capture(sent_file))[:len(session_recv)])
+
+        self.log.info("Replay the captured messages into another node")
+        pings = [msgtype for _, msgtype, _ in read_capture(recv_file)].count(b"ping")
+        assert pings > 200
+        for speed in [None, 10]:
+            conn = self.nodes[1].add_p2p_connection(P2PInterface())
+            pongs = conn.message_count["pong"]
+            start = time.time()
+            count = replay_capture(conn, recv_file, speed=speed)
+            conn.sync_with_ping()
+            elapsed = time.time() - start
+            self.log.info(f"Replayed {count} messages {'at 10x the recorded speed' if speed else 'as fast as possible'} in {elapsed:.3f} s ({count / elapsed:.0f} messages/s)")
+            # the node replied to every replayed ping (and the two of sync_with_ping)
+            assert_equal(conn.message_count["pong"] - pongs, pings + 2)
+            self.nodes[1].disconnect_p2ps()
+
 
 if __name__ == '__main__':
     MessageCaptureTest(__file__).main()
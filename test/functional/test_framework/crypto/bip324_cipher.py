@@ -13,7 +13,7 @@ anything but tests.
 
 import unittest
 
-from .chacha20 import chacha20_block, REKEY_INTERVAL
+from .chacha20 import chacha20_block, chacha20_crypt, REKEY_INTERVAL
 from .poly1305 import Poly1305
 
 
@@ -27,13 +27,8 @@ def aead_chacha20_poly1305_encrypt(key, nonce, aad, plaintext):
     """Encrypt a plaintext using ChaCha20Poly1305."""
     if plaintext is None:
         return None
-    ret = bytearray()
+    ret = bytearray(chacha20_crypt(key, nonce, 1, plaintext))
     msg_len = len(plaintext)
-    for i in range((msg_len + 63) // 64):
-        now = min(64, msg_len - 64 * i)
-        keystream = chacha20_block(key, nonce, i + 1)
-        for j in range(now):
-            ret.append(plaintext[j + 64 * i] ^ keystream[j])
     poly1305 = Poly1305(chacha20_block(key, nonce, 0)[:32])
     mac_data = aad + pad16(aad)
     mac_data += ret + pad16(ret)
@@ -53,13 +48,7 @@ def aead_chacha20_poly1305_decrypt(key, nonce, aad, ciphertext):
     mac_data += len(aad).to_bytes(8, 'little') + msg_len.to_bytes(8, 'little')
     if ciphertext[-16:] != poly1305.tag(mac_data):
         return None
-    ret = bytearray()
-    for i in range((msg_len + 63) // 64):
-        now = min(64, msg_len - 64 * i)
-        keystream = chacha20_block(key, nonce, i + 1)
-        for j in range(now):
-            ret.append(ciphertext[j + 64 * i] ^ keystream[j])
-    return bytes(ret)
+    return chacha20_crypt(key, nonce, 1, ciphertext[:-16])
 
 
 class FSChaCha20Poly1305:
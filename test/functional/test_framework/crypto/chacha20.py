@@ -5,13 +5,24 @@
 
 """Test-only implementation of ChaCha20 cipher and FSChaCha20 for BIP 324
 
-It is designed for ease of understanding, not performance.
+It is designed for ease of understanding, not performance. (chacha20_block() is the reference
+implementation; chacha20_keystream(), which bulk encryption uses, computes many blocks at once.)
 
 WARNING: This code is slow and trivially vulnerable to side channel attacks. Do not use for
 anything but tests.
 """
 
+import random
 import unittest
+import unittest.mock
+
+# The cryptography package is optional; if it is available, its ChaCha20 is used for bulk
+# encryption.
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms  # type: ignore[import]
+    HAVE_CRYPTOGRAPHY = True
+except ImportError:
+    HAVE_CRYPTOGRAPHY = False
 
 CHACHA20_INDICES = (
     (0, 4, 8, 12), (1, 5, 9, 13), (2, 6, 10, 14), (3, 7, 11, 15),
@@ -63,6 +74,78 @@ def chacha20_block(key, nonce, cnt):
     # Produce byte output
     return b''.join(state[i].to_bytes(4, 'little') for i in range(16))
 
+
+def chacha20_blocks(key, nonce, cnt, nblocks):
+    """Compute nblocks consecutive 64-byte outputs of the ChaCha20 block function, starting
+    with counter cnt, like chacha20_block() for each of them.
+
+    All blocks are computed at once: each state word is a single integer that holds that word of
+    every block, in 64-bit lanes. A value only takes the lower 32 bits of its lane, so additions
+    and rotations cannot carry into the next lane, and every operation of the block function
+    applies to all blocks with a single integer operation.
+    """
+    assert 0 <= cnt and cnt + nblocks <= 2**32
+    if nblocks == 0:
+        return bytearray()
+    # lanes * v puts v in every lane.
+    lanes = int.from_bytes((b'\x01' + bytes(7)) * nblocks, 'little')
+    mask = 0xffffffff * lanes
+    init = [v * lanes for v in CHACHA20_CONSTANTS]
+    init += [int.from_bytes(key[i:i+4], 'little') * lanes for i in range(0, 32, 4)]
+    init.append(int.from_bytes(b''.join(c.to_bytes(8, 'little') for c in range(cnt, cnt + nblocks)), 'little'))
+    init += [int.from_bytes(nonce[i:i+4], 'little') * lanes for i in range(0, 12, 4)]
+    s = list(init)
+    for _ in range(10):
+        for a, b, c, d in CHACHA20_INDICES:
+            s[a] = (s[a] + s[b]) & mask
+            s[d] ^= s[a]
+            s[d] = ((s[d] << 16) | (s[d] >> 16)) & mask
+            s[c] = (s[c] + s[d]) & mask
+            s[b] ^= s[c]
+            s[b] = ((s[b] << 12) | (s[b] >> 20)) & mask
+            s[a] = (s[a] + s[b]) & mask
+            s[d] ^= s[a]
+            s[d] = ((s[d] << 8) | (s[d] >> 24)) & mask
+            s[c] = (s[c] + s[d]) & mask
+            s[b] ^= s[c]
+            s[b] = ((s[b] << 7) | (s[b] >> 25)) & mask
+    # Interleave the lanes of the words into blocks: byte k of word j of block i is byte k of
+    # lane i of word j.
+    out = bytearray(64 * nblocks)
+    for j in range(16):
+        word = ((s[j] + init[j]) & mask).to_bytes(8 * nblocks, 'little')
+        for k in range(4):
+            out[4 * j + k::64] = word[k::8]
+    return out
+
+
+def chacha20_keystream(key, nonce, cnt, nbytes):
+    """Compute nbytes of ChaCha20 keystream, starting with block counter cnt.
+
+    Uses the ChaCha20 of the cryptography package if it is available. (Its 16-byte nonce is the
+    4-byte little-endian block counter, followed by the 12-byte nonce of RFC 8439.)"""
+    nblocks = (nbytes + 63) // 64
+    # The 32-bit block counter must not wrap around, with either implementation.
+    assert 0 <= cnt and cnt + nblocks <= 2**32
+    if HAVE_CRYPTOGRAPHY:
+        encryptor = Cipher(algorithms.ChaCha20(key, cnt.to_bytes(4, 'little') + nonce), mode=None).encryptor()
+        return encryptor.update(bytes(nbytes))
+    ret = chacha20_blocks(key, nonce, cnt, nblocks)
+    del ret[nbytes:]
+    return bytes(ret)
+
+
+def xor_bytes(a, b):
+    """Compute the bytewise XOR of two byte strings of the same length."""
+    assert len(a) == len(b)
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def chacha20_crypt(key, nonce, cnt, data):
+    """Encrypt or decrypt data with ChaCha20 (RFC 8439 section 2.4), starting with block counter cnt."""
+    return xor_bytes(data, chacha20_keystream(key, nonce, cnt, len(data)))
+
+
 class FSChaCha20:
     """Rekeying wrapper stream cipher around ChaCha20."""
     def __init__(self, initial_key, rekey_interval=REKEY_INTERVAL):
@@ -70,24 +153,26 @@ class FSChaCha20:
         self._rekey_interval = rekey_interval
         self._block_counter = 0
         self._chunk_counter = 0
-        self._keystream = b''
+        self._keystream = bytearray()
 
     def _get_keystream_bytes(self, nbytes):
-        while len(self._keystream) < nbytes:
+        if len(self._keystream) < nbytes:
+            # Generate all missing blocks at once.
+            nblocks = (nbytes - len(self._keystream) + 63) // 64
             nonce = ((0).to_bytes(4, 'little') + (self._chunk_counter // self._rekey_interval).to_bytes(8, 'little'))
-            self._keystream += chacha20_block(self._key, nonce, self._block_counter)
-            self._block_counter += 1
-        ret = self._keystream[:nbytes]
-        self._keystream = self._keystream[nbytes:]
+            self._keystream += chacha20_keystream(self._key, nonce, self._block_counter, 64 * nblocks)
+            self._block_counter += nblocks
+        ret = bytes(self._keystream[:nbytes])
+        # (Deleting from the start of a bytearray does not move the remaining bytes.)
+        del self._keystream[:nbytes]
         return ret
 
     def crypt(self, chunk):
-        ks = self._get_keystream_bytes(len(chunk))
-        ret = bytes([ks[i] ^ chunk[i] for i in range(len(chunk))])
+        ret = xor_bytes(chunk, self._get_keystream_bytes(len(chunk)))
         if ((self._chunk_counter + 1) % self._rekey_interval) == 0:
             self._key = self._get_keystream_bytes(32)
             self._block_counter = 0
-            self._keystream = b''
+            self._keystream = bytearray()
         self._chunk_counter += 1
         return ret
 
@@ -139,6 +224,14 @@ FSCHACHA20_TESTS = [
 
 
 class TestFrameworkChacha(unittest.TestCase):
+    def each_keystream_implementation(self):
+        """Make chacha20_keystream() use the pure-Python implementation, and then the cryptography
+        package if it is available, yielding for each of them."""
+        for have_cryptography in sorted({False, HAVE_CRYPTOGRAPHY}):
+            with self.subTest(cryptography=have_cryptography), \
+                 unittest.mock.patch(f"{__name__}.HAVE_CRYPTOGRAPHY", have_cryptography):
+                yield
+
     def test_chacha20(self):
         """ChaCha20 test vectors."""
         for test_vector in CHACHA20_TESTS:
@@ -147,6 +240,33 @@ class TestFrameworkChacha(unittest.TestCase):
             nonce_bytes = nonce[0].to_bytes(4, 'little') + nonce[1].to_bytes(8, 'little')
             keystream = chacha20_block(key, nonce_bytes, counter)
             self.assertEqual(hex_output, keystream.hex())
+            self.assertEqual(hex_output, chacha20_blocks(key, nonce_bytes, counter, 1).hex())
+            for _ in self.each_keystream_implementation():
+                self.assertEqual(hex_output[:50], chacha20_keystream(key, nonce_bytes, counter, 25).hex())
+
+    def test_chacha20_bulk(self):
+        """Compare bulk keystream generation and encryption against chacha20_block."""
+        for nblocks in [0, 1, 2, 7, 64]:
+            key, nonce = random.randbytes(32), random.randbytes(12)
+            cnt = random.choice([0, 1, random.randrange(2**32 - nblocks), 2**32 - nblocks])
+            expected = b''.join(chacha20_block(key, nonce, cnt + i) for i in range(nblocks))
+            self.assertEqual(bytes(chacha20_blocks(key, nonce, cnt, nblocks)), expected)
+            nbytes = max(0, 64 * nblocks - random.randrange(64))
+            data = random.randbytes(nbytes)
+            for _ in self.each_keystream_implementation():
+                self.assertEqual(chacha20_keystream(key, nonce, cnt, nbytes), expected[:nbytes])
+                self.assertEqual(chacha20_crypt(key, nonce, cnt, data), bytes(d ^ k for d, k in zip(data, expected)))
+                with self.assertRaises(AssertionError):
+                    chacha20_keystream(key, nonce, 2**32 - nblocks, 64 * nblocks + 1)
+        # RFC 8439 section 2.4.2
+        plaintext = (b"Ladies and Gentlemen of the class of '99: If I could offer you only one tip for the "
+                     b"future, sunscreen would be it.")
+        for _ in self.each_keystream_implementation():
+            ciphertext = chacha20_crypt(bytes(range(32)), bytes.fromhex("000000000000004a00000000"), 1, plaintext)
+            self.assertEqual(ciphertext.hex(),
+                             "6e2e359a2568f98041ba0728dd0d6981e97e7aec1d4360c20a27afccfd9fae0bf91b65c5524733ab8f593dabcd62b357"
+                             "1639d624e65152ab8f530c359f0861d807ca0dbf500d6a6156a38e088a22b65e52bc514d16ccf806818ce91ab7793736"
+                             "5af90bbf74a35be6b40b8eedf2785e42874d")
 
     def test_fschacha20(self):
         """FSChaCha20 test vectors."""
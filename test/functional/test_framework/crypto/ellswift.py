@@ -140,8 +140,9 @@ class TestFrameworkEllSwift(unittest.TestCase):
             for row in reader:
                 u = FE.from_bytes(bytes.fromhex(row['u']))
                 x = FE.from_bytes(bytes.fromhex(row['x']))
-                for case in range(8):
-                    ret = xswiftec_inv(x, u, case)
+                rets = [xswiftec_inv(x, u, case) for case in range(8)]
+                FE.normalize_many([ret for ret in rets if ret is not None])
+                for case, ret in enumerate(rets):
                     if ret is None:
                         self.assertEqual(row[f"case{case}_t"], "")
                     else:
@@ -15,6 +15,7 @@ Exports:
 * G: the secp256k1 generator point
 """
 
+import random
 import unittest
 from hashlib import sha256
 from test_framework.util import assert_equal, assert_not_equal
@@ -96,6 +97,16 @@ class FE:
             self._den = 1
         return self._num
 
+    @staticmethod
+    def normalize_many(fes):
+        """Bring field elements to the integer form that int() caches, with a single inversion
+        for all of them (rather than one for each)."""
+        # (An element may occur more than once, but must only be normalized once.)
+        todo = list({id(fe): fe for fe in fes if fe._den != 1}.values())
+        for fe, inv in zip(todo, inverse_many([fe._den for fe in todo], FE.SIZE)):
+            fe._num = (fe._num * inv) % FE.SIZE
+            fe._den = 1
+
     def sqrt(self):
         """Compute the square root of a field element if it exists (None otherwise).
 
@@ -212,25 +223,33 @@ class GE:
         """Compute a (batch) scalar group element multiplication.
 
         GE.mul((a1, p1), (a2, p2), (a3, p3)) is identical to a1*p1 + a2*p2 + a3*p3,
-        but more efficient."""
-        # Reduce all the scalars modulo order first (so we can deal with negatives etc).
-        naps = [(a % GE.ORDER, p) for a, p in aps]
-        # Start with point at infinity.
-        r = GE()
-        # Iterate over all bit positions, from high to low.
-        for i in range(255, -1, -1):
-            # Double what we have so far.
-            r = r + r
-            # Add then add the points for which the corresponding scalar bit is set.
-            for (a, p) in naps:
-                if (a >> i) & 1:
-                    r += p
-        return r
+        but more efficient.
+
+        Terms with a point that has a FastGEMul table are computed with that table. The other
+        ones are computed together, with Strauss' algorithm (see strauss_mul()), or with
+        Pippenger's algorithm (see pippenger_mul()) from PIPPENGER_MIN_TERMS terms on."""
+        # Reduce all the scalars modulo order first (so we can deal with negatives etc), and
+        # drop the terms that are infinity.
+        naps = []
+        fixed = []
+        for a, p in aps:
+            if p.infinity:
+                continue
+            coords = (int(p.x), int(p.y))
+            if coords in FAST_MUL_TABLES:
+                fixed.append((a, FAST_MUL_TABLES[coords]))
+            else:
+                naps.append((a % GE.ORDER, *coords))
+        if len(naps) >= PIPPENGER_MIN_TERMS:
+            r = pippenger_mul(naps)
+        else:
+            r = strauss_mul(naps)
+        for a, table in fixed:
+            r = jacobian_add(r, table.mul_jacobian(a))
+        return jacobian_to_ge(r)
 
     def __rmul__(self, a):
         """Multiply an integer with a group element."""
-        if self == G:
-            return FAST_G.mul(a)
         return GE.mul((a, self))
 
     def __neg__(self):
@@ -254,6 +273,24 @@ class GE:
         assert not self.infinity
         return self.x.to_bytes()
 
+    @staticmethod
+    def normalize_many(points):
+        """Normalize the coordinates of group elements with a single inversion (see
+        FE.normalize_many)."""
+        FE.normalize_many([c for p in points if not p.infinity for c in (p.x, p.y)])
+
+    @staticmethod
+    def to_bytes_compressed_many(points):
+        """Convert non-infinite group elements to 33-byte compressed encodings."""
+        GE.normalize_many(points)
+        return [p.to_bytes_compressed() for p in points]
+
+    @staticmethod
+    def to_bytes_xonly_many(points):
+        """Convert non-infinite group elements to 32-byte xonly encodings."""
+        FE.normalize_many([p.x for p in points])
+        return [p.to_bytes_xonly() for p in points]
+
     @staticmethod
     def lift_x(x):
         """Return group element with specified field element as x coordinate (and even y)."""
@@ -315,6 +352,226 @@ class GE:
             return "GE()"
         return f"GE(0x{int(self.x):x},0x{int(self.y):x})"
 
+
+# Point arithmetic in Jacobian coordinates, used internally for scalar multiplication.
+#
+# A point is a tuple (X, Y, Z) of integers modulo FE.SIZE, representing the affine point
+# (X/Z^2, Y/Z^3), or infinity if Z == 0. Unlike GE.__add__, these formulas need no field
+# divisions at all, and work on plain integers rather than FE objects. Only the final result
+# needs to be converted back to affine coordinates (with a single modular inversion).
+
+JACOBIAN_INFINITY = (0, 1, 0)
+
+
+def jacobian_double(p):
+    """Double a point in Jacobian coordinates."""
+    x, y, z = p
+    if z == 0:
+        return p
+    # secp256k1 has no points of order 2, so y != 0 here.
+    yy = (y * y) % FE.SIZE
+    s = (4 * x * yy) % FE.SIZE
+    m = (3 * x * x) % FE.SIZE
+    x3 = (m * m - 2 * s) % FE.SIZE
+    y3 = (m * (s - x3) - 8 * yy * yy) % FE.SIZE
+    z3 = (2 * y * z) % FE.SIZE
+    return (x3, y3, z3)
+
+
+def jacobian_add_affine(p, x2, y2):
+    """Add an affine point (given as the integers x2, y2) to a point in Jacobian coordinates."""
+    x1, y1, z1 = p
+    if z1 == 0:
+        return (x2, y2, 1)
+    zz = (z1 * z1) % FE.SIZE
+    # Bring the affine point to the same denominator as p.
+    u2 = (x2 * zz) % FE.SIZE
+    s2 = (y2 * zz * z1) % FE.SIZE
+    h = (u2 - x1) % FE.SIZE
+    r = (s2 - y1) % FE.SIZE
+    if h == 0:
+        if r == 0:
+            # Identical points: use the doubling formula.
+            return jacobian_double(p)
+        # A point added to its own negation is infinity.
+        return JACOBIAN_INFINITY
+    hh = (h * h) % FE.SIZE
+    hhh = (h * hh) % FE.SIZE
+    v = (x1 * hh) % FE.SIZE
+    x3 = (r * r - hhh - 2 * v) % FE.SIZE
+    y3 = (r * (v - x3) - y1 * hhh) % FE.SIZE
+    z3 = (z1 * h) % FE.SIZE
+    return (x3, y3, z3)
+
+
+def jacobian_add(p, q):
+    """Add two points in Jacobian coordinates."""
+    if q[2] == 0:
+        return p
+    if q[2] == 1:
+        return jacobian_add_affine(p, q[0], q[1])
+    x1, y1, z1 = p
+    if z1 == 0:
+        return q
+    x2, y2, z2 = q
+    z1z1 = (z1 * z1) % FE.SIZE
+    z2z2 = (z2 * z2) % FE.SIZE
+    # Bring both points to the same denominator.
+    u1 = (x1 * z2z2) % FE.SIZE
+    u2 = (x2 * z1z1) % FE.SIZE
+    s1 = (y1 * z2z2 * z2) % FE.SIZE
+    s2 = (y2 * z1z1 * z1) % FE.SIZE
+    h = (u2 - u1) % FE.SIZE
+    r = (s2 - s1) % FE.SIZE
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p)
+        return JACOBIAN_INFINITY
+    hh = (h * h) % FE.SIZE
+    hhh = (h * hh) % FE.SIZE
+    v = (u1 * hh) % FE.SIZE
+    x3 = (r * r - hhh - 2 * v) % FE.SIZE
+    y3 = (r * (v - x3) - s1 * hhh) % FE.SIZE
+    z3 = (z1 * z2 * h) % FE.SIZE
+    return (x3, y3, z3)
+
+
+def jacobian_to_affine(p):
+    """Convert a point in Jacobian coordinates (not infinity) to affine integer coordinates."""
+    x, y, z = p
+    zinv = pow(z, -1, FE.SIZE)
+    zinv2 = (zinv * zinv) % FE.SIZE
+    return ((x * zinv2) % FE.SIZE, (y * zinv2 * zinv) % FE.SIZE)
+
+
+def inverse_many(values, modulus):
+    """Compute the inverses of nonzero integers modulo a prime, with a single modular inversion
+    (Montgomery's trick)."""
+    # prefix[i] = the product of values[0..i-1]
+    prefix = [1]
+    for v in values:
+        prefix.append((prefix[-1] * v) % modulus)
+    inv = pow(prefix[-1], -1, modulus)
+    result = [None] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        # inv is the inverse of the product of values[0..i].
+        result[i] = (inv * prefix[i]) % modulus
+        inv = (inv * values[i]) % modulus
+    return result
+
+
+def jacobian_to_affine_many(points):
+    """Convert points in Jacobian coordinates (none of them infinity) to affine integer
+    coordinates, with a single inversion."""
+    result = []
+    for (x, y, _), zinv in zip(points, inverse_many([z for _, _, z in points], FE.SIZE)):
+        zinv2 = (zinv * zinv) % FE.SIZE
+        result.append(((x * zinv2) % FE.SIZE, (y * zinv2 * zinv) % FE.SIZE))
+    return result
+
+
+def jacobian_to_ge(p):
+    """Convert a point in Jacobian coordinates to a GE."""
+    if p[2] == 0:
+        return GE()
+    return GE(*jacobian_to_affine(p))
+
+
+def jacobian_to_ge_many(points):
+    """Convert points in Jacobian coordinates to GEs, with a single inversion."""
+    coords = iter(jacobian_to_affine_many([p for p in points if p[2] != 0]))
+    return [GE(*next(coords)) if p[2] != 0 else GE() for p in points]
+
+
+# Window size of the wNAF representation of the scalars in strauss_mul()
+STRAUSS_WINDOW = 5
+
+# Number of terms from which on GE.mul() uses pippenger_mul() rather than strauss_mul()
+PIPPENGER_MIN_TERMS = 96
+
+
+def wnaf(a, w):
+    """Compute the width-w non-adjacent form of a non-negative integer a.
+
+    Returns the list of digits, least significant first. Each digit is 0 or an odd number
+    in -(2^(w-1)-1)..2^(w-1)-1, and of any w consecutive digits at most one is nonzero."""
+    digits = []
+    while a:
+        if a & 1:
+            d = a & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            a -= d
+        else:
+            d = 0
+        digits.append(d)
+        a >>= 1
+    return digits
+
+
+def strauss_mul(terms, w=STRAUSS_WINDOW):
+    """Compute the sum of the a * (x, y) for the terms (a, x, y), in Jacobian coordinates.
+
+    The scalars a must be in 0..ORDER-1, and the points (x, y) are given as affine integer
+    coordinates. All products are computed together, with a shared doubling for each bit
+    position (Strauss' algorithm, or Shamir's trick), and with the scalars in wNAF form, so
+    that only every (w+1)th bit on average needs an addition. That requires a table of the
+    odd multiples P, 3P, ..., (2^(w-1)-1)P of each point P."""
+    if not terms:
+        return JACOBIAN_INFINITY
+    # Compute the tables in Jacobian coordinates, from 2P, and convert them to affine all at once.
+    doubles = jacobian_to_affine_many([jacobian_double((x, y, 1)) for _, x, y in terms])
+    multiples = []
+    for (_, x, y), double in zip(terms, doubles):
+        p = (x, y, 1)
+        multiples.append(p)
+        for _ in range(2**(w - 2) - 1):
+            p = jacobian_add_affine(p, *double)
+            multiples.append(p)
+    multiples = jacobian_to_affine_many(multiples)
+    size = 2**(w - 2)
+    tables = [multiples[i:i + size] for i in range(0, len(multiples), size)]
+    nafs = [wnaf(a, w) for a, _, _ in terms]
+    r = JACOBIAN_INFINITY
+    for i in range(max(len(digits) for digits in nafs) - 1, -1, -1):
+        r = jacobian_double(r)
+        for digits, table in zip(nafs, tables):
+            if i < len(digits) and digits[i]:
+                x, y = table[abs(digits[i]) >> 1]
+                r = jacobian_add_affine(r, x, y if digits[i] > 0 else FE.SIZE - y)
+    return r
+
+
+def pippenger_mul(terms):
+    """Compute the sum of the a * (x, y) for the terms (a, x, y), in Jacobian coordinates.
+
+    Like strauss_mul(), but with Pippenger's (bucket) algorithm, which is faster for many
+    terms. The scalars are split into c-bit windows. For each window, the points are sorted
+    into 2^c - 1 buckets by their digit, which costs one addition per term, and the buckets
+    are then summed, each weighted by its digit, with 2 * 2^c additions. The window size c
+    grows with the number of terms."""
+    c = max(2, len(terms).bit_length() - 3)
+    bits = max((a.bit_length() for a, _, _ in terms), default=0)
+    mask = (1 << c) - 1
+    r = JACOBIAN_INFINITY
+    for shift in range(((bits - 1) // c) * c, -1, -c):
+        for _ in range(c):
+            r = jacobian_double(r)
+        buckets = [JACOBIAN_INFINITY] * (mask + 1)
+        for a, x, y in terms:
+            d = (a >> shift) & mask
+            if d:
+                buckets[d] = jacobian_add_affine(buckets[d], x, y)
+        # running is the sum of the buckets d..mask, and total the sum of the d * bucket[d].
+        running = JACOBIAN_INFINITY
+        total = JACOBIAN_INFINITY
+        for d in range(mask, 0, -1):
+            running = jacobian_add(running, buckets[d])
+            total = jacobian_add(total, running)
+        r = jacobian_add(r, total)
+    return r
+
+
 # The secp256k1 generator point
 G = GE.lift_x(0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798)
 
@@ -322,34 +579,210 @@ G = GE.lift_x(0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
 class FastGEMul:
     """Table for fast multiplication with a constant group element.
 
-    Speed up scalar multiplication with a fixed point P by using a precomputed lookup table with
-    its powers of 2:
+    Speed up scalar multiplication with a fixed point P by using a precomputed comb table. The
+    256 bits of the scalar are split into blocks of teeth * spacing bits, and the table holds,
+    for each block k and each nonzero teeth-bit mask m, the sum of the points
 
-        table = [P, 2*P, 4*P, (2^3)*P, (2^4)*P, ..., (2^255)*P]
+        2^(k*teeth*spacing + j*spacing) * P    for each bit j set in m
 
-    During multiplication, the points corresponding to each bit set in the scalar are added up,
-    i.e. on average ~128 point additions take place.
-    """
+    During multiplication, the bits i, i + spacing, i + 2*spacing, ... of each block form the
+    mask of the table entry to add, for each i from spacing-1 down to 0, doubling in between.
+    With the default 2 blocks of 8 teeth, that is 16 doublings and at most 32 point additions,
+    using a table of 510 points.
 
-    def __init__(self, p):
-        self.table = [p]  # table[i] = (2^i) * p
-        for _ in range(255):
-            p = p + p
-            self.table.append(p)
+    The table is only computed when it is first used.
+    """
 
-    def mul(self, a):
-        result = GE()
+    def __init__(self, p, teeth=8, blocks=2):
+        assert not p.infinity
+        self.p = p
+        self.teeth = teeth
+        self.blocks = blocks
+        self.spacing = -(-256 // (teeth * blocks))
+        self._table = None
+
+    @property
+    def table(self):
+        """table[k][m] = the affine coordinates of the entry for block k and mask m."""
+        if self._table is None:
+            # The teeth points, 2^(i*spacing) * P
+            teeth = []
+            q = (int(self.p.x), int(self.p.y), 1)
+            for _ in range(self.blocks * self.teeth):
+                teeth.append(jacobian_to_affine(q))
+                for _ in range(self.spacing):
+                    q = jacobian_double(q)
+            table = []
+            for k in range(self.blocks):
+                # Each entry is the entry without its highest tooth, plus that tooth.
+                entries = [JACOBIAN_INFINITY]
+                for j in range(self.teeth):
+                    entries += [jacobian_add_affine(entry, *teeth[k * self.teeth + j]) for entry in entries]
+                table.append([None] + jacobian_to_affine_many(entries[1:]))
+            self._table = table
+        return self._table
+
+    def mul_jacobian(self, a):
+        """Compute a * P, in Jacobian coordinates."""
+        table = self.table
         a = a % GE.ORDER
-        for bit in range(a.bit_length()):
-            if a & (1 << bit):
-                result += self.table[bit]
+        block_bits = self.teeth * self.spacing
+        result = JACOBIAN_INFINITY
+        for i in range(self.spacing - 1, -1, -1):
+            result = jacobian_double(result)
+            for k in range(self.blocks):
+                mask = 0
+                for j in range(self.teeth):
+                    mask |= ((a >> (k * block_bits + j * self.spacing + i)) & 1) << j
+                if mask:
+                    result = jacobian_add_affine(result, *table[k][mask])
         return result
 
+    def mul(self, a):
+        """Compute a * P."""
+        return jacobian_to_ge(self.mul_jacobian(a))
+
+    def mul_many(self, scalars):
+        """Compute a * P for each of the scalars a, with a single inversion for all of them."""
+        return jacobian_to_ge_many([self.mul_jacobian(a) for a in scalars])
+
+
+# FastGEMul tables for frequently used points, by the affine coordinates of the point. GE.mul()
+# (and thus a * P) uses them automatically.
+FAST_MUL_TABLES: dict[tuple[int, int], FastGEMul] = {}
+
+
+def register_fast_mul(p, **kwargs):
+    """Use a FastGEMul table for multiplications with the point p from now on, and return it.
+
+    As the table is only computed when it is first used, this is cheap for points that end up
+    not being multiplied with."""
+    coords = (int(p.x), int(p.y))
+    if coords not in FAST_MUL_TABLES:
+        FAST_MUL_TABLES[coords] = FastGEMul(p, **kwargs)
+    return FAST_MUL_TABLES[coords]
+
+
 # Precomputed table with multiples of G for fast multiplication
-FAST_G = FastGEMul(G)
+FAST_G = register_fast_mul(G)
+
 
 class TestFrameworkSecp256k1(unittest.TestCase):
     def test_H(self):
         H = sha256(G.to_bytes_uncompressed()).digest()
         assert GE.lift_x(FE.from_bytes(H)) is not None
         self.assertEqual(H.hex(), "50929b74c1a04954b78b4b6035e97a5e078a5a0f28ec96d547bfee9ace803ac0")
+
+    def test_mul(self):
+        def affine_mul(*aps):
+            """Bitwise GE.mul() with affine additions only"""
+            r = GE()
+            for i in range(255, -1, -1):
+                r = r + r
+                for a, p in aps:
+                    if ((a % GE.ORDER) >> i) & 1:
+                        r += p
+            return r
+
+        P = GE.lift_x(FE.from_bytes(sha256(b"P").digest()))
+        scalars = [0, 1, 2, -1, GE.ORDER - 2, GE.ORDER, GE.ORDER_HALF] + [random.randrange(-GE.ORDER, 2 * GE.ORDER) for _ in range(8)]
+        for a in scalars:
+            self.assertEqual(repr(a * G), repr(affine_mul((a, G))))
+            self.assertEqual(repr(a * P), repr(affine_mul((a, P))))
+            b = random.randrange(GE.ORDER)
+            self.assertEqual(repr(GE.mul((a, G), (b, P))), repr(affine_mul((a, G), (b, P))))
+        # Doubling and cancellation within an addition, and infinity terms
+        self.assertEqual(repr(GE.mul((1, P), (1, P))), repr(P + P))
+        self.assertEqual(repr(GE.mul((3, P), (-3, P))), "GE()")
+        self.assertEqual(repr(GE.mul((5, G), (7, GE()))), repr(5 * G))
+
+    def test_multi_mul(self):
+        def bitwise_mul(terms):
+            """GE.mul()'s double-and-add (in Jacobian coordinates) before Strauss and Pippenger"""
+            r = JACOBIAN_INFINITY
+            for i in range(255, -1, -1):
+                r = jacobian_double(r)
+                for a, x, y in terms:
+                    if (a >> i) & 1:
+                        r = jacobian_add_affine(r, x, y)
+            return r
+
+        self.assertEqual(wnaf(0, 5), [])
+        for a in [1, 15, 16, 31, 2**256 - 1] + [random.randrange(GE.ORDER) for _ in range(10)]:
+            for w in range(2, 9):
+                digits = wnaf(a, w)
+                self.assertEqual(sum(d << i for i, d in enumerate(digits)), a)
+                self.assertTrue(all(d % 2 and abs(d) < 2**(w - 1) for d in digits if d))
+                self.assertTrue(all(sum(d != 0 for d in digits[i:i + w]) <= 1 for i in range(len(digits))))
+
+        points = [(int(p.x), int(p.y)) for p in (GE.lift_x(FE(i)) for i in range(1, 60)) if p is not None]
+        for count in [0, 1, 2, 3, 10, 40]:
+            terms = [(random.randrange(GE.ORDER), *random.choice(points)) for _ in range(count)]
+            # Some special cases: zero and tiny scalars, and repeated and negated points
+            if count >= 10:
+                terms[0] = (0, *terms[0][1:])
+                terms[1] = (1, *terms[1][1:])
+                terms[2] = (terms[3][0], *terms[3][1:])
+                terms[4] = (GE.ORDER - terms[5][0], *terms[5][1:])
+            expected = jacobian_to_ge(bitwise_mul(terms))
+            for w in [2, 3, 5]:
+                self.assertEqual(repr(jacobian_to_ge(strauss_mul(terms, w))), repr(expected))
+            self.assertEqual(repr(jacobian_to_ge(pippenger_mul(terms))), repr(expected))
+        # A sum that cancels out
+        x, y = points[0]
+        self.assertEqual(repr(jacobian_to_ge(strauss_mul([(5, x, y), (GE.ORDER - 5, x, y)]))), "GE()")
+        self.assertEqual(repr(jacobian_to_ge(pippenger_mul([(5, x, y), (GE.ORDER - 5, x, y)]))), "GE()")
+
+    def test_inverse_many(self):
+        self.assertEqual(inverse_many([], FE.SIZE), [])
+        for modulus in [FE.SIZE, GE.ORDER]:
+            values = [1, modulus - 1] + [random.randrange(1, modulus) for _ in range(10)]
+            self.assertEqual(inverse_many(values, modulus), [pow(v, -1, modulus) for v in values])
+
+    def test_normalize_many(self):
+        points = [GE.lift_x(FE.from_bytes(sha256(bytes([i])).digest())) for i in range(20)]
+        points = [p for p in points if p is not None]
+
+        def sums():
+            """Group elements with denominators in their coordinates (as additions result in)"""
+            result = [p + q for p, q in zip(points, points[1:])] + [GE(), points[0] + points[0]]
+            return result + [GE(result[0].x, -result[0].y)]
+
+        expected = [repr(p) for p in sums()]
+        expected_xonly = [p.to_bytes_xonly() for p in sums() if not p.infinity]
+        points_sums = sums()
+        fes = [p.x for p in points_sums if not p.infinity]
+        self.assertTrue(any(fe._den != 1 for fe in fes))
+        # (Elements that occur more than once are normalized once.)
+        FE.normalize_many(fes + fes[:3])
+        self.assertTrue(all(fe._den == 1 for fe in fes))
+        self.assertEqual([p.to_bytes_xonly() for p in points_sums if not p.infinity], expected_xonly)
+        GE.normalize_many(points_sums)
+        self.assertEqual([repr(p) for p in points_sums], expected)
+        finite = [p for p in sums() if not p.infinity]
+        self.assertEqual(GE.to_bytes_xonly_many(finite), expected_xonly)
+        finite = [p for p in sums() if not p.infinity]
+        self.assertEqual(GE.to_bytes_compressed_many(finite), [p.to_bytes_compressed() for p in sums() if not p.infinity])
+        FE.normalize_many([])
+
+        scalars = [0, 1, GE.ORDER, -1] + [random.randrange(GE.ORDER) for _ in range(5)]
+        self.assertEqual([repr(p) for p in FAST_G.mul_many(scalars)], [repr(a * G) for a in scalars])
+
+    def test_fast_mul(self):
+        P = GE.lift_x(FE.from_bytes(sha256(b"fast_mul").digest()))
+        for teeth, blocks in [(8, 2), (4, 4), (5, 3), (1, 1)]:
+            table = FastGEMul(P, teeth=teeth, blocks=blocks)
+            for a in [0, 1, -1, GE.ORDER - 1, 2**255, 2**256 - 1] + [random.randrange(GE.ORDER) for _ in range(4)]:
+                self.assertEqual(repr(table.mul(a)), repr(GE.mul((a, P))))
+        # Registering a table makes GE.mul() use it, also for equal points.
+        self.assertNotIn((int(P.x), int(P.y)), FAST_MUL_TABLES)
+        table = register_fast_mul(P)
+        try:
+            self.assertIs(register_fast_mul(GE(P.x, P.y)), table)
+            self.assertIsNone(table._table)
+            a, b = random.randrange(GE.ORDER), random.randrange(GE.ORDER)
+            self.assertEqual(repr(GE.mul((a, G), (b, P))), repr(a * G + table.mul(b)))
+            self.assertEqual(repr(GE.mul((a, P), (-a, GE(P.x, P.y)))), "GE()")
+            self.assertIsNotNone(table._table)
+        finally:
+            del FAST_MUL_TABLES[(int(P.x), int(P.y))]
@@ -29,6 +29,52 @@ def TaggedHash(tag, data):
     return hashlib.sha256(ss).digest()
 
 
+def decode_ecdsa_signature(sig, low_s=True):
+    """Decode a strictly DER-encoded ECDSA signature into its (r, s) values.
+
+    Returns None if the signature is not strictly DER-encoded, if r or s is out of range,
+    or (if low_s) if s is not in the lower half of the range."""
+    # Extract r and s from the DER formatted signature. Return None for
+    # any DER encoding errors.
+    if (sig[1] + 2 != len(sig)):
+        return None
+    if (len(sig) < 4):
+        return None
+    if (sig[0] != 0x30):
+        return None
+    if (sig[2] != 0x02):
+        return None
+    rlen = sig[3]
+    if (len(sig) < 6 + rlen):
+        return None
+    if rlen < 1 or rlen > 33:
+        return None
+    if sig[4] >= 0x80:
+        return None
+    if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
+        return None
+    r = int.from_bytes(sig[4:4+rlen], 'big')
+    if (sig[4+rlen] != 0x02):
+        return None
+    slen = sig[5+rlen]
+    if slen < 1 or slen > 33:
+        return None
+    if (len(sig) != 6 + rlen + slen):
+        return None
+    if sig[6+rlen] >= 0x80:
+        return None
+    if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
+        return None
+    s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
+
+    # Verify that r and s are within the group order
+    if r < 1 or s < 1 or r >= ORDER or s >= ORDER:
+        return None
+    if low_s and s >= secp256k1.GE.ORDER_HALF:
+        return None
+    return (r, s)
+
+
 class ECPubKey:
     """A secp256k1 public key"""
 
@@ -62,45 +108,10 @@ class ECPubKey:
         See https://en.wikipedia.org/wiki/Elliptic_Curve_Digital_Signature_Algorithm for the
         ECDSA verifier algorithm"""
         assert self.is_valid
-
-        # Extract r and s from the DER formatted signature. Return false for
-        # any DER encoding errors.
-        if (sig[1] + 2 != len(sig)):
-            return False
-        if (len(sig) < 4):
-            return False
-        if (sig[0] != 0x30):
-            return False
-        if (sig[2] != 0x02):
-            return False
-        rlen = sig[3]
-        if (len(sig) < 6 + rlen):
-            return False
-        if rlen < 1 or rlen > 33:
-            return False
-        if sig[4] >= 0x80:
-            return False
-        if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
-            return False
-        r = int.from_bytes(sig[4:4+rlen], 'big')
-        if (sig[4+rlen] != 0x02):
-            return False
-        slen = sig[5+rlen]
-        if slen < 1 or slen > 33:
-            return False
-        if (len(sig) != 6 + rlen + slen):
-            return False
-        if sig[6+rlen] >= 0x80:
-            return False
-        if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
-            return False
-        s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
-
-        # Verify that r and s are within the group order
-        if r < 1 or s < 1 or r >= ORDER or s >= ORDER:
-            return False
-        if low_s and s >= secp256k1.GE.ORDER_HALF:
+        rs = decode_ecdsa_signature(sig, low_s)
+        if rs is None:
             return False
+        r, s = rs
         z = int.from_bytes(msg, 'big')
 
         # Run verifier algorithm on r, s
@@ -201,6 +212,19 @@ def compute_xonly_pubkey(key):
     P = x * secp256k1.G
     return (P.to_bytes_xonly(), not P.y.is_even())
 
+def compute_xonly_pubkey_many(keys):
+    """Compute the x-only public keys of many private keys at once, like compute_xonly_pubkey."""
+    results = [(None, None)] * len(keys)
+    valid = []
+    for i, key in enumerate(keys):
+        assert_equal(len(key), 32)
+        x = int.from_bytes(key, 'big')
+        if 0 < x < ORDER:
+            valid.append((i, x))
+    for (i, _), P in zip(valid, secp256k1.FAST_G.mul_many([x for _, x in valid])):
+        results[i] = (P.to_bytes_xonly(), not P.y.is_even())
+    return results
+
 def tweak_add_privkey(key, tweak):
     """Tweak a private key (after negating it if needed)."""
 
@@ -235,6 +259,8 @@ def tweak_add_pubkey(key, tweak):
     Q = t * secp256k1.G + P
     if Q.infinity:
         return None
+    # Both coordinates are needed; normalize them together.
+    secp256k1.GE.normalize_many([Q])
     return (Q.to_bytes_xonly(), not Q.y.is_even())
 
 def verify_schnorr(key, sig, msg):
@@ -264,6 +290,74 @@ def verify_schnorr(key, sig, msg):
         return False
     return True
 
+def verify_schnorr_batch(entries):
+    """Verify many Schnorr signatures at once (see BIP 340).
+
+    - entries is a list of (key, sig, msg) tuples, with the arguments of verify_schnorr
+
+    Returns the list of the verification results of the entries. The valid-looking entries are
+    verified together with the batch verification equation of BIP 340:
+
+        (a1*s1 + a2*s2 + ...) * G == a1*R1 + (a1*e1)*P1 + a2*R2 + (a2*e2)*P2 + ...
+
+    with random coefficients a1=1, a2, a3, ..., and a single multi-scalar multiplication. If
+    that fails, both halves of the entries are verified in the same way, recursively, until
+    the invalid entries are found.
+    """
+    results = [False] * len(entries)
+    items = []
+    for i, (key, sig, msg) in enumerate(entries):
+        assert_equal(len(key), 32)
+        assert_equal(len(sig), 64)
+        P = secp256k1.GE.from_bytes_xonly(key)
+        if P is None:
+            continue
+        R = secp256k1.GE.from_bytes_xonly(sig[0:32])
+        if R is None:
+            continue
+        s = int.from_bytes(sig[32:64], 'big')
+        if s >= ORDER:
+            continue
+        e = int.from_bytes(TaggedHash("BIP0340/challenge", sig[0:32] + key + msg), 'big') % ORDER
+        items.append((i, P, R, s, e))
+
+    pending = [items] if items else []
+    while pending:
+        items = pending.pop()
+        coefficients = [1] + [random.randrange(1, 2**128) for _ in items[1:]]
+        terms = [(-sum(a * s for a, (_, _, _, s, _) in zip(coefficients, items)), secp256k1.G)]
+        for a, (_, P, R, _, e) in zip(coefficients, items):
+            terms += [(a, R), (a * e, P)]
+        if secp256k1.GE.mul(*terms).infinity:
+            for i, _, _, _, _ in items:
+                results[i] = True
+        elif len(items) > 1:
+            pending += [items[:len(items) // 2], items[len(items) // 2:]]
+    return results
+
+def verify_ecdsa_batch(entries, low_s=True):
+    """Verify many ECDSA signatures at once.
+
+    - entries is a list of (pubkey, sig, msg) tuples, with an ECPubKey and the arguments of
+      ECPubKey.verify_ecdsa
+
+    Returns the list of the verification results of the entries. ECDSA signatures cannot be
+    verified together, but the inverses of all s values are computed with a single inversion,
+    and all multiplications with G use its precomputed table.
+    """
+    results = [False] * len(entries)
+    items = []
+    for i, (pubkey, sig, msg) in enumerate(entries):
+        assert pubkey.is_valid
+        rs = decode_ecdsa_signature(sig, low_s)
+        if rs is not None:
+            items.append((i, pubkey.p, *rs, int.from_bytes(msg, 'big')))
+    ws = secp256k1.inverse_many([s for _, _, _, s, _ in items], ORDER)
+    for (i, P, r, _, z), w in zip(items, ws):
+        R = secp256k1.GE.mul((z * w, secp256k1.G), (r * w, P))
+        results[i] = not R.infinity and (int(R.x) % ORDER) == r
+    return results
+
 def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     """Create a Schnorr signature (see BIP 340)."""
 
@@ -312,6 +406,44 @@ class TestFrameworkKey(unittest.TestCase):
                     self.assertFalse(verify_pubkey.verify_ecdsa(sig_ecdsa, msg))
                     self.assertFalse(verify_schnorr(verify_xonly_pubkey, sig_schnorr, msg))
 
+    def test_compute_xonly_pubkey_many(self):
+        keys = [generate_privkey() for _ in range(5)] + [bytes(32), ORDER.to_bytes(32, 'big'), (1).to_bytes(32, 'big')]
+        self.assertEqual(compute_xonly_pubkey_many(keys), [compute_xonly_pubkey(key) for key in keys])
+        self.assertEqual(compute_xonly_pubkey_many([]), [])
+
+    def test_batch_verification(self):
+        keys = []
+        for _ in range(10):
+            key = ECKey()
+            key.generate()
+            keys.append(key)
+        msgs = [random.randbytes(32) for _ in keys]
+        xonly_keys = [key.get_pubkey().get_bytes()[1:] for key in keys]
+        schnorr_entries = [(xonly_key, sign_schnorr(key.get_bytes(), msg), msg) for key, xonly_key, msg in zip(keys, xonly_keys, msgs)]
+        ecdsa_entries = [(key.get_pubkey(), key.sign_ecdsa(msg), msg) for key, msg in zip(keys, msgs)]
+        self.assertEqual(verify_schnorr_batch([]), [])
+        self.assertEqual(verify_ecdsa_batch([]), [])
+        self.assertEqual(verify_schnorr_batch(schnorr_entries), [True] * len(keys))
+        self.assertEqual(verify_ecdsa_batch(ecdsa_entries), [True] * len(keys))
+
+        # Damage some of the entries: a bit flip in a signature or message, an invalid R or
+        # public key, a signature of another message, and swapped signatures.
+        schnorr_entries[1] = (schnorr_entries[1][0], random_bitflip(schnorr_entries[1][1]), schnorr_entries[1][2])
+        schnorr_entries[3] = (schnorr_entries[3][0], schnorr_entries[3][1], random_bitflip(schnorr_entries[3][2]))
+        schnorr_entries[4] = (schnorr_entries[4][0], bytes(32) + schnorr_entries[4][1][32:], schnorr_entries[4][2])
+        schnorr_entries[5] = (bytes(32), schnorr_entries[5][1], schnorr_entries[5][2])
+        schnorr_entries[6] = (schnorr_entries[6][0], sign_schnorr(keys[6].get_bytes(), msgs[7]), schnorr_entries[6][2])
+        schnorr_entries[8], schnorr_entries[9] = (schnorr_entries[8][0], schnorr_entries[9][1], schnorr_entries[8][2]), (schnorr_entries[9][0], schnorr_entries[8][1], schnorr_entries[9][2])
+        ecdsa_entries[1] = (ecdsa_entries[1][0], random_bitflip(ecdsa_entries[1][1]), ecdsa_entries[1][2])
+        ecdsa_entries[6] = (ecdsa_entries[6][0], keys[6].sign_ecdsa(msgs[7]), ecdsa_entries[6][2])
+        ecdsa_entries[8], ecdsa_entries[9] = (ecdsa_entries[8][0], ecdsa_entries[9][1], ecdsa_entries[8][2]), (ecdsa_entries[9][0], ecdsa_entries[8][1], ecdsa_entries[9][2])
+        schnorr_results = verify_schnorr_batch(schnorr_entries)
+        self.assertEqual(schnorr_results, [verify_schnorr(*entry) for entry in schnorr_entries])
+        self.assertEqual(schnorr_results, [i not in (1, 3, 4, 5, 6, 8, 9) for i in range(len(keys))])
+        ecdsa_results = verify_ecdsa_batch(ecdsa_entries)
+        self.assertEqual(ecdsa_results, [pubkey.verify_ecdsa(sig, msg) for pubkey, sig, msg in ecdsa_entries])
+        self.assertEqual(ecdsa_results, [i not in (1, 6, 8, 9) for i in range(len(keys))])
+
     def test_schnorr_testvectors(self):
         """Implement the BIP340 test vectors (read from bip340_test_vectors.csv)."""
         num_tests = 0
@@ -337,6 +469,7 @@ class TestFrameworkKey(unittest.TestCase):
                     except RuntimeError as e:
                         self.fail("BIP340 test vector %i (%s): signing raised exception %s" % (i, comment, e))
                 result_actual = verify_schnorr(pubkey, sig, msg)
+                self.assertEqual(verify_schnorr_batch([(pubkey, sig, msg)]), [result_actual])
                 if result:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification failed" % (i, comment))
                 else:
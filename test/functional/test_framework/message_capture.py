@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026-present The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Record and replay P2P sessions in the message capture format.
+
+This is the format of the files written by the node with -capturemessages
+(and read by contrib/message-capture/message-capture-parser.py). For each
+message, it contains:
+
+- the time, in microseconds since the epoch (8 bytes)
+- the message type, padded with zeros (12 bytes)
+- the length of the payload (4 bytes)
+- the payload
+
+A recorded session consists of a msgs_sent.dat and a msgs_recv.dat file,
+like each of the directories the node writes for its peers."""
+
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from test_framework.messages import msg_generic
+
+CAPTURE_HEADER = struct.Struct("<Q12sI")
+
+# Messages that are only valid during the handshake, which the replayed
+# connection has already completed
+HANDSHAKE_MSGTYPES = frozenset([b"version", b"verack", b"wtxidrelay", b"sendaddrv2", b"sendtxrcncl", b"feature"])
+
+
+def capture_record(time_us, msgtype, payload):
+    """Serialize a message in the message capture format."""
+    return CAPTURE_HEADER.pack(time_us, msgtype, len(payload)) + payload
+
+
+def read_capture(path):
+    """Read a message capture file, as a list of (time in microseconds,
+    message type, payload) tuples."""
+    with open(path, "rb") as f:
+        data = f.read()
+    messages = []
+    pos = 0
+    while pos < len(data):
+        if len(data) - pos < CAPTURE_HEADER.size:
+            raise ValueError(f"truncated message header at offset {pos} of {path}")
+        time_us, msgtype, length = CAPTURE_HEADER.unpack_from(data, pos)
+        pos += CAPTURE_HEADER.size
+        if len(data) - pos < length:
+            raise ValueError(f"truncated message payload at offset {pos} of {path}")
+        messages.append((time_us, msgtype.split(b"\x00", 1)[0], data[pos:pos + length]))
+        pos += length
+    return messages
+
+
+class SessionRecorder:
+    """Records the messages sent and received over a P2PConnection into
+    msgs_sent.dat and msgs_recv.dat files in a directory.
+
+    Messages are timestamped with clock_us(), which returns the time in
+    microseconds since the epoch. It defaults to the system clock, whereas
+    the node stamps its captures with its mockable clock: to record the
+    same times as a node under setmocktime, pass a clock that returns its
+    mocktime (see P2PConnection.start_recording())."""
+
+    def __init__(self, directory, clock_us=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._clock_us = clock_us or (lambda: time.time_ns() // 1000)
+        self._lock = threading.Lock()
+        self._files = {
+            "sent": open(os.path.join(directory, "msgs_sent.dat"), "wb"),
+            "recv": open(os.path.join(directory, "msgs_recv.dat"), "wb"),
+        }
+
+    def record(self, direction, msgtype, payload):
+        """Record a message that was "sent" to or "recv"(eived) from the peer."""
+        with self._lock:
+            self._files[direction].write(capture_record(self._clock_us(), msgtype, payload))
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+
+
+def replay_capture(p2p, path, *, speed=None, skip_msgtypes=HANDSHAKE_MSGTYPES, batch_size=1000):
+    """Send the messages of a message capture file over a connected
+    P2PConnection, e.g. the msgs_recv.dat of a peer of a node that was run
+    with -capturemessages, or the msgs_sent.dat of a recorded session.
+
+    The messages are sent as they are, without deserializing them. Without
+    a speed, they are sent as fast as possible, in batches of batch_size
+    messages. Otherwise, they are sent at speed times the recorded pace.
+    Messages of the skip_msgtypes are not sent (by default the handshake
+    messages, as the connection has already done the handshake).
+
+    Returns the number of messages sent."""
+    messages = [(time_us, msgtype, payload) for time_us, msgtype, payload in read_capture(path) if msgtype not in skip_msgtypes]
+    if speed is None:
+        for i in range(0, len(messages), batch_size):
+            p2p.send_many(msg_generic(msgtype, payload) for _, msgtype, payload in messages[i:i + batch_size])
+    elif messages:
+        start = time.time()
+        first_time_us = messages[0][0]
+        for time_us, msgtype, payload in messages:
+            delay = start + (time_us - first_time_us) / 1e6 / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            p2p.send_without_ping(msg_generic(msgtype, payload))
+    return len(messages)
+
+
+class TestFrameworkMessageCapture(unittest.TestCase):
+    def test_record_and_read(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            recorder = SessionRecorder(os.path.join(tmpdir, "session"))
+            recorder.record("sent", b"version", b"\x01" * 100)
+            recorder.record("recv", b"verack", b"")
+            recorder.record("sent", b"ping", bytes(8))
+            recorder.close()
+            sent = read_capture(os.path.join(tmpdir, "session", "msgs_sent.dat"))
+            recv = read_capture(os.path.join(tmpdir, "session", "msgs_recv.dat"))
+        self.assertEqual([(msgtype, payload) for _, msgtype, payload in sent], [(b"version", b"\x01" * 100), (b"ping", bytes(8))])
+        self.assertEqual([(msgtype, payload) for _, msgtype, payload in recv], [(b"verack", b"")])
+        self.assertLessEqual(sent[0][0], sent[1][0])
+        self.assertLess(abs(sent[0][0] / 1e6 - time.time()), 60)
+
+    def test_record_clock(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            recorder = SessionRecorder(tmpdir, clock_us=lambda: 1_000_000)
+            recorder.record("sent", b"ping", bytes(8))
+            recorder.close()
+            self.assertEqual(read_capture(os.path.join(tmpdir, "msgs_sent.dat")), [(1_000_000, b"ping", bytes(8))])
+
+    def test_truncated(self):
+        record = capture_record(1, b"ping", bytes(8))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "msgs.dat")
+            for data, error in [(record[:10], "header"), (record[:-1], "payload")]:
+                with open(path, "wb") as f:
+                    f.write(record + data)
+                with self.assertRaisesRegex(ValueError, f"truncated message {error}"):
+                    read_capture(path)
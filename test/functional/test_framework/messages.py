@@ -15,20 +15,31 @@ msg_block, msg_tx, msg_headers, etc.:
 
 ser_*, deser_*: functions that handle serialization/deserialization.
 
+*_from_buffer: deserialization directly from a buffer (bytes, bytearray or
+    memoryview) at a given offset. These return the decoded value together
+    with the offset just past it and avoid the per-field copies of reading
+    from a stream. Message and primitive classes expose this as
+    cls.from_buffer(buf, offset) and obj.deserialize_from_buffer(buf, offset);
+    their stream based deserialize(f) is a thin wrapper around it.
+
 Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
 from base64 import b32decode, b32encode
+from collections.abc import MutableSequence
 import copy
 import hashlib
-from io import BytesIO
-import math
+from io import BufferedReader, BytesIO
+import itertools
+import operator
 import random
 import socket
+import struct
 import time
 import unittest
+import unittest.mock
 
-from test_framework.crypto.siphash import siphash256
+from test_framework.crypto.siphash import siphash256, siphash256_many
 from test_framework.util import (
     assert_equal,
     assert_not_equal,
@@ -100,6 +111,10 @@ VERSION_AUXPOW = (1 << 8)
 VERSION_CHAIN_START = (1 << 16)
 CHAIN_ID = 1
 
+# Magic bytes in front of the chain merkle root in the parent coinbase
+MERGED_MINING_HEADER = b"\xfa\xbemm"
+MAX_CHAIN_MERKLE_BRANCH_LENGTH = 30
+
 # Namecoin tx version
 NAMECOIN_TX_VERSION = 0x7100
 
@@ -128,6 +143,17 @@ def ser_compact_size(l):
     return r
 
 
+def compact_size_len(l):
+    """Return the length of the compact size encoding of l."""
+    if l < 253:
+        return 1
+    elif l < 0x10000:
+        return 3
+    elif l < 0x100000000:
+        return 5
+    return 9
+
+
 def deser_compact_size(f):
     nit = int.from_bytes(f.read(1), "little")
     if nit == 253:
@@ -186,17 +212,49 @@ def uint256_from_compact(c):
     return v
 
 
+_UINT256 = struct.Struct("32s")
+
+
+# Classes with a fixed-size serialization can declare it as a struct.Struct in
+# their _fixed_struct class attribute, together with _from_struct_fields() and
+# _struct_fields() to convert from and to the struct's fields. Vectors of
+# such objects are then (de)serialized with a single precompiled struct
+# instead of calling (de)serialize() for each element.
+def _fixed_struct_of(c):
+    # Only use the fast path for the class declaring the layout, subclasses may
+    # serialize differently.
+    return c.__dict__.get("_fixed_struct")
+
+
+def _deser_fixed_vector(data, c, codec):
+    from_fields = c._from_struct_fields
+    return [from_fields(*fields) for fields in codec.iter_unpack(data)]
+
+
+def _ser_fixed_vector(l):
+    c = type(l[0])
+    codec = _fixed_struct_of(c)
+    if codec is None or any(type(i) is not c for i in l):
+        return None
+    pack = codec.pack
+    return b"".join([pack(*i._struct_fields()) for i in l])
+
+
 # deser_function_name: Allow for an alternate deserialization function on the
 # entries in the vector.
 def deser_vector(f, c, deser_function_name=None):
     nit = deser_compact_size(f)
+    codec = None if deser_function_name else _fixed_struct_of(c)
+    if codec is not None:
+        data = f.read(nit * codec.size)
+        if len(data) != nit * codec.size:
+            raise ValueError("vector extends beyond end of stream")
+        return _deser_fixed_vector(data, c, codec)
+    deser = getattr(c, deser_function_name or "deserialize")
     r = []
     for _ in range(nit):
         t = c()
-        if deser_function_name:
-            getattr(t, deser_function_name)(f)
-        else:
-            t.deserialize(f)
+        deser(t, f)
         r.append(t)
     return r
 
@@ -206,28 +264,23 @@ def deser_vector(f, c, deser_function_name=None):
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
     r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+    if l and not ser_function_name:
+        data = _ser_fixed_vector(l)
+        if data is not None:
+            return r + data
+    return r + b"".join(map(operator.methodcaller(ser_function_name or "serialize"), l))
 
 
 def deser_uint256_vector(f):
     nit = deser_compact_size(f)
-    r = []
-    for _ in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    data = f.read(nit * 32)
+    if len(data) != nit * 32:
+        raise ValueError("vector extends beyond end of stream")
+    return [int.from_bytes(h, 'little') for (h,) in _UINT256.iter_unpack(data)]
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return ser_compact_size(len(l)) + b"".join([u.to_bytes(32, 'little') for u in l])
 
 
 def deser_string_vector(f):
@@ -246,6 +299,127 @@ def ser_string_vector(l):
     return r
 
 
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_UINT64 = struct.Struct("<Q")
+_INT64 = struct.Struct("<q")
+_HEADER = struct.Struct("<i32s32sIII")  # block header without auxpow
+_INV = struct.Struct("<I32s")
+
+
+def deser_compact_size_from_buffer(buf, offset):
+    nit = buf[offset]
+    offset += 1
+    if nit == 253:
+        nit = _UINT16.unpack_from(buf, offset)[0]
+        offset += 2
+    elif nit == 254:
+        nit = _UINT32.unpack_from(buf, offset)[0]
+        offset += 4
+    elif nit == 255:
+        nit = _UINT64.unpack_from(buf, offset)[0]
+        offset += 8
+    return nit, offset
+
+
+def deser_string_from_buffer(buf, offset):
+    nit, offset = deser_compact_size_from_buffer(buf, offset)
+    end = offset + nit
+    if end > len(buf):
+        raise ValueError("string extends beyond end of buffer")
+    return bytes(buf[offset:end]), end
+
+
+def deser_uint256_from_buffer(buf, offset):
+    return int.from_bytes(buf[offset:offset + 32], 'little'), offset + 32
+
+
+def deser_vector_from_buffer(buf, offset, c):
+    nit, offset = deser_compact_size_from_buffer(buf, offset)
+    codec = _fixed_struct_of(c)
+    if codec is not None:
+        end = offset + nit * codec.size
+        if end > len(buf):
+            raise ValueError("vector extends beyond end of buffer")
+        return _deser_fixed_vector(buf[offset:end], c, codec), end
+    r = []
+    for _ in range(nit):
+        t = c()
+        offset = t.deserialize_from_buffer(buf, offset)
+        r.append(t)
+    return r, offset
+
+
+def deser_uint256_vector_from_buffer(buf, offset):
+    nit, offset = deser_compact_size_from_buffer(buf, offset)
+    end = offset + nit * 32
+    if end > len(buf):
+        raise ValueError("vector extends beyond end of buffer")
+    return [int.from_bytes(h, 'little') for (h,) in _UINT256.iter_unpack(buf[offset:end])], end
+
+
+def deser_string_vector_from_buffer(buf, offset):
+    nit, offset = deser_compact_size_from_buffer(buf, offset)
+    r = []
+    for _ in range(nit):
+        t, offset = deser_string_from_buffer(buf, offset)
+        r.append(t)
+    return r, offset
+
+
+class _BufferReader:
+    """Minimal read-only stream over a buffer, used to run stream based
+    deserialize(f) implementations on buffers."""
+    __slots__ = ("buf", "offset")
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+
+    def read(self, n=-1):
+        start = self.offset
+        end = len(self.buf) if n < 0 else min(start + n, len(self.buf))
+        self.offset = end
+        return bytes(self.buf[start:end])
+
+
+class _BufferDeserializable:
+    """Base class for objects that can be deserialized from a buffer.
+
+    Subclasses implement either deserialize_from_buffer(buf, offset), in which
+    case deserialize(f) is derived from it, or the stream based
+    deserialize(f), in which case deserialize_from_buffer() falls back to
+    running it on a stream over the buffer.
+
+    A derived deserialize(f) only accepts a BytesIO (or the internal stream
+    over a buffer): other streams, such as files, can't be deserialized from
+    without reading them to the end, so their data must be read and passed
+    to from_buffer() instead."""
+    __slots__ = ()
+
+    @classmethod
+    def from_buffer(cls, buf, offset=0):
+        """Deserialize a new object from buf at offset. Returns the object and
+        the offset just past it."""
+        obj = cls()
+        return obj, obj.deserialize_from_buffer(memoryview(buf), offset)
+
+    def deserialize_from_buffer(self, buf, offset):
+        reader = _BufferReader(buf, offset)
+        self.deserialize(reader)
+        return reader.offset
+
+    def deserialize(self, f):
+        if isinstance(f, _BufferReader):
+            f.offset = self.deserialize_from_buffer(f.buf, f.offset)
+        elif isinstance(f, BytesIO):
+            # getvalue() does not copy a BytesIO that was created from bytes
+            # and not written to since.
+            f.seek(self.deserialize_from_buffer(memoryview(f.getvalue()), f.tell()))
+        else:
+            raise TypeError(f"{type(self).__name__}.deserialize() needs a BytesIO, not {type(f).__name__}; use from_buffer() on the data instead")
+
+
 def deser_block_spent_outputs(f):
     nit = deser_compact_size(f)
     return [deser_vector(f, CTxOut) for _ in range(nit)]
@@ -300,7 +474,7 @@ def from_binary(cls, stream):
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
 
-class CAddress:
+class CAddress(_BufferDeserializable):
     __slots__ = ("net", "ip", "nServices", "port", "time")
 
     # see https://github.com/bitcoin/bips/blob/master/bip-0155.mediawiki
@@ -426,7 +600,7 @@ class CAddress:
                 % (self.nServices, self.ADDRV2_NET_NAME[self.net], self.ip, self.port))
 
 
-class CInv:
+class CInv(_BufferDeserializable):
     __slots__ = ("hash", "type")
 
     typemap = {
@@ -440,19 +614,27 @@ class CInv:
         MSG_WTX: "WTX",
     }
 
+    _fixed_struct = _INV
+
     def __init__(self, t=0, h=0):
         self.type = t
         self.hash = h
 
-    def deserialize(self, f):
-        self.type = int.from_bytes(f.read(4), "little")
-        self.hash = deser_uint256(f)
+    @classmethod
+    def _from_struct_fields(cls, t, h):
+        return cls(t, int.from_bytes(h, 'little'))
+
+    def _struct_fields(self):
+        return self.type, self.hash.to_bytes(32, 'little')
+
+    def deserialize_from_buffer(self, buf, offset):
+        t, h = _INV.unpack_from(buf, offset)
+        self.type = t
+        self.hash = int.from_bytes(h, 'little')
+        return offset + 36
 
     def serialize(self):
-        r = b""
-        r += self.type.to_bytes(4, "little")
-        r += ser_uint256(self.hash)
-        return r
+        return _INV.pack(*self._struct_fields())
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -462,15 +644,16 @@ class CInv:
         return isinstance(other, CInv) and self.hash == other.hash and self.type == other.type
 
 
-class CBlockLocator:
+class CBlockLocator(_BufferDeserializable):
     __slots__ = ("nVersion", "vHave")
 
     def __init__(self):
         self.vHave = []
 
-    def deserialize(self, f):
-        int.from_bytes(f.read(4), "little", signed=True)  # Ignore version field.
-        self.vHave = deser_uint256_vector(f)
+    def deserialize_from_buffer(self, buf, offset):
+        offset += 4  # Ignore version field.
+        self.vHave, offset = deser_uint256_vector_from_buffer(buf, offset)
+        return offset
 
     def serialize(self):
         r = b""
@@ -482,16 +665,158 @@ class CBlockLocator:
         return "CBlockLocator(vHave=%s)" % (repr(self.vHave))
 
 
-class COutPoint:
+# Cached transaction hashes are tagged with the value of this epoch at the time
+# they were computed. Modifying any part of a transaction whose hash has been
+# cached moves the epoch forward, which invalidates all cached hashes at once.
+# Every epoch value is handed out only once, so this stays correct even when
+# the network thread and the test thread modify transactions concurrently.
+_tx_hash_epoch_counter = itertools.count(1)
+_tx_hash_epoch = 0
+
+
+def _invalidate_tx_hashes():
+    global _tx_hash_epoch
+    _tx_hash_epoch = next(_tx_hash_epoch_counter)
+
+
+class _TxComponentList(list):
+    """List of transaction parts (inputs, outputs, witness items) that
+    invalidates cached transaction hashes when modified in place."""
+    __slots__ = ("_watched",)
+
+    def __new__(cls, *args):
+        self = super().__new__(cls, *args)
+        self._watched = False
+        return self
+
+    def __getstate__(self):
+        # Copies start out unwatched.
+        return None
+
+    def _modified(self):
+        if self._watched:
+            _invalidate_tx_hashes()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._modified()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._modified()
+
+    # (mypy requires in-place operators to match the overloaded list.__add__
+    # and list.__mul__ signatures exactly.)
+    def __iadd__(self, other):  # type: ignore[misc]
+        super().__iadd__(other)
+        self._modified()
+        return self
+
+    def __imul__(self, n):  # type: ignore[misc]
+        super().__imul__(n)
+        self._modified()
+        return self
+
+    def append(self, item):
+        super().append(item)
+        self._modified()
+
+    def extend(self, items):
+        super().extend(items)
+        self._modified()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._modified()
+
+    def pop(self, *args):
+        item = super().pop(*args)
+        self._modified()
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self._modified()
+
+    def clear(self):
+        super().clear()
+        self._modified()
+
+    def sort(self, **kwargs):
+        super().sort(**kwargs)
+        self._modified()
+
+    def reverse(self):
+        super().reverse()
+        self._modified()
+
+
+class _TxComponent(_BufferDeserializable):
+    """Base class for the parts of a transaction that feed into its hashes.
+
+    Once a transaction hash has been computed and cached, all parts of the
+    transaction are marked as watched. Assigning to an attribute of a watched
+    part (or modifying one of its lists) invalidates the cached hashes. Plain
+    lists assigned to attributes are converted to tracked lists for this
+    purpose. Byte strings (scripts, witness stack items) are treated as
+    immutable; replace them instead of modifying a bytearray in place."""
+    __slots__ = ("_watched",)
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        object.__setattr__(self, "_watched", False)
+        return self
+
+    def __setattr__(self, name, value):
+        if type(value) is list:
+            value = _TxComponentList(value)
+        object.__setattr__(self, name, value)
+        if self._watched:
+            _invalidate_tx_hashes()
+
+    def __getstate__(self):
+        # Copies start out unwatched and without cached hashes.
+        slots = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if not name.startswith("_") and hasattr(self, name):
+                    slots[name] = getattr(self, name)
+        return None, slots
+
+    def _watch(self):
+        object.__setattr__(self, "_watched", True)
+
+
+def _watch_list(l):
+    if isinstance(l, _TxComponentList):
+        l._watched = True
+
+
+class COutPoint(_TxComponent):
     __slots__ = ("hash", "n")
+    _fixed_struct = struct.Struct("<32sI")
 
     def __init__(self, hash=0, n=0):
         self.hash = hash
         self.n = n
 
-    def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = int.from_bytes(f.read(4), "little")
+    @classmethod
+    def _from_struct_fields(cls, h, n):
+        return cls(int.from_bytes(h, 'little'), n)
+
+    def _struct_fields(self):
+        return self.hash.to_bytes(32, 'little'), self.n
+
+    def get_serialized_size(self):
+        return 36
+
+    def clone(self):
+        return COutPoint(self.hash, self.n)
+
+    def deserialize_from_buffer(self, buf, offset):
+        self.hash = int.from_bytes(buf[offset:offset + 32], 'little')
+        self.n = _UINT32.unpack_from(buf, offset + 32)[0]
+        return offset + 36
 
     def serialize(self):
         r = b""
@@ -503,7 +828,7 @@ class COutPoint:
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
-class CTxIn:
+class CTxIn(_TxComponent):
     __slots__ = ("nSequence", "prevout", "scriptSig")
 
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
@@ -514,11 +839,22 @@ class CTxIn:
         self.scriptSig = scriptSig
         self.nSequence = nSequence
 
-    def deserialize(self, f):
+    def deserialize_from_buffer(self, buf, offset):
         self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = int.from_bytes(f.read(4), "little")
+        offset = self.prevout.deserialize_from_buffer(buf, offset)
+        self.scriptSig, offset = deser_string_from_buffer(buf, offset)
+        self.nSequence = _UINT32.unpack_from(buf, offset)[0]
+        return offset + 4
+
+    def _watch(self):
+        super()._watch()
+        self.prevout._watch()
+
+    def get_serialized_size(self):
+        return 36 + compact_size_len(len(self.scriptSig)) + len(self.scriptSig) + 4
+
+    def clone(self):
+        return CTxIn(self.prevout.clone(), self.scriptSig, self.nSequence)
 
     def serialize(self):
         r = b""
@@ -533,16 +869,23 @@ class CTxIn:
                self.nSequence)
 
 
-class CTxOut:
+class CTxOut(_TxComponent):
     __slots__ = ("nValue", "scriptPubKey")
 
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
-    def deserialize(self, f):
-        self.nValue = int.from_bytes(f.read(8), "little", signed=True)
-        self.scriptPubKey = deser_string(f)
+    def deserialize_from_buffer(self, buf, offset):
+        self.nValue = _INT64.unpack_from(buf, offset)[0]
+        self.scriptPubKey, offset = deser_string_from_buffer(buf, offset + 8)
+        return offset
+
+    def get_serialized_size(self):
+        return 8 + compact_size_len(len(self.scriptPubKey)) + len(self.scriptPubKey)
+
+    def clone(self):
+        return CTxOut(self.nValue, self.scriptPubKey)
 
     def serialize(self):
         r = b""
@@ -556,13 +899,22 @@ class CTxOut:
                self.scriptPubKey.hex())
 
 
-class CScriptWitness:
+class CScriptWitness(_TxComponent):
     __slots__ = ("stack",)
 
     def __init__(self):
         # stack is a vector of strings
         self.stack = []
 
+    def _watch(self):
+        super()._watch()
+        _watch_list(self.stack)
+
+    def clone(self):
+        r = CScriptWitness()
+        r.stack = self.stack[:]
+        return r
+
     def __repr__(self):
         return "CScriptWitness(%s)" % \
                (",".join([x.hex() for x in self.stack]))
@@ -573,14 +925,28 @@ class CScriptWitness:
         return True
 
 
-class CTxInWitness:
+class CTxInWitness(_TxComponent):
     __slots__ = ("scriptWitness",)
 
     def __init__(self):
         self.scriptWitness = CScriptWitness()
 
-    def deserialize(self, f):
-        self.scriptWitness.stack = deser_string_vector(f)
+    def _watch(self):
+        super()._watch()
+        self.scriptWitness._watch()
+
+    def get_serialized_size(self):
+        stack = self.scriptWitness.stack
+        return compact_size_len(len(stack)) + sum(compact_size_len(len(x)) + len(x) for x in stack)
+
+    def clone(self):
+        r = CTxInWitness()
+        r.scriptWitness = self.scriptWitness.clone()
+        return r
+
+    def deserialize_from_buffer(self, buf, offset):
+        self.scriptWitness.stack, offset = deser_string_vector_from_buffer(buf, offset)
+        return offset
 
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
@@ -592,15 +958,27 @@ class CTxInWitness:
         return self.scriptWitness.is_null()
 
 
-class CTxWitness:
+class CTxWitness(_TxComponent):
     __slots__ = ("vtxinwit",)
 
     def __init__(self):
         self.vtxinwit = []
 
-    def deserialize(self, f):
+    def _watch(self):
+        super()._watch()
+        _watch_list(self.vtxinwit)
+        for x in self.vtxinwit:
+            x._watch()
+
+    def clone(self):
+        r = CTxWitness()
+        r.vtxinwit = [x.clone() for x in self.vtxinwit]
+        return r
+
+    def deserialize_from_buffer(self, buf, offset):
         for i in range(len(self.vtxinwit)):
-            self.vtxinwit[i].deserialize(f)
+            offset = self.vtxinwit[i].deserialize_from_buffer(buf, offset)
+        return offset
 
     def serialize(self):
         r = b""
@@ -622,42 +1000,64 @@ class CTxWitness:
         return True
 
 
-class CTransaction:
-    __slots__ = ("nLockTime", "version", "vin", "vout", "wit")
+class CTransaction(_TxComponent):
+    __slots__ = ("nLockTime", "version", "vin", "vout", "wit",
+                 "_size_cache", "_txid_cache", "_wtxid_cache")
 
-    def __init__(self, tx=None):
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        object.__setattr__(self, "_size_cache", None)
+        object.__setattr__(self, "_txid_cache", None)
+        object.__setattr__(self, "_wtxid_cache", None)
+        return self
+
+    def __init__(self, tx=None, *, deep=False):
+        """Create an empty transaction, or a copy of tx.
+
+        The copy gets its own inputs, outputs and witnesses, which can be
+        modified without affecting tx, but shares the scripts and witness
+        stack items with it, as those are immutable byte strings. Pass
+        deep=True to copy those as well."""
         if tx is None:
             self.version = 2
             self.vin = []
             self.vout = []
             self.wit = CTxWitness()
             self.nLockTime = 0
-        else:
+        elif deep:
             self.version = tx.version
             self.vin = copy.deepcopy(tx.vin)
             self.vout = copy.deepcopy(tx.vout)
             self.nLockTime = tx.nLockTime
             self.wit = copy.deepcopy(tx.wit)
+        else:
+            self.version = tx.version
+            self.vin = [txin.clone() for txin in tx.vin]
+            self.vout = [txout.clone() for txout in tx.vout]
+            self.nLockTime = tx.nLockTime
+            self.wit = tx.wit.clone()
 
-    def deserialize(self, f):
-        self.version = int.from_bytes(f.read(4), "little")
-        self.vin = deser_vector(f, CTxIn)
+    def deserialize_from_buffer(self, buf, offset):
+        self.version = _UINT32.unpack_from(buf, offset)[0]
+        self.vin, offset = deser_vector_from_buffer(buf, offset + 4, CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = int.from_bytes(f.read(1), "little")
+            flags = buf[offset]
+            offset += 1
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
-                self.vin = deser_vector(f, CTxIn)
-                self.vout = deser_vector(f, CTxOut)
+                self.vin, offset = deser_vector_from_buffer(buf, offset, CTxIn)
+                self.vout, offset = deser_vector_from_buffer(buf, offset, CTxOut)
         else:
-            self.vout = deser_vector(f, CTxOut)
+            self.vout, offset = deser_vector_from_buffer(buf, offset, CTxOut)
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for _ in range(len(self.vin))]
-            self.wit.deserialize(f)
+            offset = self.wit.deserialize_from_buffer(buf, offset)
         else:
             self.wit = CTxWitness()
-        self.nLockTime = int.from_bytes(f.read(4), "little")
+        self.nLockTime = _UINT32.unpack_from(buf, offset)[0]
+        return offset + 4
 
     def serialize_without_witness(self):
         r = b""
@@ -695,10 +1095,35 @@ class CTransaction:
     def serialize(self):
         return self.serialize_with_witness()
 
+    def _watch(self):
+        super()._watch()
+        _watch_list(self.vin)
+        for txin in self.vin:
+            txin._watch()
+        _watch_list(self.vout)
+        for txout in self.vout:
+            txout._watch()
+        self.wit._watch()
+
+    def _cached(self, cache_slot, compute):
+        cached = getattr(self, cache_slot)
+        if cached is not None and cached[0] == _tx_hash_epoch:
+            return cached[1]
+        # Start watching before reading the epoch and computing, so that any
+        # modification racing with the computation invalidates the result.
+        self._watch()
+        epoch = _tx_hash_epoch
+        value = compute()
+        object.__setattr__(self, cache_slot, (epoch, value))
+        return value
+
     @property
     def wtxid(self):
         """Return wtxid (transaction hash with witness) as little-endian bytes."""
-        return hash256(self.serialize_with_witness())
+        if self.wit.is_null():
+            # Without witness data both serializations are identical.
+            return self.txid
+        return self._cached("_wtxid_cache", lambda: hash256(self.serialize_with_witness()))
 
     @property
     def wtxid_hex(self):
@@ -713,7 +1138,7 @@ class CTransaction:
     @property
     def txid(self):
         """Return txid (transaction hash without witness) as little-endian bytes."""
-        return hash256(self.serialize_without_witness())
+        return self._cached("_txid_cache", lambda: hash256(self.serialize_without_witness()))
 
     @property
     def txid_hex(self):
@@ -731,15 +1156,32 @@ class CTransaction:
                 return False
         return True
 
+    def _compute_sizes(self):
+        """Add up the serialized sizes without and with witness, field by
+        field, mirroring serialize_without_witness and serialize_with_witness."""
+        size = (4 + compact_size_len(len(self.vin)) + sum(txin.get_serialized_size() for txin in self.vin) +
+                compact_size_len(len(self.vout)) + sum(txout.get_serialized_size() for txout in self.vout) + 4)
+        if self.wit.is_null():
+            return size, size
+        # Marker and flag, and a witness for each input (empty if missing)
+        vtxinwit = self.wit.vtxinwit[:len(self.vin)]
+        witness_size = 2 + sum(x.get_serialized_size() for x in vtxinwit) + len(self.vin) - len(vtxinwit)
+        return size, size + witness_size
+
+    def get_serialized_size(self, with_witness=True):
+        """Return the length of serialize_with_witness() (or of
+        serialize_without_witness()) without serializing."""
+        sizes = self._cached("_size_cache", self._compute_sizes)
+        return sizes[1] if with_witness else sizes[0]
+
     # Calculate the transaction weight using witness and non-witness
     # serialization size (does NOT use sigops).
     def get_weight(self):
-        with_witness_size = len(self.serialize_with_witness())
-        without_witness_size = len(self.serialize_without_witness())
+        without_witness_size, with_witness_size = self._cached("_size_cache", self._compute_sizes)
         return (WITNESS_SCALE_FACTOR - 1) * without_witness_size + with_witness_size
 
     def get_vsize(self):
-        return math.ceil(self.get_weight() / WITNESS_SCALE_FACTOR)
+        return (self.get_weight() + WITNESS_SCALE_FACTOR - 1) // WITNESS_SCALE_FACTOR
 
     def __repr__(self):
         return "CTransaction(version=%i vin=%s vout=%s wit=%s nLockTime=%i)" \
@@ -759,14 +1201,87 @@ class CAuxPow(CTransaction):
         self.nChainIndex = 0
         self.parentBlock = CBlockHeader()
 
-    def deserialize(self, f):
-        super(CAuxPow, self).deserialize(f)
-        self.hashBlock = deser_uint256(f)
-        self.vMerkleBranch = deser_uint256_vector(f)
-        self.nIndex = int.from_bytes(f.read(4), "little")
-        self.vChainMerkleBranch = deser_uint256_vector(f)
-        self.nChainIndex = int.from_bytes(f.read(4), "little")
-        self.parentBlock.deserialize(f)
+    def set_merkle_branch(self, tree, index):
+        """Set the branch linking this coinbase, leaf index of the MerkleTree
+        of the parent block's transactions, to the parent block."""
+        self.vMerkleBranch = [uint256_from_str(h) for h in tree.branch(index)]
+        self.nIndex = index
+
+    def set_chain_merkle_branch(self, tree, index):
+        """Set the branch linking the block hash, leaf index of the
+        merge-mining MerkleTree, to the root committed in the coinbase."""
+        self.vChainMerkleBranch = [uint256_from_str(h) for h in tree.branch(index)]
+        self.nChainIndex = index
+
+    @staticmethod
+    def get_expected_index(nonce, chain_id, height):
+        """Return the slot of the chain with chain_id in a merge-mining
+        merkle tree of the given height, for the nonce in the coinbase."""
+        rand = (nonce * 1103515245 + 12345) & 0xffffffff
+        rand = ((rand + chain_id) * 1103515245 + 12345) & 0xffffffff
+        return rand % (1 << height)
+
+    def check(self, hash_aux_block, chain_id, strict_chain_id=True):
+        """Check that this auxpow commits to the block hash hash_aux_block
+        (as integer), like CAuxPow::check in the node. Raise ValueError with
+        the node's error message if it does not. This does not check the
+        proof of work of the parent block.
+
+        As in the node, nIndex is ignored: the parent coinbase is always
+        the first transaction of the parent block."""
+        if strict_chain_id and self.parentBlock.get_chain_id() == chain_id:
+            raise ValueError("Aux POW parent has our chain ID")
+        if len(self.vChainMerkleBranch) > MAX_CHAIN_MERKLE_BRANCH_LENGTH:
+            raise ValueError("Aux POW chain merkle branch too long")
+
+        chain_branch = [ser_uint256(h) for h in self.vChainMerkleBranch]
+        root_hash = MerkleTree.root_from_branch(ser_uint256(hash_aux_block), chain_branch, self.nChainIndex)[::-1]
+
+        branch = [ser_uint256(h) for h in self.vMerkleBranch]
+        if uint256_from_str(MerkleTree.root_from_branch(self.txid, branch, 0)) != self.parentBlock.hashMerkleRoot:
+            raise ValueError("Aux POW merkle root incorrect")
+        if not self.vin:
+            raise ValueError("Aux POW coinbase has no inputs")
+
+        script = bytes(self.vin[0].scriptSig)
+        head = script.find(MERGED_MINING_HEADER)
+        pos = script.find(root_hash)
+        if pos == -1:
+            raise ValueError("Aux POW missing chain merkle root in parent coinbase")
+        if head != -1:
+            # Only a single merged mining header, just before the chain merkle root
+            if script.find(MERGED_MINING_HEADER, head + 1) != -1:
+                raise ValueError("Multiple merged mining headers in coinbase")
+            if head + len(MERGED_MINING_HEADER) != pos:
+                raise ValueError("Merged mining header is not just before chain merkle root")
+        elif pos > 20:
+            raise ValueError("Aux POW chain merkle root must start in the first 20 bytes of the parent coinbase")
+
+        pos += len(root_hash)
+        if len(script) - pos < 8:
+            raise ValueError("Aux POW missing chain merkle tree size and nonce in parent coinbase")
+        size, nonce = struct.unpack_from("<II", script, pos)
+        height = len(self.vChainMerkleBranch)
+        if size != 1 << height:
+            raise ValueError("Aux POW merkle branch size does not match parent coinbase")
+        if self.nChainIndex != self.get_expected_index(nonce, chain_id, height):
+            raise ValueError("Aux POW wrong index")
+
+    def deserialize_from_buffer(self, buf, offset):
+        offset = super(CAuxPow, self).deserialize_from_buffer(buf, offset)
+        self.hashBlock, offset = deser_uint256_from_buffer(buf, offset)
+        self.vMerkleBranch, offset = deser_uint256_vector_from_buffer(buf, offset)
+        self.nIndex = _UINT32.unpack_from(buf, offset)[0]
+        self.vChainMerkleBranch, offset = deser_uint256_vector_from_buffer(buf, offset + 4)
+        self.nChainIndex = _UINT32.unpack_from(buf, offset)[0]
+        return self.parentBlock.deserialize_from_buffer(buf, offset + 4)
+
+    def get_serialized_size(self, with_witness=True):
+        assert with_witness, "auxpow is always serialized with witness"
+        return (super(CAuxPow, self).get_serialized_size() + 32 +
+                compact_size_len(len(self.vMerkleBranch)) + 32 * len(self.vMerkleBranch) + 4 +
+                compact_size_len(len(self.vChainMerkleBranch)) + 32 * len(self.vChainMerkleBranch) + 4 +
+                self.parentBlock.get_serialized_size())
 
     def serialize(self):
         r = b""
@@ -780,7 +1295,7 @@ class CAuxPow(CTransaction):
         return r
 
 
-class CBlockHeader:
+class CBlockHeader(_BufferDeserializable):
     __slots__ = ("hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce",
                  "auxpow",
                  "nTime", "nVersion")
@@ -819,32 +1334,67 @@ class CBlockHeader:
     def is_auxpow(self):
         return (self.nVersion & VERSION_AUXPOW) > 0
 
-    def deserialize(self, f):
-        self.nVersion = int.from_bytes(f.read(4), "little", signed=True)
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = int.from_bytes(f.read(4), "little")
-        self.nBits = int.from_bytes(f.read(4), "little")
-        self.nNonce = int.from_bytes(f.read(4), "little")
+    def is_legacy(self):
+        return self.nVersion == 1
+
+    def get_chain_id(self):
+        return self.nVersion // VERSION_CHAIN_START
+
+    def check_proof_of_work(self, pow_hash=hash256, chain_id=CHAIN_ID, strict_chain_id=True, target=None):
+        """Check the proof of work of this header, which is done on the
+        parent block for auxpow headers, like CheckAuxPowProofOfWork in the
+        node. Raise ValueError with the node's error message if it is not
+        valid.
+
+        pow_hash maps a serialized 80-byte header to its proof-of-work hash
+        (as little-endian bytes). The default is double-SHA256, but merge
+        mining parents may use another one (such as scrypt)."""
+        if target is None:
+            target = uint256_from_compact(self.nBits)
+        if not self.is_legacy() and strict_chain_id and self.get_chain_id() != chain_id:
+            raise ValueError("block does not have our chain ID")
+        if self.auxpow is None:
+            if self.is_auxpow():
+                raise ValueError("no auxpow on block with auxpow version")
+            if uint256_from_str(pow_hash(self._serialize_header(False))) > target:
+                raise ValueError("non-AUX proof of work failed")
+            return
+        if not self.is_auxpow():
+            raise ValueError("auxpow on block with non-auxpow version")
+        parent = self.auxpow.parentBlock
+        if parent.is_auxpow():
+            raise ValueError("auxpow parent block has auxpow version")
+        if uint256_from_str(pow_hash(parent._serialize_header(False))) > target:
+            raise ValueError("AUX proof of work failed")
+        self.auxpow.check(self.hash_int, self.get_chain_id(), strict_chain_id)
+
+    def deserialize_from_buffer(self, buf, offset):
+        self.nVersion, prev, merkle, self.nTime, self.nBits, self.nNonce = _HEADER.unpack_from(buf, offset)
+        self.hashPrevBlock = int.from_bytes(prev, 'little')
+        self.hashMerkleRoot = int.from_bytes(merkle, 'little')
+        offset += 80
         if self.is_auxpow():
             self.auxpow = CAuxPow()
-            self.auxpow.deserialize(f)
+            offset = self.auxpow.deserialize_from_buffer(buf, offset)
+        return offset
 
     def serialize(self):
         return self._serialize_header(True)
 
     def _serialize_header(self, withAuxpow):
-        r = b""
-        r += self.nVersion.to_bytes(4, "little", signed=True)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += self.nTime.to_bytes(4, "little")
-        r += self.nBits.to_bytes(4, "little")
-        r += self.nNonce.to_bytes(4, "little")
+        r = _HEADER.pack(self.nVersion, self.hashPrevBlock.to_bytes(32, 'little'),
+                         self.hashMerkleRoot.to_bytes(32, 'little'),
+                         self.nTime, self.nBits, self.nNonce)
         if withAuxpow and self.is_auxpow():
             r += self.auxpow.serialize()
         return r
 
+    def get_serialized_size(self):
+        """Return the length of the serialized header, including auxpow."""
+        if self.is_auxpow():
+            return BLOCK_HEADER_SIZE + self.auxpow.get_serialized_size()
+        return BLOCK_HEADER_SIZE
+
     @property
     def hash_hex(self):
         """Return block header hash as hex string."""
@@ -863,16 +1413,149 @@ class CBlockHeader:
 BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 80)
 
+
+def check_proof_of_work_many(headers, pow_hash=hash256, chain_id=CHAIN_ID, strict_chain_id=True):
+    """Check the (aux)pow of many headers or blocks, e.g. read from blk files.
+
+    Return a list with, for each header, None if its proof of work is valid
+    or the error message of CBlockHeader.check_proof_of_work() otherwise.
+    Targets are decoded once per distinct nBits."""
+    targets = {}
+    results = []
+    for header in headers:
+        target = targets.get(header.nBits)
+        if target is None:
+            target = targets[header.nBits] = uint256_from_compact(header.nBits)
+        try:
+            header.check_proof_of_work(pow_hash, chain_id, strict_chain_id, target)
+            results.append(None)
+        except ValueError as e:
+            results.append(str(e))
+    return results
+
+class MerkleTree:
+    """Bitcoin merkle tree over a list of 32-byte hashes (little-endian bytes)
+    that keeps all levels, so that appending, replacing or removing a leaf only
+    rehashes the O(log n) nodes on its path to the root.
+
+    As in Bitcoin, a level with an odd number of nodes pairs its last node
+    with itself."""
+    __slots__ = ("_levels",)
+
+    def __init__(self, leaves=()):
+        self._levels = [list(leaves)]
+        level = self._levels[0]
+        while len(level) > 1:
+            level = [hash256(level[i] + level[min(i + 1, len(level) - 1)]) for i in range(0, len(level), 2)]
+            self._levels.append(level)
+
+    def __len__(self):
+        return len(self._levels[0])
+
+    def __getitem__(self, i):
+        return self._levels[0][i]
+
+    @property
+    def root(self):
+        """Return the merkle root as little-endian bytes."""
+        assert len(self) > 0, "merkle tree of no leaves has no root"
+        return self._levels[-1][0]
+
+    def _rehash_path(self, i):
+        """Recompute the nodes above leaf i, and resize the upper levels to
+        match the number of leaves."""
+        k = 0
+        while len(self._levels[k]) > 1:
+            level = self._levels[k]
+            if k + 1 == len(self._levels):
+                self._levels.append([])
+            parent_level = self._levels[k + 1]
+            del parent_level[(len(level) + 1) // 2:]
+            p = i >> 1
+            left = level[2 * p]
+            right = level[2 * p + 1] if 2 * p + 1 < len(level) else left
+            h = hash256(left + right)
+            if p < len(parent_level):
+                parent_level[p] = h
+            else:
+                parent_level.append(h)
+            i = p
+            k += 1
+        del self._levels[k + 1:]
+
+    def append(self, leaf):
+        self._levels[0].append(leaf)
+        self._rehash_path(len(self) - 1)
+
+    def replace(self, i, leaf):
+        self._levels[0][i] = leaf
+        self._rehash_path(i)
+
+    def pop(self):
+        leaf = self._levels[0].pop()
+        if len(self) > 0:
+            self._rehash_path(len(self) - 1)
+        else:
+            del self._levels[1:]
+        return leaf
+
+    def update_leaves(self, leaves):
+        """Make the tree match the given list of leaves, rehashing only the
+        paths of leaves that changed."""
+        while len(self) > len(leaves):
+            self.pop()
+        for i, (old, new) in enumerate(zip(self._levels[0], leaves)):
+            if old != new:
+                self.replace(i, new)
+        for leaf in leaves[len(self):]:
+            self.append(leaf)
+
+    def branch(self, i):
+        """Return the merkle branch (list of sibling hashes from the leaf up)
+        proving that leaf i is part of the tree."""
+        branch = []
+        for level in self._levels[:-1]:
+            sibling = i ^ 1
+            branch.append(level[sibling] if sibling < len(level) else level[i])
+            i >>= 1
+        return branch
+
+    @staticmethod
+    def root_from_branch(leaf, branch, i):
+        """Compute the merkle root from a leaf, its merkle branch and its
+        index in the tree."""
+        h = leaf
+        for sibling in branch:
+            if i & 1:
+                h = hash256(sibling + h)
+            else:
+                h = hash256(h + sibling)
+            i >>= 1
+        return h
+
+    def level(self, height):
+        """Return the nodes at the given height above the leaves."""
+        return self._levels[height]
+
+    @property
+    def height(self):
+        return len(self._levels) - 1
+
+
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    __slots__ = ("vtx", "_merkle_tree", "_witness_merkle_tree")
 
     def __init__(self, header=None):
         super().__init__(header)
         self.vtx = []
+        # Merkle trees of the last root calculations, updated incrementally
+        self._merkle_tree = None
+        self._witness_merkle_tree = None
 
-    def deserialize(self, f):
-        super().deserialize(f)
-        self.vtx = deser_vector(f, CTransaction)
+    def deserialize_from_buffer(self, buf, offset):
+        offset = super().deserialize_from_buffer(buf, offset)
+        self.vtx, offset = deser_vector_from_buffer(buf, offset, CTransaction)
+        return offset
 
     def serialize(self, with_witness=True):
         r = b""
@@ -886,19 +1569,22 @@ class CBlock(CBlockHeader):
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
     def get_merkle_root(cls, hashes):
-        while len(hashes) > 1:
-            newhashes = []
-            for i in range(0, len(hashes), 2):
-                i2 = min(i+1, len(hashes)-1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        return uint256_from_str(hashes[0])
+        return uint256_from_str(MerkleTree(hashes).root)
+
+    def _update_merkle_tree(self, slot, hashes):
+        tree = getattr(self, slot)
+        if tree is None:
+            tree = MerkleTree(hashes)
+            setattr(self, slot, tree)
+        else:
+            tree.update_leaves(hashes)
+        return tree
 
     def calc_merkle_root(self):
         hashes = []
         for tx in self.vtx:
-            hashes.append(ser_uint256(tx.txid_int))
-        return self.get_merkle_root(hashes)
+            hashes.append(tx.txid)
+        return uint256_from_str(self._update_merkle_tree("_merkle_tree", hashes).root)
 
     def calc_witness_merkle_root(self):
         # For witness root purposes, the hash of the
@@ -907,18 +1593,16 @@ class CBlock(CBlockHeader):
 
         for tx in self.vtx[1:]:
             # Calculate the hashes with witness data
-            hashes.append(ser_uint256(tx.wtxid_int))
-
-        return self.get_merkle_root(hashes)
+            hashes.append(tx.wtxid)
 
-    def is_valid(self):
-        target = uint256_from_compact(self.nBits)
+        return uint256_from_str(self._update_merkle_tree("_witness_merkle_tree", hashes).root)
 
-        # FIXME: Validation is not actually used anywhere.  If it is in
-        # the future, need to implement basic auxpow checking.
-        assert not self.is_auxpow()
-
-        if self.hash_int > target:
+    def is_valid(self, pow_hash=hash256, chain_id=CHAIN_ID, strict_chain_id=True):
+        """Check the (aux)pow, transaction values and merkle root of this
+        block. See CBlockHeader.check_proof_of_work for the arguments."""
+        try:
+            self.check_proof_of_work(pow_hash, chain_id, strict_chain_id)
+        except ValueError:
             return False
         for tx in self.vtx:
             if not tx.is_valid():
@@ -932,12 +1616,16 @@ class CBlock(CBlockHeader):
         while self.hash_int > target:
             self.nNonce += 1
 
+    def get_serialized_size(self, with_witness=True):
+        """Return the length of the serialized block, including the transactions."""
+        return (CBlockHeader.get_serialized_size(self) + compact_size_len(len(self.vtx)) +
+                sum(tx.get_serialized_size(with_witness=with_witness) for tx in self.vtx))
+
     # Calculate the block weight using witness and non-witness
     # serialization size (does NOT use sigops).
     def get_weight(self):
-        with_witness_size = len(self.serialize(with_witness=True))
-        without_witness_size = len(self.serialize(with_witness=False))
-        return (WITNESS_SCALE_FACTOR - 1) * without_witness_size + with_witness_size
+        header_size = CBlockHeader.get_serialized_size(self) + compact_size_len(len(self.vtx))
+        return WITNESS_SCALE_FACTOR * header_size + sum(tx.get_weight() for tx in self.vtx)
 
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
@@ -945,17 +1633,217 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
-class PrefilledTransaction:
+def _skip_transaction(buf, offset):
+    """Find the boundaries of the serialized transaction at offset without
+    decoding it. Returns the offset of its witness data (None if it has no
+    witness) and the offset just past it."""
+    offset += 4  # version
+    n_in, offset = deser_compact_size_from_buffer(buf, offset)
+    flags = 0
+    has_outputs = True
+    if n_in == 0:
+        # Mirrors CTransaction.deserialize_from_buffer()
+        flags = buf[offset]
+        offset += 1
+        if flags != 0:
+            n_in, offset = deser_compact_size_from_buffer(buf, offset)
+        else:
+            has_outputs = False
+    for _ in range(n_in):
+        script_len, offset = deser_compact_size_from_buffer(buf, offset + 36)
+        offset += script_len + 4
+    if has_outputs:
+        n_out, offset = deser_compact_size_from_buffer(buf, offset)
+        for _ in range(n_out):
+            script_len, offset = deser_compact_size_from_buffer(buf, offset + 8)
+            offset += script_len
+    witness_start = None
+    if flags != 0:
+        witness_start = offset
+        for _ in range(n_in):
+            n_items, offset = deser_compact_size_from_buffer(buf, offset)
+            for _ in range(n_items):
+                item_len, offset = deser_compact_size_from_buffer(buf, offset)
+                offset += item_len
+    offset += 4  # nLockTime
+    if offset > len(buf):
+        raise ValueError("transaction extends beyond end of buffer")
+    return witness_start, offset
+
+
+class LazyTransactionList(MutableSequence):
+    """List of the transactions of a serialized block that are only decoded
+    when accessed.
+
+    The serialized transactions are kept as bytes together with the
+    boundaries of each transaction. Transactions that were never accessed are
+    serialized and hashed straight from these bytes. Accessed transactions are
+    decoded once and from then on behave like in a normal list."""
+    __slots__ = ("_entries", "_raw")
+
+    def __init__(self, raw=b"", spans=()):
+        self._raw = raw
+        # Either a decoded CTransaction, or a (start, witness_start, end)
+        # tuple locating the serialized transaction in _raw.
+        self._entries = list(spans)
+
+    @classmethod
+    def from_buffer(cls, buf, offset=0):
+        """Index the vector of transactions at offset in a single pass.
+        Returns the list and the offset just past the transactions."""
+        buf = memoryview(buf)
+        n, start = deser_compact_size_from_buffer(buf, offset)
+        spans = []
+        end = start
+        for _ in range(n):
+            witness_start, tx_end = _skip_transaction(buf, end)
+            spans.append((end - start, None if witness_start is None else witness_start - start, tx_end - start))
+            end = tx_end
+        return cls(bytes(buf[start:end]), spans), end
+
+    def _decode(self, i):
+        entry = self._entries[i]
+        if isinstance(entry, tuple):
+            entry, _ = CTransaction.from_buffer(self._raw, entry[0])
+            self._entries[i] = entry
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._decode(j) for j in range(*i.indices(len(self._entries)))]
+        return self._decode(i)
+
+    def __setitem__(self, i, tx):
+        self._entries[i] = list(tx) if isinstance(i, slice) else tx
+
+    def __delitem__(self, i):
+        del self._entries[i]
+
+    def insert(self, i, tx):
+        self._entries.insert(i, tx)
+
+    def decoded_count(self):
+        """Return how many transactions have been decoded so far."""
+        return sum(1 for entry in self._entries if not isinstance(entry, tuple))
+
+    def serialize_tx(self, i, with_witness=True):
+        entry = self._entries[i]
+        if not isinstance(entry, tuple):
+            return entry.serialize_with_witness() if with_witness else entry.serialize_without_witness()
+        start, witness_start, end = entry
+        if with_witness or witness_start is None:
+            return self._raw[start:end]
+        # Leave out the segwit marker and flag bytes and the witness data
+        return self._raw[start:start + 4] + self._raw[start + 6:witness_start] + self._raw[end - 4:end]
+
+    def serialize(self, with_witness=True):
+        return ser_compact_size(len(self._entries)) + b"".join(
+            self.serialize_tx(i, with_witness) for i in range(len(self._entries)))
+
+    def get_serialized_size(self, i, with_witness=True):
+        """Return the serialized length of transaction i, without decoding it."""
+        entry = self._entries[i]
+        if not isinstance(entry, tuple):
+            return entry.get_serialized_size(with_witness=with_witness)
+        start, witness_start, end = entry
+        if with_witness or witness_start is None:
+            return end - start
+        return end - start - 2 - (end - 4 - witness_start)
+
+    def get_weight(self, i):
+        """Return the weight of transaction i, without decoding it."""
+        entry = self._entries[i]
+        if not isinstance(entry, tuple):
+            return entry.get_weight()
+        start, witness_start, end = entry
+        with_witness_size = end - start
+        without_witness_size = with_witness_size
+        if witness_start is not None:
+            without_witness_size -= 2 + (end - 4 - witness_start)
+        return (WITNESS_SCALE_FACTOR - 1) * without_witness_size + with_witness_size
+
+    def txid(self, i):
+        """Return the txid of transaction i as little-endian bytes, without decoding it."""
+        entry = self._entries[i]
+        if not isinstance(entry, tuple):
+            return entry.txid
+        return hash256(self.serialize_tx(i, with_witness=False))
+
+    def wtxid(self, i):
+        """Return the wtxid of transaction i as little-endian bytes, without decoding it."""
+        entry = self._entries[i]
+        if not isinstance(entry, tuple):
+            return entry.wtxid
+        return hash256(self.serialize_tx(i))
+
+    def __repr__(self):
+        return "LazyTransactionList(%d transactions, %d decoded)" % (len(self._entries), self.decoded_count())
+
+
+class CLazyBlock(CBlock):
+    """A block that only decodes its header up front.
+
+    The transactions are indexed in a single pass over the serialized block
+    and kept as a LazyTransactionList, so consumers that only look at the
+    header, the transaction count or a few transactions don't pay for
+    decoding the rest. Serialization, weight and merkle root calculation use
+    the original bytes of transactions that were never accessed."""
+    __slots__ = ()
+
+    def deserialize_from_buffer(self, buf, offset):
+        offset = CBlockHeader.deserialize_from_buffer(self, buf, offset)
+        self.vtx, offset = LazyTransactionList.from_buffer(buf, offset)
+        return offset
+
+    def serialize(self, with_witness=True):
+        if not isinstance(self.vtx, LazyTransactionList):
+            return super().serialize(with_witness)
+        return CBlockHeader.serialize(self) + self.vtx.serialize(with_witness)
+
+    def get_serialized_size(self, with_witness=True):
+        if not isinstance(self.vtx, LazyTransactionList):
+            return super().get_serialized_size(with_witness)
+        return (CBlockHeader.get_serialized_size(self) + compact_size_len(len(self.vtx)) +
+                sum(self.vtx.get_serialized_size(i, with_witness) for i in range(len(self.vtx))))
+
+    def get_weight(self):
+        if not isinstance(self.vtx, LazyTransactionList):
+            return super().get_weight()
+        header_size = CBlockHeader.get_serialized_size(self) + compact_size_len(len(self.vtx))
+        return WITNESS_SCALE_FACTOR * header_size + sum(self.vtx.get_weight(i) for i in range(len(self.vtx)))
+
+    def calc_merkle_root(self):
+        if not isinstance(self.vtx, LazyTransactionList):
+            return super().calc_merkle_root()
+        hashes = [self.vtx.txid(i) for i in range(len(self.vtx))]
+        return uint256_from_str(self._update_merkle_tree("_merkle_tree", hashes).root)
+
+    def calc_witness_merkle_root(self):
+        if not isinstance(self.vtx, LazyTransactionList):
+            return super().calc_witness_merkle_root()
+        hashes = [ser_uint256(0)] + [self.vtx.wtxid(i) for i in range(1, len(self.vtx))]
+        return uint256_from_str(self._update_merkle_tree("_witness_merkle_tree", hashes).root)
+
+    def __repr__(self):
+        return "CLazyBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
+            % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
+               time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
+
+
+class PrefilledTransaction(_BufferDeserializable):
     __slots__ = ("index", "tx")
 
     def __init__(self, index=0, tx = None):
         self.index = index
         self.tx = tx
 
-    def deserialize(self, f):
-        self.index = deser_compact_size(f)
+    def deserialize_from_buffer(self, buf, offset):
+        self.index, offset = deser_compact_size_from_buffer(buf, offset)
         self.tx = CTransaction()
-        self.tx.deserialize(f)
+        return self.tx.deserialize_from_buffer(buf, offset)
 
     def serialize(self, with_witness=True):
         r = b""
@@ -977,7 +1865,7 @@ class PrefilledTransaction:
 
 
 # This is what we send on the wire, in a cmpctblock message.
-class P2PHeaderAndShortIDs:
+class P2PHeaderAndShortIDs(_BufferDeserializable):
     __slots__ = ("header", "nonce", "prefilled_txn", "prefilled_txn_length",
                  "shortids", "shortids_length")
 
@@ -989,16 +1877,17 @@ class P2PHeaderAndShortIDs:
         self.prefilled_txn_length = 0
         self.prefilled_txn = []
 
-    def deserialize(self, f):
-        self.header.deserialize(f)
-        self.nonce = int.from_bytes(f.read(8), "little")
-        self.shortids_length = deser_compact_size(f)
+    def deserialize_from_buffer(self, buf, offset):
+        offset = self.header.deserialize_from_buffer(buf, offset)
+        self.nonce = _UINT64.unpack_from(buf, offset)[0]
+        self.shortids_length, offset = deser_compact_size_from_buffer(buf, offset + 8)
         for _ in range(self.shortids_length):
-            # shortids are defined to be 6 bytes in the spec, so append
-            # two zero bytes and read it in as an 8-byte number
-            self.shortids.append(int.from_bytes(f.read(6) + b'\x00\x00', "little"))
-        self.prefilled_txn = deser_vector(f, PrefilledTransaction)
+            # shortids are defined to be 6 bytes in the spec
+            self.shortids.append(int.from_bytes(buf[offset:offset + 6], "little"))
+            offset += 6
+        self.prefilled_txn, offset = deser_vector_from_buffer(buf, offset, PrefilledTransaction)
         self.prefilled_txn_length = len(self.prefilled_txn)
+        return offset
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
@@ -1033,6 +1922,11 @@ def calculate_shortid(k0, k1, tx_hash):
     return expected_shortid
 
 
+# Calculate the shortids for a list of transaction hashes, with the same keys
+def calculate_shortids(k0, k1, tx_hashes):
+    return [h & 0x0000ffffffffffff for h in siphash256_many(k0, k1, tx_hashes)]
+
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs:
@@ -1049,6 +1943,7 @@ class HeaderAndShortIDs:
             self.header = p2pheaders_and_shortids.header
             self.nonce = p2pheaders_and_shortids.nonce
             self.shortids = p2pheaders_and_shortids.shortids
+            self.use_witness = isinstance(p2pheaders_and_shortids, P2PHeaderAndShortWitnessIDs)
             last_index = -1
             for x in p2pheaders_and_shortids.prefilled_txn:
                 self.prefilled_txn.append(PrefilledTransaction(x.index + last_index + 1, x.tx))
@@ -1089,29 +1984,108 @@ class HeaderAndShortIDs:
         self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
-        for i in range(len(block.vtx)):
-            if i not in prefill_list:
-                tx_hash = block.vtx[i].txid_int
-                if use_witness:
-                    tx_hash = block.vtx[i].wtxid_int
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+        prefilled = set(prefill_list)
+        tx_hashes = [tx.wtxid_int if use_witness else tx.txid_int for i, tx in enumerate(block.vtx) if i not in prefilled]
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
 
 
-class BlockTransactionsRequest:
+class PartiallyDownloadedBlock:
+    """Reconstruct a block from a compact block and the transactions we know
+    about, the way the node does (see PartiallyDownloadedBlock in
+    src/blockencodings.cpp).
+
+    The short IDs of the compact block are indexed, and looked up for each
+    transaction of mempool (e.g. a mirror of a node's mempool), with the
+    short IDs of all of them computed in one batch. If more than one
+    transaction matches a short ID, the transaction is treated as missing
+    and its index is recorded in collisions. Missing transactions can then
+    be requested with getblocktxn and passed to fill_block().
+
+    Short IDs are computed from wtxids or txids according to the
+    use_witness of the compact block, unless use_witness is given (a
+    P2PHeaderAndShortIDs deserialized from a cmpctblock message does not
+    record which of them the sender used)."""
+    __slots__ = ("header", "txn_available", "collisions")
+
+    def __init__(self, cmpctblock, mempool=(), use_witness=None):
+        if isinstance(cmpctblock, P2PHeaderAndShortIDs):
+            cmpctblock = HeaderAndShortIDs(cmpctblock)
+        if use_witness is None:
+            use_witness = cmpctblock.use_witness
+        block_size = len(cmpctblock.shortids) + len(cmpctblock.prefilled_txn)
+        if block_size == 0:
+            raise ValueError("compact block without transactions")
+        self.header = CBlockHeader(cmpctblock.header)
+        self.txn_available = [None] * block_size
+        self.collisions = []
+        for prefilled in cmpctblock.prefilled_txn:
+            if prefilled.index >= block_size or self.txn_available[prefilled.index] is not None:
+                raise ValueError(f"invalid prefilled transaction index {prefilled.index}")
+            self.txn_available[prefilled.index] = prefilled.tx
+
+        shortid_index = {}
+        shortids = iter(cmpctblock.shortids)
+        for i in range(block_size):
+            if self.txn_available[i] is None:
+                shortid_index[next(shortids)] = i
+        if len(shortid_index) != len(cmpctblock.shortids):
+            raise ValueError("short ID collision within the compact block")
+
+        mempool = list(mempool)
+        k0, k1 = cmpctblock.get_siphash_keys()
+        tx_hashes = [tx.wtxid_int if use_witness else tx.txid_int for tx in mempool]
+        found = {}
+        for tx, shortid in zip(mempool, calculate_shortids(k0, k1, tx_hashes)):
+            i = shortid_index.get(shortid)
+            if i is None:
+                continue
+            if i not in found:
+                found[i] = tx
+                self.txn_available[i] = tx
+            elif self.txn_available[i] is not None and found[i].wtxid_int != tx.wtxid_int:
+                self.txn_available[i] = None
+                self.collisions.append(i)
+
+    def missing_indexes(self):
+        """Return the indexes of the transactions to request with getblocktxn."""
+        return [i for i, tx in enumerate(self.txn_available) if tx is None]
+
+    def fill_block(self, missing_txs):
+        """Return the block, completed with the requested transactions
+        (in the order of missing_indexes())."""
+        missing_txs = iter(missing_txs)
+        block = CBlock(self.header)
+        try:
+            block.vtx = [next(missing_txs) if tx is None else tx for tx in self.txn_available]
+        except StopIteration:
+            raise ValueError("not enough transactions to fill the block")
+        if next(missing_txs, None) is not None:
+            raise ValueError("too many transactions to fill the block")
+        if block.calc_merkle_root() != block.hashMerkleRoot:
+            raise ValueError("reconstructed block does not match the merkle root")
+        return block
+
+    def __repr__(self):
+        return "PartiallyDownloadedBlock(header=%s, missing=%s, collisions=%s)" % (repr(self.header), repr(self.missing_indexes()), repr(self.collisions))
+
+
+class BlockTransactionsRequest(_BufferDeserializable):
     __slots__ = ("blockhash", "indexes")
 
     def __init__(self, blockhash=0, indexes = None):
         self.blockhash = blockhash
         self.indexes = indexes if indexes is not None else []
 
-    def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
-        indexes_length = deser_compact_size(f)
+    def deserialize_from_buffer(self, buf, offset):
+        self.blockhash, offset = deser_uint256_from_buffer(buf, offset)
+        indexes_length, offset = deser_compact_size_from_buffer(buf, offset)
         for _ in range(indexes_length):
-            self.indexes.append(deser_compact_size(f))
+            index, offset = deser_compact_size_from_buffer(buf, offset)
+            self.indexes.append(index)
+        return offset
 
     def serialize(self):
         r = b""
@@ -1141,16 +2115,17 @@ class BlockTransactionsRequest:
         return "BlockTransactionsRequest(hash=%064x indexes=%s)" % (self.blockhash, repr(self.indexes))
 
 
-class BlockTransactions:
+class BlockTransactions(_BufferDeserializable):
     __slots__ = ("blockhash", "transactions")
 
     def __init__(self, blockhash=0, transactions = None):
         self.blockhash = blockhash
         self.transactions = transactions if transactions is not None else []
 
-    def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
-        self.transactions = deser_vector(f, CTransaction)
+    def deserialize_from_buffer(self, buf, offset):
+        self.blockhash, offset = deser_uint256_from_buffer(buf, offset)
+        self.transactions, offset = deser_vector_from_buffer(buf, offset, CTransaction)
+        return offset
 
     def serialize(self, with_witness=True):
         r = b""
@@ -1165,7 +2140,7 @@ class BlockTransactions:
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
 
 
-class CPartialMerkleTree:
+class CPartialMerkleTree(_BufferDeserializable):
     __slots__ = ("nTransactions", "vBits", "vHash")
 
     def __init__(self):
@@ -1191,11 +2166,60 @@ class CPartialMerkleTree:
         r += ser_string(bytes(vBytesArray))
         return r
 
+    def initialize_from_tree(self, tree, matches):
+        """Build the partial merkle tree for the leaves of the given MerkleTree
+        that are flagged in matches (a list of booleans)."""
+        assert_equal(len(matches), len(tree))
+        self.nTransactions = len(tree)
+        self.vHash = []
+        self.vBits = []
+
+        def traverse_and_build(height, pos):
+            first = pos << height
+            parent_of_match = any(matches[first:min((pos + 1) << height, len(tree))])
+            self.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                self.vHash.append(uint256_from_str(tree.level(height)[pos]))
+            else:
+                traverse_and_build(height - 1, pos * 2)
+                if pos * 2 + 1 < len(tree.level(height - 1)):
+                    traverse_and_build(height - 1, pos * 2 + 1)
+
+        traverse_and_build(tree.height, 0)
+
+    def extract_matches(self):
+        """Return the merkle root and the list of (index, hash) pairs of the
+        matched leaves."""
+        width = lambda height: (self.nTransactions + (1 << height) - 1) >> height
+        height = 0
+        while width(height) > 1:
+            height += 1
+        bits = iter(self.vBits)
+        hashes = iter(self.vHash)
+        matched = []
+
+        def traverse_and_extract(height, pos):
+            parent_of_match = next(bits)
+            if height == 0 or not parent_of_match:
+                h = ser_uint256(next(hashes))
+                if height == 0 and parent_of_match:
+                    matched.append((pos, uint256_from_str(h)))
+                return h
+            left = traverse_and_extract(height - 1, pos * 2)
+            right = left
+            if pos * 2 + 1 < width(height - 1):
+                right = traverse_and_extract(height - 1, pos * 2 + 1)
+                assert left != right, "duplicate hashes in partial merkle tree"
+            return hash256(left + right)
+
+        root = traverse_and_extract(height, 0)
+        return uint256_from_str(root), matched
+
     def __repr__(self):
         return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
 
 
-class CMerkleBlock:
+class CMerkleBlock(_BufferDeserializable):
     __slots__ = ("header", "txn")
 
     def __init__(self):
@@ -1217,7 +2241,7 @@ class CMerkleBlock:
 
 
 # Objects that correspond to messages on the wire
-class msg_version:
+class msg_version(_BufferDeserializable):
     __slots__ = ("addrFrom", "addrTo", "nNonce", "relay", "nServices",
                  "nStartingHeight", "nTime", "nVersion", "strSubVer")
     msgtype = b"version"
@@ -1271,7 +2295,7 @@ class msg_version:
                self.strSubVer, self.nStartingHeight, self.relay)
 
 
-class msg_verack:
+class msg_verack(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"verack"
 
@@ -1288,7 +2312,7 @@ class msg_verack:
         return "msg_verack()"
 
 
-class msg_addr:
+class msg_addr(_BufferDeserializable):
     __slots__ = ("addrs",)
     msgtype = b"addr"
 
@@ -1305,7 +2329,7 @@ class msg_addr:
         return "msg_addr(addrs=%s)" % (repr(self.addrs))
 
 
-class msg_addrv2:
+class msg_addrv2(_BufferDeserializable):
     __slots__ = ("addrs",)
     msgtype = b"addrv2"
 
@@ -1322,7 +2346,7 @@ class msg_addrv2:
         return "msg_addrv2(addrs=%s)" % (repr(self.addrs))
 
 
-class msg_sendaddrv2:
+class msg_sendaddrv2(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"sendaddrv2"
 
@@ -1339,7 +2363,7 @@ class msg_sendaddrv2:
         return "msg_sendaddrv2()"
 
 
-class msg_inv:
+class msg_inv(_BufferDeserializable):
     __slots__ = ("inv",)
     msgtype = b"inv"
 
@@ -1349,8 +2373,9 @@ class msg_inv:
         else:
             self.inv = inv
 
-    def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+    def deserialize_from_buffer(self, buf, offset):
+        self.inv, offset = deser_vector_from_buffer(buf, offset, CInv)
+        return offset
 
     def serialize(self):
         return ser_vector(self.inv)
@@ -1359,15 +2384,16 @@ class msg_inv:
         return "msg_inv(inv=%s)" % (repr(self.inv))
 
 
-class msg_getdata:
+class msg_getdata(_BufferDeserializable):
     __slots__ = ("inv",)
     msgtype = b"getdata"
 
     def __init__(self, inv=None):
         self.inv = inv if inv is not None else []
 
-    def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+    def deserialize_from_buffer(self, buf, offset):
+        self.inv, offset = deser_vector_from_buffer(buf, offset, CInv)
+        return offset
 
     def serialize(self):
         return ser_vector(self.inv)
@@ -1376,7 +2402,7 @@ class msg_getdata:
         return "msg_getdata(inv=%s)" % (repr(self.inv))
 
 
-class msg_getblocks:
+class msg_getblocks(_BufferDeserializable):
     __slots__ = ("locator", "hashstop")
     msgtype = b"getblocks"
 
@@ -1384,10 +2410,11 @@ class msg_getblocks:
         self.locator = CBlockLocator()
         self.hashstop = 0
 
-    def deserialize(self, f):
+    def deserialize_from_buffer(self, buf, offset):
         self.locator = CBlockLocator()
-        self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        offset = self.locator.deserialize_from_buffer(buf, offset)
+        self.hashstop, offset = deser_uint256_from_buffer(buf, offset)
+        return offset
 
     def serialize(self):
         r = b""
@@ -1400,7 +2427,7 @@ class msg_getblocks:
             % (repr(self.locator), self.hashstop)
 
 
-class msg_tx:
+class msg_tx(_BufferDeserializable):
     __slots__ = ("tx",)
     msgtype = b"tx"
 
@@ -1410,8 +2437,8 @@ class msg_tx:
         else:
             self.tx = tx
 
-    def deserialize(self, f):
-        self.tx.deserialize(f)
+    def deserialize_from_buffer(self, buf, offset):
+        return self.tx.deserialize_from_buffer(buf, offset)
 
     def serialize(self):
         return self.tx.serialize_with_witness()
@@ -1419,7 +2446,7 @@ class msg_tx:
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
-class msg_wtxidrelay:
+class msg_wtxidrelay(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"wtxidrelay"
 
@@ -1443,7 +2470,7 @@ class msg_no_witness_tx(msg_tx):
         return self.tx.serialize_without_witness()
 
 
-class msg_block:
+class msg_block(_BufferDeserializable):
     __slots__ = ("block",)
     msgtype = b"block"
 
@@ -1453,8 +2480,8 @@ class msg_block:
         else:
             self.block = block
 
-    def deserialize(self, f):
-        self.block.deserialize(f)
+    def deserialize_from_buffer(self, buf, offset):
+        return self.block.deserialize_from_buffer(buf, offset)
 
     def serialize(self):
         return self.block.serialize()
@@ -1485,7 +2512,7 @@ class msg_no_witness_block(msg_block):
         return self.block.serialize(with_witness=False)
 
 
-class msg_getaddr:
+class msg_getaddr(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"getaddr"
 
@@ -1502,15 +2529,16 @@ class msg_getaddr:
         return "msg_getaddr()"
 
 
-class msg_ping:
+class msg_ping(_BufferDeserializable):
     __slots__ = ("nonce",)
     msgtype = b"ping"
 
     def __init__(self, nonce=0):
         self.nonce = nonce
 
-    def deserialize(self, f):
-        self.nonce = int.from_bytes(f.read(8), "little")
+    def deserialize_from_buffer(self, buf, offset):
+        self.nonce = _UINT64.unpack_from(buf, offset)[0]
+        return offset + 8
 
     def serialize(self):
         r = b""
@@ -1521,15 +2549,16 @@ class msg_ping:
         return "msg_ping(nonce=%08x)" % self.nonce
 
 
-class msg_pong:
+class msg_pong(_BufferDeserializable):
     __slots__ = ("nonce",)
     msgtype = b"pong"
 
     def __init__(self, nonce=0):
         self.nonce = nonce
 
-    def deserialize(self, f):
-        self.nonce = int.from_bytes(f.read(8), "little")
+    def deserialize_from_buffer(self, buf, offset):
+        self.nonce = _UINT64.unpack_from(buf, offset)[0]
+        return offset + 8
 
     def serialize(self):
         r = b""
@@ -1540,7 +2569,7 @@ class msg_pong:
         return "msg_pong(nonce=%08x)" % self.nonce
 
 
-class msg_mempool:
+class msg_mempool(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"mempool"
 
@@ -1557,15 +2586,16 @@ class msg_mempool:
         return "msg_mempool()"
 
 
-class msg_notfound:
+class msg_notfound(_BufferDeserializable):
     __slots__ = ("vec", )
     msgtype = b"notfound"
 
     def __init__(self, vec=None):
         self.vec = vec or []
 
-    def deserialize(self, f):
-        self.vec = deser_vector(f, CInv)
+    def deserialize_from_buffer(self, buf, offset):
+        self.vec, offset = deser_vector_from_buffer(buf, offset, CInv)
+        return offset
 
     def serialize(self):
         return ser_vector(self.vec)
@@ -1574,7 +2604,7 @@ class msg_notfound:
         return "msg_notfound(vec=%s)" % (repr(self.vec))
 
 
-class msg_sendheaders:
+class msg_sendheaders(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"sendheaders"
 
@@ -1595,7 +2625,7 @@ class msg_sendheaders:
 # number of entries
 # vector of hashes
 # hash_stop (hash of last desired block header, 0 to get as many as possible)
-class msg_getheaders:
+class msg_getheaders(_BufferDeserializable):
     __slots__ = ("hashstop", "locator",)
     msgtype = b"getheaders"
 
@@ -1603,10 +2633,11 @@ class msg_getheaders:
         self.locator = CBlockLocator()
         self.hashstop = 0
 
-    def deserialize(self, f):
+    def deserialize_from_buffer(self, buf, offset):
         self.locator = CBlockLocator()
-        self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        offset = self.locator.deserialize_from_buffer(buf, offset)
+        self.hashstop, offset = deser_uint256_from_buffer(buf, offset)
+        return offset
 
     def serialize(self):
         r = b""
@@ -1621,28 +2652,50 @@ class msg_getheaders:
 
 # headers message has
 # <count> <vector of block headers>
-class msg_headers:
+class msg_headers(_BufferDeserializable):
     __slots__ = ("headers",)
     msgtype = b"headers"
 
     def __init__(self, headers=None):
         self.headers = headers if headers is not None else []
 
-    def deserialize(self, f):
-        # comment in bitcoind indicates these should be deserialized as blocks
-        blocks = deser_vector(f, CBlock)
-        for x in blocks:
-            self.headers.append(CBlockHeader(x))
+    def deserialize_from_buffer(self, buf, offset):
+        # comment in bitcoind indicates these should be deserialized as blocks,
+        # i.e. each header is followed by a (zero) transaction count
+        nit, offset = deser_compact_size_from_buffer(buf, offset)
+        for _ in range(nit):
+            header = CBlockHeader()
+            offset = header.deserialize_from_buffer(buf, offset)
+            _, offset = deser_vector_from_buffer(buf, offset, CTransaction)
+            self.headers.append(header)
+        return offset
 
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        return ser_compact_size(len(self.headers)) + b"".join([
+            CBlockHeader.serialize(x) + b"\x00" for x in self.headers])
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
 
 
-class msg_merkleblock:
+class msg_preserialized_headers(msg_headers):
+    """A msg_headers whose headers have been serialized in advance, each
+    followed by the (zero) transaction count"""
+    __slots__ = ("serialized_headers",)
+
+    def __init__(self, headers, serialized_headers):
+        super().__init__(headers)
+        self.serialized_headers = serialized_headers
+
+    def serialize(self):
+        return ser_compact_size(len(self.serialized_headers)) + b"".join(self.serialized_headers)
+
+    def __repr__(self):
+        # (the headers may be whole blocks, which are expensive to repr)
+        return "msg_preserialized_headers(%d headers)" % len(self.serialized_headers)
+
+
+class msg_merkleblock(_BufferDeserializable):
     __slots__ = ("merkleblock",)
     msgtype = b"merkleblock"
 
@@ -1662,7 +2715,7 @@ class msg_merkleblock:
         return "msg_merkleblock(merkleblock=%s)" % (repr(self.merkleblock))
 
 
-class msg_filterload:
+class msg_filterload(_BufferDeserializable):
     __slots__ = ("data", "nHashFuncs", "nTweak", "nFlags")
     msgtype = b"filterload"
 
@@ -1691,7 +2744,7 @@ class msg_filterload:
             self.data, self.nHashFuncs, self.nTweak, self.nFlags)
 
 
-class msg_filteradd:
+class msg_filteradd(_BufferDeserializable):
     __slots__ = ("data")
     msgtype = b"filteradd"
 
@@ -1710,7 +2763,7 @@ class msg_filteradd:
         return "msg_filteradd(data={})".format(self.data)
 
 
-class msg_filterclear:
+class msg_filterclear(_BufferDeserializable):
     __slots__ = ()
     msgtype = b"filterclear"
 
@@ -1727,15 +2780,16 @@ class msg_filterclear:
         return "msg_filterclear()"
 
 
-class msg_feefilter:
+class msg_feefilter(_BufferDeserializable):
     __slots__ = ("feerate",)
     msgtype = b"feefilter"
 
     def __init__(self, feerate=0):
         self.feerate = feerate
 
-    def deserialize(self, f):
-        self.feerate = int.from_bytes(f.read(8), "little")
+    def deserialize_from_buffer(self, buf, offset):
+        self.feerate = _UINT64.unpack_from(buf, offset)[0]
+        return offset + 8
 
     def serialize(self):
         r = b""
@@ -1746,7 +2800,7 @@ class msg_feefilter:
         return "msg_feefilter(feerate=%08x)" % self.feerate
 
 
-class msg_sendcmpct:
+class msg_sendcmpct(_BufferDeserializable):
     __slots__ = ("announce", "version")
     msgtype = b"sendcmpct"
 
@@ -1768,16 +2822,16 @@ class msg_sendcmpct:
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
 
 
-class msg_cmpctblock:
+class msg_cmpctblock(_BufferDeserializable):
     __slots__ = ("header_and_shortids",)
     msgtype = b"cmpctblock"
 
     def __init__(self, header_and_shortids = None):
         self.header_and_shortids = header_and_shortids
 
-    def deserialize(self, f):
+    def deserialize_from_buffer(self, buf, offset):
         self.header_and_shortids = P2PHeaderAndShortIDs()
-        self.header_and_shortids.deserialize(f)
+        return self.header_and_shortids.deserialize_from_buffer(buf, offset)
 
     def serialize(self):
         r = b""
@@ -1788,16 +2842,16 @@ class msg_cmpctblock:
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
 
 
-class msg_getblocktxn:
+class msg_getblocktxn(_BufferDeserializable):
     __slots__ = ("block_txn_request",)
     msgtype = b"getblocktxn"
 
     def __init__(self):
         self.block_txn_request = None
 
-    def deserialize(self, f):
+    def deserialize_from_buffer(self, buf, offset):
         self.block_txn_request = BlockTransactionsRequest()
-        self.block_txn_request.deserialize(f)
+        return self.block_txn_request.deserialize_from_buffer(buf, offset)
 
     def serialize(self):
         r = b""
@@ -1808,15 +2862,15 @@ class msg_getblocktxn:
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
 
 
-class msg_blocktxn:
+class msg_blocktxn(_BufferDeserializable):
     __slots__ = ("block_transactions",)
     msgtype = b"blocktxn"
 
     def __init__(self):
         self.block_transactions = BlockTransactions()
 
-    def deserialize(self, f):
-        self.block_transactions.deserialize(f)
+    def deserialize_from_buffer(self, buf, offset):
+        return self.block_transactions.deserialize_from_buffer(buf, offset)
 
     def serialize(self):
         r = b""
@@ -1834,7 +2888,7 @@ class msg_no_witness_blocktxn(msg_blocktxn):
         return self.block_transactions.serialize(with_witness=False)
 
 
-class msg_getcfilters:
+class msg_getcfilters(_BufferDeserializable):
     __slots__ = ("filter_type", "start_height", "stop_hash")
     msgtype =  b"getcfilters"
 
@@ -1859,7 +2913,7 @@ class msg_getcfilters:
         return "msg_getcfilters(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
             self.filter_type, self.start_height, self.stop_hash)
 
-class msg_cfilter:
+class msg_cfilter(_BufferDeserializable):
     __slots__ = ("filter_type", "block_hash", "filter_data")
     msgtype =  b"cfilter"
 
@@ -1884,7 +2938,7 @@ class msg_cfilter:
         return "msg_cfilter(filter_type={:#x}, block_hash={:x})".format(
             self.filter_type, self.block_hash)
 
-class msg_getcfheaders:
+class msg_getcfheaders(_BufferDeserializable):
     __slots__ = ("filter_type", "start_height", "stop_hash")
     msgtype =  b"getcfheaders"
 
@@ -1909,7 +2963,7 @@ class msg_getcfheaders:
         return "msg_getcfheaders(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
             self.filter_type, self.start_height, self.stop_hash)
 
-class msg_cfheaders:
+class msg_cfheaders(_BufferDeserializable):
     __slots__ = ("filter_type", "stop_hash", "prev_header", "hashes")
     msgtype =  b"cfheaders"
 
@@ -1937,7 +2991,7 @@ class msg_cfheaders:
         return "msg_cfheaders(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
-class msg_getcfcheckpt:
+class msg_getcfcheckpt(_BufferDeserializable):
     __slots__ = ("filter_type", "stop_hash")
     msgtype =  b"getcfcheckpt"
 
@@ -1959,7 +3013,7 @@ class msg_getcfcheckpt:
         return "msg_getcfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
-class msg_cfcheckpt:
+class msg_cfcheckpt(_BufferDeserializable):
     __slots__ = ("filter_type", "stop_hash", "headers")
     msgtype =  b"cfcheckpt"
 
@@ -1984,7 +3038,7 @@ class msg_cfcheckpt:
         return "msg_cfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
-class msg_sendtxrcncl:
+class msg_sendtxrcncl(_BufferDeserializable):
     __slots__ = ("version", "salt")
     msgtype = b"sendtxrcncl"
 
@@ -2006,7 +3060,7 @@ class msg_sendtxrcncl:
         return "msg_sendtxrcncl(version=%lu, salt=%lu)" %\
             (self.version, self.salt)
 
-class msg_feature:
+class msg_feature(_BufferDeserializable):
     """FEATURE message for negotiating optional features."""
     __slots__ = ("feature_id", "feature_data")
     msgtype = b"feature"
@@ -2060,3 +3114,360 @@ class TestFrameworkScript(unittest.TestCase):
         check_varint(0x80123456, "86ffc7e756")
         check_varint(0xffffffff, "8efefefe7f")
         check_varint(0xffffffffffffffff, "80fefefefefefefefe7f")
+
+    def test_tx_hash_cache_invalidation(self):
+        def check_hashes(tx):
+            self.assertEqual(tx.txid, hash256(tx.serialize_without_witness()))
+            self.assertEqual(tx.wtxid, hash256(tx.serialize_with_witness()))
+
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(1, 0), b"\x51", 0))
+        tx.vout.append(CTxOut(1000, b"\x51"))
+        check_hashes(tx)
+
+        # Each kind of modification must invalidate the cached hashes.
+        tx.vin[0].prevout.n = 1
+        check_hashes(tx)
+        tx.vin[0].scriptSig = b"\x52"
+        check_hashes(tx)
+        tx.vout[0].nValue -= 1
+        check_hashes(tx)
+        tx.vout.append(CTxOut(0, b""))
+        check_hashes(tx)
+        tx.vout[1] = CTxOut(2, b"\x6a")
+        check_hashes(tx)
+        del tx.vout[1]
+        check_hashes(tx)
+        tx.vin = [CTxIn(COutPoint(2, 0))]
+        check_hashes(tx)
+        tx.nLockTime = 42
+        check_hashes(tx)
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01"]
+        check_hashes(tx)
+        tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x02")
+        check_hashes(tx)
+        tx.wit.vtxinwit[0].scriptWitness.stack[0] = b"\x03"
+        check_hashes(tx)
+
+        # Copies start with an empty cache, and modifying them leaves the
+        # original's hashes intact.
+        tx_copy = CTransaction(tx)
+        tx_copy.vout[0].nValue += 1
+        check_hashes(tx_copy)
+        self.assertNotEqual(tx_copy.txid, tx.txid)
+        check_hashes(tx)
+
+    def test_deserialize_from_buffer(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(1, 2), b"\x51" * 300, 3)]
+        tx.vout = [CTxOut(4, b"\x52"), CTxOut(5, b"")]
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"", b"\x01" * 70000]
+        block = CBlock()
+        block.vtx = [tx, CTransaction(tx)]
+        block.vtx[1].wit = CTxWitness()
+
+        for msg in [msg_tx(tx), msg_block(block), msg_inv([CInv(MSG_TX, 6), CInv(MSG_BLOCK, 7)]),
+                    msg_headers([CBlockHeader(block)]), msg_ping(8), msg_version()]:
+            ser = msg.serialize()
+            # Decode at an offset, followed by unrelated data.
+            decoded, offset = type(msg).from_buffer(b"\xff" * 3 + ser + b"\xff", 3)
+            self.assertEqual(offset, 3 + len(ser))
+            self.assertEqual(decoded.serialize(), ser)
+            # The stream interface leaves the stream right after the object.
+            f = BytesIO(ser + b"\xff")
+            decoded = type(msg)()
+            decoded.deserialize(f)
+            self.assertEqual(decoded.serialize(), ser)
+            self.assertEqual(f.read(), b"\xff")
+            # Other streams are only accepted by a stream based deserialize(f)
+            if type(msg).deserialize is _BufferDeserializable.deserialize:
+                with self.assertRaises(TypeError):
+                    type(msg)().deserialize(BufferedReader(BytesIO(ser)))
+            else:
+                type(msg)().deserialize(BufferedReader(BytesIO(ser)))
+
+        self.assertEqual(deser_compact_size_from_buffer(ser_compact_size(0x12345678) + b"\xff", 0), (0x12345678, 5))
+        with self.assertRaises(ValueError):
+            deser_string_from_buffer(ser_compact_size(10) + b"\x00" * 9, 0)
+
+    def test_lazy_block(self):
+        block = CBlock()
+        for i in range(4):
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(i, 0), b"\x51" * i)]
+            tx.vout = [CTxOut(i, b"\x52" * 300)]
+            if i % 2:
+                tx.wit.vtxinwit = [CTxInWitness()]
+                tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01" * i, b""]
+            block.vtx.append(tx)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        ser = block.serialize()
+
+        lazy, offset = CLazyBlock.from_buffer(ser)
+        self.assertEqual(offset, len(ser))
+        self.assertEqual(lazy.hash_int, block.hash_int)
+        self.assertEqual(len(lazy.vtx), 4)
+        self.assertEqual(lazy.vtx.decoded_count(), 0)
+        # Serialization, hashing and weight work without decoding.
+        self.assertEqual(lazy.serialize(), ser)
+        self.assertEqual(lazy.serialize(with_witness=False), block.serialize(with_witness=False))
+        self.assertEqual(lazy.calc_merkle_root(), block.hashMerkleRoot)
+        self.assertEqual(lazy.calc_witness_merkle_root(), block.calc_witness_merkle_root())
+        self.assertEqual(lazy.get_weight(), block.get_weight())
+        self.assertEqual(lazy.vtx.decoded_count(), 0)
+
+        # Accessed transactions are decoded once and can be modified.
+        self.assertEqual(lazy.vtx[3].wtxid, block.vtx[3].wtxid)
+        self.assertIs(lazy.vtx[3], lazy.vtx[3])
+        self.assertEqual(lazy.vtx.decoded_count(), 1)
+        lazy.vtx[3].nLockTime = 1
+        block.vtx[3].nLockTime = 1
+        lazy.vtx.append(CTransaction(block.vtx[0]))
+        block.vtx.append(CTransaction(block.vtx[0]))
+        self.assertEqual(lazy.serialize(), block.serialize())
+        self.assertEqual(lazy.calc_merkle_root(), block.calc_merkle_root())
+        self.assertEqual(lazy.vtx.decoded_count(), 2)
+
+    def test_merkle_tree(self):
+        def naive_root(leaves):
+            while len(leaves) > 1:
+                leaves = [hash256(leaves[i] + leaves[min(i + 1, len(leaves) - 1)]) for i in range(0, len(leaves), 2)]
+            return leaves[0]
+
+        rng = random.Random(1)
+        leaves = [rng.randbytes(32)]
+        tree = MerkleTree(leaves)
+        for _ in range(300):
+            op = rng.randrange(3)
+            if op == 0 or len(leaves) == 1:
+                leaf = rng.randbytes(32)
+                leaves.append(leaf)
+                tree.append(leaf)
+            elif op == 1:
+                i = rng.randrange(len(leaves))
+                leaves[i] = rng.randbytes(32)
+                tree.replace(i, leaves[i])
+            else:
+                self.assertEqual(tree.pop(), leaves.pop())
+            self.assertEqual(tree.root, naive_root(leaves))
+            self.assertEqual(MerkleTree(leaves).root, tree.root)
+            i = rng.randrange(len(leaves))
+            self.assertEqual(MerkleTree.root_from_branch(leaves[i], tree.branch(i), i), tree.root)
+
+        new_leaves = leaves[:10] + [rng.randbytes(32)] + leaves[11:40]
+        tree.update_leaves(new_leaves)
+        self.assertEqual(tree.root, naive_root(new_leaves))
+
+        for n in [1, 2, 7, 8, 9, 33]:
+            tree = MerkleTree([rng.randbytes(32) for _ in range(n)])
+            matches = [rng.random() < 0.3 for _ in range(n)]
+            pmt = CPartialMerkleTree()
+            pmt.initialize_from_tree(tree, matches)
+            decoded = CPartialMerkleTree()
+            decoded.deserialize(BytesIO(pmt.serialize()))
+            root, matched = decoded.extract_matches()
+            self.assertEqual(root, uint256_from_str(tree.root))
+            self.assertEqual(matched, [(i, uint256_from_str(tree[i])) for i in range(n) if matches[i]])
+
+    def test_fixed_size_vectors(self):
+        class CInvSubclass(CInv):
+            __slots__ = ()
+
+        invs = [CInv(MSG_TX, 1 << 255), CInv(MSG_BLOCK, 2)]
+        ser = ser_vector(invs)
+        # The fast path must match element-wise serialization, which is also
+        # used for vectors containing subclasses.
+        self.assertEqual(ser, ser_compact_size(2) + b"".join(i.serialize() for i in invs))
+        self.assertEqual(ser_vector([CInvSubclass(i.type, i.hash) for i in invs]), ser)
+        for decoded in [deser_vector(BytesIO(ser), CInv), deser_vector_from_buffer(ser, 0, CInv)[0]]:
+            self.assertEqual(decoded, invs)
+
+        outpoints = [COutPoint(3, 4), COutPoint(1 << 200, 0xffffffff)]
+        ser = ser_vector(outpoints)
+        self.assertEqual(ser, ser_compact_size(2) + b"".join(o.serialize() for o in outpoints))
+        self.assertEqual([repr(o) for o in deser_vector(BytesIO(ser), COutPoint)], [repr(o) for o in outpoints])
+
+        hashes = [0, 1 << 255, 12345]
+        self.assertEqual(deser_uint256_vector(BytesIO(ser_uint256_vector(hashes))), hashes)
+        with self.assertRaises(ValueError):
+            deser_vector(BytesIO(ser[:-1]), COutPoint)
+
+    def test_serialized_size(self):
+        def check_tx(tx):
+            self.assertEqual(tx.get_serialized_size(), len(tx.serialize_with_witness()))
+            self.assertEqual(tx.get_serialized_size(with_witness=False), len(tx.serialize_without_witness()))
+            self.assertEqual(tx.get_weight(), 3 * len(tx.serialize_without_witness()) + len(tx.serialize_with_witness()))
+
+        tx = CTransaction()
+        check_tx(tx)
+        tx.vin = [CTxIn(COutPoint(1, 2), b"\x51" * 300) for _ in range(3)]
+        tx.vout = [CTxOut(1, b"\x6a" * n) for n in [0, 252, 253, 70000]]
+        check_tx(tx)
+        # cached sizes follow modifications
+        tx.vout[0].scriptPubKey = b"\x00" * 22
+        check_tx(tx)
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"", b"\x01" * 80]
+        check_tx(tx)
+        # fewer witnesses than inputs are padded with empty witnesses, extra ones are dropped
+        tx.wit.vtxinwit += [CTxInWitness() for _ in range(4)]
+        tx.wit.vtxinwit[3].scriptWitness.stack.append(b"\x02")
+        check_tx(tx)
+        self.assertEqual(tx.get_vsize(), (tx.get_weight() + 3) // 4)
+
+        block = CBlock()
+        block.vtx = [tx, CTransaction()]
+        weight = 3 * len(block.serialize(with_witness=False)) + len(block.serialize())
+        self.assertEqual(block.get_weight(), weight)
+        lazy = CLazyBlock.from_buffer(block.serialize())[0]
+        self.assertEqual(lazy.get_weight(), weight)
+        for with_witness in [True, False]:
+            self.assertEqual(block.get_serialized_size(with_witness), len(block.serialize(with_witness)))
+            self.assertEqual(lazy.get_serialized_size(with_witness), len(block.serialize(with_witness)))
+        self.assertEqual(lazy.vtx.decoded_count(), 0)
+
+        block.auxpow = CAuxPow()
+        block.mark_auxpow()
+        block.auxpow.vin = [CTxIn()]
+        block.auxpow.vMerkleBranch = [1, 2]
+        block.auxpow.vChainMerkleBranch = [3]
+        self.assertEqual(CBlockHeader(block).get_serialized_size(), len(CBlockHeader(block).serialize()))
+        self.assertEqual(block.get_serialized_size(), len(block.serialize()))
+        self.assertEqual(block.get_weight(), 3 * len(block.serialize(with_witness=False)) + len(block.serialize()))
+
+    def test_transaction_copy(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(1, 2), b"\x51", 3)]
+        tx.vout = [CTxOut(4, b"\x51"), CTxOut(5, b"")]
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01", bytearray(b"\x02")]
+        ser = tx.serialize()
+        for deep in [False, True]:
+            tx_copy = CTransaction(tx, deep=deep)
+            self.assertEqual(tx_copy.serialize(), ser)
+            self.assertEqual(tx_copy.wtxid_hex, tx.wtxid_hex)
+            # stack items are shared by the shallow copy, even mutable ones
+            self.assertEqual(tx_copy.wit.vtxinwit[0].scriptWitness.stack[1] is tx.wit.vtxinwit[0].scriptWitness.stack[1], not deep)
+            tx_copy.vin[0].prevout.n = 7
+            tx_copy.vin[0].scriptSig = b""
+            tx_copy.vout[0].nValue = 8
+            tx_copy.vout.pop()
+            tx_copy.wit.vtxinwit[0].scriptWitness.stack.append(b"\x03")
+            self.assertEqual(tx.serialize(), ser)
+
+    def test_compact_block_reconstruction(self):
+        block = CBlock()
+        block.vtx = [CTransaction() for _ in range(20)]
+        for i, tx in enumerate(block.vtx):
+            tx.vin = [CTxIn(COutPoint(i, 0))]
+            tx.wit.vtxinwit = [CTxInWitness()]
+            tx.wit.vtxinwit[0].scriptWitness.stack = [bytes([i])]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        cmpct = HeaderAndShortIDs()
+        cmpct.initialize_from_block(block, nonce=1, prefill_list=[0, 5], use_witness=True)
+        k0, k1 = cmpct.get_siphash_keys()
+        self.assertEqual(cmpct.shortids, [calculate_shortid(k0, k1, tx.wtxid_int) for i, tx in enumerate(block.vtx) if i not in (0, 5)])
+
+        # duplicates in the mempool are not collisions
+        mempool = block.vtx[2:10] + block.vtx[8:] + [CTransaction(block.vtx[12])]
+        partial = PartiallyDownloadedBlock(cmpct.to_p2p(), mempool)
+        self.assertEqual(partial.missing_indexes(), [1])
+        self.assertEqual(partial.collisions, [])
+        with self.assertRaises(ValueError):
+            partial.fill_block([])
+        with self.assertRaises(ValueError):
+            partial.fill_block([block.vtx[1], block.vtx[2]])
+        with self.assertRaises(ValueError):
+            partial.fill_block([block.vtx[2]])
+        self.assertEqual(partial.fill_block([block.vtx[1]]).serialize(), block.serialize())
+
+        # short IDs follow the use_witness of the compact block
+        cmpct.initialize_from_block(block, nonce=1, prefill_list=[0, 5], use_witness=False)
+        self.assertEqual(PartiallyDownloadedBlock(cmpct.to_p2p(), mempool).missing_indexes(), [1])
+        self.assertEqual(PartiallyDownloadedBlock(cmpct, mempool, use_witness=True).missing_indexes(), [i for i in range(20) if i not in (0, 5)])
+
+        # transactions with the same short ID are left for getblocktxn
+        def init_data(missing):
+            cmpct = HeaderAndShortIDs()
+            cmpct.initialize_from_block(block, prefill_list=[i for i in range(20) if i not in missing], use_witness=True)
+            return PartiallyDownloadedBlock(cmpct, block.vtx)
+        with unittest.mock.patch(f"{__name__}.calculate_shortids", lambda k0, k1, tx_hashes: [h & 1 for h in siphash256_many(k0, k1, tx_hashes)]):
+            # with these 1-bit short IDs, transactions 8 and 9 differ and 3 and 4 don't
+            partial = init_data([8, 9])
+            self.assertEqual(sorted(partial.collisions), [8, 9])
+            self.assertEqual(partial.missing_indexes(), [8, 9])
+            with self.assertRaises(ValueError):
+                init_data([3, 4])
+
+    def test_auxpow_validation(self):
+        from test_framework.auxpow_testing import computeAuxpow
+
+        block = CBlock()
+        block.nBits = 0x207fffff
+        block.vtx = [CTransaction()]
+        block.vtx[0].vin = [CTxIn(COutPoint(0, 0xffffffff), b"\x51")]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.mark_auxpow()
+        target = uint256_from_compact(block.nBits)
+
+        # an auxpow built by the RPC test helpers is valid
+        block.auxpow = CAuxPow.from_buffer(bytes.fromhex(computeAuxpow(block.hash_hex, b"%064x" % target, True)))[0]
+        self.assertTrue(block.is_valid())
+        block.auxpow = CAuxPow.from_buffer(bytes.fromhex(computeAuxpow(block.hash_hex, b"%064x" % target, False)))[0]
+        self.assertFalse(block.is_valid())
+        # with a different proof-of-work hash function
+        self.assertTrue(block.is_valid(pow_hash=lambda header: bytes(32)))
+
+        def solve_parent(auxpow):
+            while auxpow.parentBlock.hash_int > target:
+                auxpow.parentBlock.nNonce += 1
+
+        def build_auxpow(script_prefix=MERGED_MINING_HEADER, nonce=7, height=2, index=None, extra=b""):
+            if index is None:
+                index = CAuxPow.get_expected_index(nonce, CHAIN_ID, height)
+            leaves = [bytes([i]) * 32 for i in range(1 << height)]
+            leaves[index] = ser_uint256(block.hash_int)
+            chain_tree = MerkleTree(leaves)
+            auxpow = CAuxPow()
+            auxpow.vin = [CTxIn(COutPoint(0, 0xffffffff), script_prefix + chain_tree.root[::-1] + struct.pack("<II", 1 << height, nonce) + extra)]
+            auxpow.set_chain_merkle_branch(chain_tree, index)
+            tree = MerkleTree([auxpow.txid, bytes(32), bytes(32)])
+            auxpow.set_merkle_branch(tree, 0)
+            auxpow.parentBlock.nVersion = 1
+            auxpow.parentBlock.hashMerkleRoot = uint256_from_str(tree.root)
+            solve_parent(auxpow)
+            return auxpow
+
+        def check(auxpow):
+            block.auxpow = auxpow
+            return check_proof_of_work_many([block])[0]
+
+        self.assertIsNone(check(build_auxpow()))
+        self.assertIsNone(check(build_auxpow(script_prefix=b"\x03123456")))
+        self.assertIsNone(check(build_auxpow(script_prefix=bytes(20))))
+        self.assertEqual(check(build_auxpow(script_prefix=bytes(21))), "Aux POW chain merkle root must start in the first 20 bytes of the parent coinbase")
+        self.assertEqual(check(build_auxpow(script_prefix=MERGED_MINING_HEADER + b"\x00")), "Merged mining header is not just before chain merkle root")
+        self.assertEqual(check(build_auxpow(extra=MERGED_MINING_HEADER)), "Multiple merged mining headers in coinbase")
+        index = CAuxPow.get_expected_index(7, CHAIN_ID, 2)
+        self.assertEqual(check(build_auxpow(index=index ^ 1)), "Aux POW wrong index")
+        auxpow = build_auxpow()
+        auxpow.vin[0].scriptSig = auxpow.vin[0].scriptSig[:-1]
+        self.assertEqual(check(auxpow), "Aux POW merkle root incorrect")
+        auxpow = build_auxpow()
+        auxpow.nIndex = 1
+        self.assertIsNone(check(auxpow))
+        auxpow.parentBlock.nVersion = block.nVersion & ~VERSION_AUXPOW
+        solve_parent(auxpow)
+        self.assertEqual(check(auxpow), "Aux POW parent has our chain ID")
+        self.assertEqual(check_proof_of_work_many([block, CBlockHeader(block)], pow_hash=lambda header: bytes(32)),
+                         ["Aux POW parent has our chain ID"] * 2)
+        block.auxpow = None
+        self.assertEqual(check(None), "no auxpow on block with auxpow version")
+
+    def test_slots(self):
+        # Messages and the records they are made of have no per-instance __dict__
+        for cls in list(globals().values()):
+            if isinstance(cls, type) and cls.__module__ == __name__ and not issubclass(cls, unittest.TestCase):
+                self.assertEqual(cls.__dictoffset__, 0, cls.__name__)
@@ -21,17 +21,35 @@ P2PTxInvStore: A p2p interface class that inherits from P2PDataStore, and keeps
               a count of how many times each txid has been announced."""
 
 import asyncio
-from collections import defaultdict
+import contextlib
+from collections import (
+    OrderedDict,
+    defaultdict,
+)
 import ipaddress
 from io import BytesIO
+import json
 import logging
+import os
 import platform
+import random
 import socket
 import struct
 import sys
+import tempfile
 import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Optional,
+)
+import unittest
+import unittest.mock
 
 from test_framework.messages import (
+    CInv,
+    CBlock,
     CBlockHeader,
     MAX_HEADERS_RESULTS,
     msg_addr,
@@ -63,6 +81,7 @@ from test_framework.messages import (
     msg_notfound,
     msg_ping,
     msg_pong,
+    msg_preserialized_headers,
     msg_sendaddrv2,
     msg_sendcmpct,
     msg_sendheaders,
@@ -79,6 +98,7 @@ from test_framework.messages import (
     MAGIC_BYTES,
     sha256,
 )
+from test_framework.message_capture import SessionRecorder
 from test_framework.netutil import (
     set_ephemeral_port_range,
 )
@@ -117,7 +137,7 @@ OVERLOADED_PEER_TX_DELAY = 2
 # How long to wait before downloading a transaction from an additional peer
 GETDATA_TX_INTERVAL = 60
 
-MESSAGEMAP = {
+MESSAGEMAP: dict[bytes, Any] = {
     b"addr": msg_addr,
     b"addrv2": msg_addrv2,
     b"block": msg_block,
@@ -156,6 +176,165 @@ MESSAGEMAP = {
     b"wtxidrelay": msg_wtxidrelay,
 }
 
+# Length and checksum fields of the v1 P2P message header
+V1_LENGTH_CHECKSUM = struct.Struct("<i4s")
+
+# Payload decoders keyed by the raw msgtype of the message header, so that
+# received messages are dispatched with a single lookup
+MESSAGE_DECODERS: dict[bytes, Callable[..., tuple[Any, int]]] = {msgtype: cls.from_buffer for msgtype, cls in MESSAGEMAP.items()}
+
+
+def build_v1_message(magic_bytes, msgtype, data):
+    """Build a v1 P2P message: header (with the payload checksum) and payload"""
+    return b"".join([
+        magic_bytes,
+        msgtype.ljust(12, b"\x00"),
+        len(data).to_bytes(4, "little"),
+        sha256(sha256(data))[:4],
+        data,
+    ])
+
+
+def build_v2_contents(msgtype, data):
+    """Build the (unencrypted) contents of a v2 P2P packet: message type and payload"""
+    shortid = MSGTYPE_TO_SHORTID.get(msgtype)
+    if shortid is not None:
+        return shortid.to_bytes(1, 'big') + data
+    return b"\x00" + msgtype.ljust(12, b"\x00") + data
+
+
+class MessageCache:
+    """Serialized messages that are sent to many peers, keyed by message identity.
+
+    A cached message is kept alive (so that its id() can't be reused) and must
+    not be modified while it is cached. For v1 connections, the whole message
+    including the header and checksum is cached per network magic. v2 packets
+    are encrypted with the key stream of each connection, so only their
+    contents are cached and encryption is still done per peer.
+
+    See broadcast_message()."""
+
+    def __init__(self, max_messages=16):
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        # id(message) -> [message, payload, v2 contents, {magic bytes: v1 message}]
+        self._entries = OrderedDict()
+
+    def _get(self, message):
+        # Called with self._lock held
+        entry = self._entries.get(id(message))
+        if entry is None:
+            entry = self._entries[id(message)] = [message, message.serialize(), None, {}]
+            if len(self._entries) > self.max_messages:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(id(message))
+        return entry
+
+    def v1_message(self, message, magic_bytes):
+        with self._lock:
+            entry = self._get(message)
+            tmsg = entry[3].get(magic_bytes)
+            if tmsg is None:
+                tmsg = entry[3][magic_bytes] = build_v1_message(magic_bytes, message.msgtype, entry[1])
+            return tmsg
+
+    def v2_contents(self, message):
+        with self._lock:
+            entry = self._get(message)
+            if entry[2] is None:
+                entry[2] = build_v2_contents(message.msgtype, entry[1])
+            return entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def broadcast_message(p2ps, message, *, is_decoy=False, cache=None):
+    """Send a message to many connections with send_without_ping(), but
+    serialize it (and compute the checksum of v1 messages) only once.
+
+    The message must not be modified while it is being sent. A MessageCache
+    can be passed to reuse the serialization across calls."""
+    if cache is None:
+        cache = MessageCache(max_messages=1)
+    for p2p in p2ps:
+        p2p.send_without_ping(message, is_decoy, cache=cache)
+
+
+class P2PMetrics:
+    """Traffic and timing counters of a P2PConnection, per direction and msgtype.
+
+    For every msgtype this records the number of messages, their size on the
+    wire (including the header or the v2 encryption overhead) and the time (in
+    seconds) spent in the test framework handling them:
+
+    - decode_time: deserializing received messages
+    - handler_time: delivering received messages to on_message() (for a
+      P2PInterface, this includes waiting for p2p_lock and the on_* callback)
+    - send_wait: from the send_without_ping() call until the message was
+      handed to the transport by the network thread
+
+    Messages sent with send_raw_message() (e.g. the v2 handshake) are recorded
+    under the "(raw)" msgtype."""
+    FIELDS = ("count", "bytes", "decode_time", "handler_time", "send_wait")
+
+    def __init__(self, name):
+        self.name = name
+        self.peer = None
+        self._lock = threading.Lock()
+        self._stats = {"send": {}, "receive": {}}
+
+    def record(self, direction, msgtype, size, decode_time=0.0, handler_time=0.0, send_wait=0.0):
+        with self._lock:
+            stats = self._stats[direction].get(msgtype)
+            if stats is None:
+                stats = self._stats[direction][msgtype] = [0, 0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += decode_time
+            stats[3] += handler_time
+            stats[4] += send_wait
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                direction: {
+                    msgtype.decode("ascii"): dict(zip(self.FIELDS, stats))
+                    for msgtype, stats in sorted(per_msgtype.items())
+                } for direction, per_msgtype in self._stats.items()
+            }
+
+
+def merge_p2p_metrics(dicts):
+    """Sum up metrics (as returned by P2PMetrics.to_dict) per direction and msgtype."""
+    total = {"send": {}, "receive": {}}
+    for d in dicts:
+        for direction, per_msgtype in d.items():
+            for msgtype, stats in per_msgtype.items():
+                merged = total[direction].setdefault(msgtype, dict.fromkeys(P2PMetrics.FIELDS, 0))
+                for field in P2PMetrics.FIELDS:
+                    merged[field] += stats[field]
+    return total
+
+
+def enable_p2p_metrics():
+    """Record the P2PMetrics of the P2P connections created from now on.
+    Without this, connections have no metrics and are not timed."""
+    global p2p_metrics
+    if p2p_metrics is None:
+        p2p_metrics = []
+
+
+def dump_p2p_metrics(path):
+    """Write the metrics of all P2P connections made by this process since
+    enable_p2p_metrics() to a JSON file."""
+    peers = [{"name": m.name, "peer": m.peer, **m.to_dict()} for m in p2p_metrics or []]
+    total = merge_p2p_metrics({"send": p["send"], "receive": p["receive"]} for p in peers)
+    with open(path, "w") as f:
+        json.dump({"peers": peers, "total": total}, f, indent=1)
+
 
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
@@ -177,8 +356,19 @@ class P2PConnection(asyncio.Protocol):
         # This lock is acquired before sending messages over the socket. There's an implied lock order and
         # p2p_lock must not be acquired after _send_lock as it could result in deadlocks.
         self._send_lock = threading.Lock()
+        # Messages sent within batch_sends(), as (bytes, msgtype, time queued).
+        # Protected by _batch_lock, which is acquired after _send_lock.
+        self._send_batch = None
+        self._batch_lock = threading.Lock()
         self.v2_state = None  # EncryptedP2PState object needed for v2 p2p connections
         self.reconnect = False  # set if reconnection needs to happen
+        # P2PMetrics of this connection, if enable_p2p_metrics() was called
+        self.metrics = None
+        if p2p_metrics is not None:
+            self.metrics = P2PMetrics(type(self).__name__)
+            p2p_metrics.append(self.metrics)
+        # SessionRecorder, see start_recording()
+        self.recorder = None
 
     @property
     def is_connected(self):
@@ -195,19 +385,19 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self._reset_recvbuf()
         self.magic_bytes = MAGIC_BYTES[net]
         self.p2p_connected_to_node = dstport != 0
+        # The time the connection was set up, see P2PInterface.handshake_time
+        self.time_connect = time.time()
 
     def peer_connect(self, dstaddr, dstport, *, net, timeout_factor, supports_v2_p2p):
         self.peer_connect_helper(dstaddr, dstport, net, timeout_factor)
         if supports_v2_p2p:
             self.v2_state = EncryptedP2PState(initiating=True, net=net)
 
-        loop = NetworkThread.network_event_loop
         logger.debug('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
-        coroutine = loop.create_connection(lambda: self, host=self.dstaddr, port=self.dstport)
-        return lambda: loop.call_soon_threadsafe(loop.create_task, coroutine)
+        return lambda: NetworkThread.create_connections([self])
 
     def peer_accept_connection(self, connect_id, connect_cb=lambda: None, *, net, timeout_factor, supports_v2_p2p, reconnect):
         self.peer_connect_helper('0', 0, net, timeout_factor)
@@ -222,6 +412,27 @@ class P2PConnection(asyncio.Protocol):
         # Connection could have already been closed by other end.
         NetworkThread.network_event_loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
 
+    def start_recording(self, directory, node=None):
+        """Record all messages sent (except with send_raw_message()) and
+        received over this connection into msgs_sent.dat and msgs_recv.dat
+        files in the directory, in the -capturemessages format. See
+        message_capture.replay_capture() for replaying them.
+
+        Messages are timestamped with the system clock, or, if a TestNode is
+        given, with its mocktime while it has one (like the node does)."""
+        assert self.recorder is None
+        clock_us = None
+        if node is not None:
+            def clock_us():
+                if node.mocktime is None:
+                    return time.time_ns() // 1000
+                return node.mocktime * 1_000_000
+        self.recorder = SessionRecorder(directory, clock_us)
+
+    def stop_recording(self):
+        self.recorder.close()
+        self.recorder = None
+
     # Connection and disconnection methods
 
     def connection_made(self, transport):
@@ -234,6 +445,8 @@ class P2PConnection(asyncio.Protocol):
         self.dstaddr = them[0]
         self.dstport = them[1]
         self._transport = transport
+        if self.metrics is not None:
+            self.metrics.peer = f"{them[0]}:{them[1]}"
         # in an inbound connection to the TestNode with P2PConnection as the initiator, [TestNode <---- P2PConnection]
         # send the initial handshake immediately
         if self.supports_v2_p2p and self.v2_state.initiating and not self.v2_state.tried_v2_handshake:
@@ -245,6 +458,8 @@ class P2PConnection(asyncio.Protocol):
         if self.p2p_connected_to_node and not self.supports_v2_p2p:
             self.send_version()
         self.on_open()
+        with p2p_lock:
+            p2p_condition.notify_all()
 
     def connection_lost(self, exc):
         """asyncio callback when a connection is closed."""
@@ -254,8 +469,10 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self._reset_recvbuf()
         self.on_close()
+        with p2p_lock:
+            p2p_condition.notify_all()
 
     # v2 handshake method
     def _on_data_v2_handshake(self):
@@ -272,8 +489,8 @@ class P2PConnection(asyncio.Protocol):
             if not self.v2_state.initiating and not self.v2_state.sent_garbage:
                 # if the responder hasn't sent garbage yet, the responder is still reading ellswift bytes
                 # reads ellswift bytes till the first mismatch from 12 bytes V1_PREFIX
-                length, send_handshake_bytes = self.v2_state.respond_v2_handshake(BytesIO(self.recvbuf))
-                self.recvbuf = self.recvbuf[length:]
+                length, send_handshake_bytes = self.v2_state.respond_v2_handshake(BytesIO(self._unread_recvbuf()))
+                self._recvpos += length
                 if send_handshake_bytes == -1:
                     self.v2_state = None
                     return
@@ -285,8 +502,8 @@ class P2PConnection(asyncio.Protocol):
 
             # `complete_handshake()` reads the remaining ellswift bytes from recvbuf
             # and sends response after deriving shared ECDH secret using received ellswift bytes
-            length, response = self.v2_state.complete_handshake(BytesIO(self.recvbuf))
-            self.recvbuf = self.recvbuf[length:]
+            length, response = self.v2_state.complete_handshake(BytesIO(self._unread_recvbuf()))
+            self._recvpos += length
             if response:
                 self.send_raw_message(response)
             else:
@@ -296,20 +513,37 @@ class P2PConnection(asyncio.Protocol):
         # is derived in `complete_handshake()`.
         # so `authenticate_handshake()` which uses the BIP324 derived ciphers gets called after `complete_handshake()`.
         assert self.v2_state.peer
-        length, is_mac_auth = self.v2_state.authenticate_handshake(self.recvbuf)
+        length, is_mac_auth = self.v2_state.authenticate_handshake(self._unread_recvbuf())
         if not is_mac_auth:
             raise ValueError("invalid v2 mac tag in handshake authentication")
-        self.recvbuf = self.recvbuf[length:]
+        self._recvpos += length
         if self.v2_state.tried_v2_handshake:
             # for v2 outbound connections, send version message immediately after v2 handshake
             if self.p2p_connected_to_node:
                 self.send_version()
             # process post-v2-handshake data immediately, if available
-            if len(self.recvbuf) > 0:
+            if len(self.recvbuf) > self._recvpos:
                 self._on_data()
 
     # Socket read methods
 
+    # The receive buffer is a bytearray that received data is appended to in
+    # place, with a read position instead of slicing off every processed
+    # message. It is compacted once at least half of it has been processed,
+    # so that receiving is linear in the amount of data.
+
+    def _reset_recvbuf(self):
+        self.recvbuf = bytearray()
+        self._recvpos = 0
+
+    def _unread_recvbuf(self):
+        return bytes(self.recvbuf[self._recvpos:])
+
+    def _compact_recvbuf(self):
+        if self._recvpos and 2 * self._recvpos >= len(self.recvbuf):
+            del self.recvbuf[:self._recvpos]
+            self._recvpos = 0
+
     def data_received(self, t):
         """asyncio callback when data is read from the socket."""
         if len(t) > 0:
@@ -318,6 +552,7 @@ class P2PConnection(asyncio.Protocol):
                 self._on_data_v2_handshake()
             else:
                 self._on_data()
+            self._compact_recvbuf()
 
     def _on_data(self):
         """Try to read P2P messages from the recv buffer.
@@ -326,68 +561,83 @@ class P2PConnection(asyncio.Protocol):
         parses and verifies the P2P header, then passes the P2P payload to
         the on_message callback for processing."""
         try:
-            while True:
-                if self.supports_v2_p2p:
-                    # v2 P2P messages are read
-                    msglen, msg = self.v2_state.v2_receive_packet(self.recvbuf)
-                    if msglen == -1:
-                        raise ValueError("invalid v2 mac tag " + repr(self.recvbuf))
-                    elif msglen == 0:  # need to receive more bytes in recvbuf
-                        return
-                    self.recvbuf = self.recvbuf[msglen:]
-
-                    if msg is None:  # ignore decoy messages
-                        return
-                    assert msg  # application layer messages (which aren't decoy messages) are non-empty
-                    shortid = msg[0]  # 1-byte short message type ID
-                    if shortid == 0:
-                        # next 12 bytes are interpreted as ASCII message type if shortid is b'\x00'
-                        if len(msg) < 13:
-                            raise IndexError("msg needs minimum required length of 13 bytes")
-                        msgtype = msg[1:13].rstrip(b'\x00')
-                        msg = msg[13:]  # msg is set to be payload
-                    else:
-                        # a 1-byte short message type ID
-                        msgtype = SHORTID.get(shortid, f"unknown-{shortid}")
-                        msg = msg[1:]
-                else:
-                    # v1 P2P messages are read
-                    if len(self.recvbuf) < 4:
-                        return
-                    if self.recvbuf[:4] != self.magic_bytes:
-                        raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                        return
-                    msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                    checksum = self.recvbuf[4+12+4:4+12+4+4]
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                    th = sha256(msg)
-                    h = sha256(th)
-                    if checksum != h[:4]:
-                        raise ValueError("got bad checksum " + repr(self.recvbuf))
-                    self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if msgtype not in MESSAGEMAP:
-                    raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[msgtype]()
-                t.deserialize(f)
-                self._log_message("receive", t)
-                self.on_message(t)
+            # Don't hold on to the view (which blocks resizing recvbuf) after returning
+            with memoryview(self.recvbuf) as buf:
+                self._read_messages(buf)
         except Exception as e:
             if not self.reconnect:
                 logger.exception(f"Error reading message: {repr(e)}")
             raise
 
+    def _read_messages(self, buf):
+        while True:
+            pos = self._recvpos
+            if self.supports_v2_p2p:
+                # v2 P2P messages are read
+                msglen, msg = self.v2_state.v2_receive_packet(buf[pos:])
+                if msglen == -1:
+                    raise ValueError("invalid v2 mac tag " + repr(bytes(buf[pos:])))
+                elif msglen == 0:  # need to receive more bytes in recvbuf
+                    return
+                self._recvpos = pos + msglen
+
+                if msg is None:  # ignore decoy messages
+                    return
+                assert msg  # application layer messages (which aren't decoy messages) are non-empty
+                shortid = msg[0]  # 1-byte short message type ID
+                if shortid == 0:
+                    # next 12 bytes are interpreted as ASCII message type if shortid is b'\x00'
+                    if len(msg) < 13:
+                        raise IndexError("msg needs minimum required length of 13 bytes")
+                    msgtype = msg[1:13].rstrip(b'\x00')
+                    msg = msg[13:]  # msg is set to be payload
+                else:
+                    # a 1-byte short message type ID
+                    msgtype = SHORTID.get(shortid, f"unknown-{shortid}")
+                    msg = msg[1:]
+            else:
+                # v1 P2P messages are read
+                if len(buf) - pos < 4:
+                    return
+                if buf[pos:pos+4] != self.magic_bytes:
+                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(bytes(buf[pos:]))))
+                if len(buf) - pos < 4 + 12 + 4 + 4:
+                    return
+                msgtype = bytes(buf[pos+4:pos+4+12]).split(b"\x00", 1)[0]
+                msglen, checksum = V1_LENGTH_CHECKSUM.unpack_from(buf, pos+4+12)
+                if len(buf) - pos < 4 + 12 + 4 + 4 + msglen:
+                    return
+                msg = bytes(buf[pos+4+12+4+4:pos+4+12+4+4+msglen])
+                th = sha256(msg)
+                h = sha256(th)
+                if checksum != h[:4]:
+                    raise ValueError("got bad checksum " + repr(bytes(buf[pos:])))
+                self._recvpos = pos + 4 + 12 + 4 + 4 + msglen
+            decode = MESSAGE_DECODERS.get(msgtype)
+            if decode is None:
+                raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
+            if self.recorder is not None:
+                self.recorder.record("recv", msgtype, bytes(msg))
+            if self.metrics is None:
+                t, _ = decode(msg)
+                self._log_message("receive", t)
+                self.on_message(t)
+                continue
+            time_start = time.perf_counter()
+            t, _ = decode(msg)
+            time_decoded = time.perf_counter()
+            self._log_message("receive", t)
+            self.on_message(t)
+            self.metrics.record("receive", msgtype, self._recvpos - pos, decode_time=time_decoded - time_start,
+                                handler_time=time.perf_counter() - time_decoded)
+
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
         raise NotImplementedError
 
     # Socket write methods
 
-    def send_without_ping(self, message, is_decoy=False):
+    def send_without_ping(self, message, is_decoy=False, *, cache=None):
         """Send a P2P message over the socket.
 
         This method takes a P2P payload, builds the P2P header and adds
@@ -397,52 +647,103 @@ class P2PConnection(asyncio.Protocol):
         preferred to send a message. This can help to reduce intermittent test
         failures due to a missing sync. Also, it includes a call to
         sync_with_ping, allowing for concise test code.
+
+        If a MessageCache is given, the serialized message is taken from it.
         """
+        time_queued = time.perf_counter() if self.metrics is not None else None
         with self._send_lock:
-            tmsg = self.build_message(message, is_decoy)
+            tmsg = self.build_message(message, is_decoy, cache=cache)
+            if self.recorder is not None and not is_decoy:
+                self.recorder.record("sent", message.msgtype, message.serialize())
             self._log_message("send", message)
-            return self.send_raw_message(tmsg)
+            return self.send_raw_message(tmsg, msgtype=message.msgtype, time_queued=time_queued)
+
+    def send_many(self, messages, is_decoy=False, *, cache=None):
+        """Send many P2P messages over the socket at once.
+
+        The messages are built in order (so that v2 packets are encrypted in
+        sequence), joined and written to the socket with a single wakeup of
+        the network thread. See send_without_ping()."""
+        with self.batch_sends():
+            for message in messages:
+                self.send_without_ping(message, is_decoy, cache=cache)
+
+    @contextlib.contextmanager
+    def batch_sends(self):
+        """Context manager that holds back all messages sent over this
+        connection (also by the network thread, e.g. pongs), and writes them
+        at once, in order, when it exits.
+
+        Don't wait for a response to a message within it, as the message is
+        only sent at the end. If the connection was closed in the meantime,
+        the messages are dropped and IOError is raised, like for a message
+        sent outside of a batch."""
+        with self._batch_lock:
+            outermost = self._send_batch is None
+            if outermost:
+                self._send_batch = []
+        dropped = False
+        try:
+            yield
+        finally:
+            if outermost:
+                # Hold the locks, so that later messages are scheduled to be written after the batch
+                with self._send_lock, self._batch_lock:
+                    batch, self._send_batch = self._send_batch, None
+                    if batch:
+                        if self.is_connected:
+                            self._write_soon(batch)
+                        else:
+                            dropped = True
+        if dropped:
+            raise IOError('Not connected')
 
-    def send_raw_message(self, raw_message_bytes):
+    def send_raw_message(self, raw_message_bytes, *, msgtype=b"(raw)", time_queued=None):
         if not self.is_connected:
             raise IOError('Not connected')
+        if time_queued is None and self.metrics is not None:
+            time_queued = time.perf_counter()
+        with self._batch_lock:
+            if self._send_batch is not None:
+                self._send_batch.append((raw_message_bytes, msgtype, time_queued))
+                return
+        self._write_soon([(raw_message_bytes, msgtype, time_queued)])
 
+    def _write_soon(self, raw_messages):
+        """Write (bytes, msgtype, time queued) tuples to the socket from the network thread."""
         def maybe_write():
             if not self._transport:
                 return
             if self._transport.is_closing():
                 return
-            self._transport.write(raw_message_bytes)
+            self._transport.writelines([raw_message for raw_message, _, _ in raw_messages])
+            if self.metrics is None:
+                return
+            time_written = time.perf_counter()
+            for raw_message, msgtype, time_queued in raw_messages:
+                self.metrics.record("send", msgtype, len(raw_message), send_wait=time_written - time_queued)
         NetworkThread.network_event_loop.call_soon_threadsafe(maybe_write)
 
     # Class utility methods
 
-    def build_message(self, message, is_decoy=False):
+    def build_message(self, message, is_decoy=False, *, cache=None):
         """Build a serialized P2P message"""
-        msgtype = message.msgtype
-        data = message.serialize()
         if self.supports_v2_p2p:
-            if msgtype in SHORTID.values():
-                tmsg = MSGTYPE_TO_SHORTID.get(msgtype).to_bytes(1, 'big')
+            if cache is not None:
+                contents = cache.v2_contents(message)
             else:
-                tmsg = b"\x00"
-                tmsg += msgtype
-                tmsg += b"\x00" * (12 - len(msgtype))
-            tmsg += data
-            return self.v2_state.v2_enc_packet(tmsg, ignore=is_decoy)
+                contents = build_v2_contents(message.msgtype, message.serialize())
+            return self.v2_state.v2_enc_packet(contents, ignore=is_decoy)
         else:
-            tmsg = self.magic_bytes
-            tmsg += msgtype
-            tmsg += b"\x00" * (12 - len(msgtype))
-            tmsg += len(data).to_bytes(4, "little")
-            th = sha256(data)
-            h = sha256(th)
-            tmsg += h[:4]
-            tmsg += data
-            return tmsg
+            if cache is not None:
+                return cache.v1_message(message, self.magic_bytes)
+            return build_v1_message(self.magic_bytes, message.msgtype, message.serialize())
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            # Don't build the (possibly large) repr of the message for nothing
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
@@ -473,6 +774,8 @@ class P2PInterface(P2PConnection):
         # To wait for a message to be received, pop that message from
         # this and use self.wait_until.
         self.last_message = {}
+        # The time the most recent message of each type was received
+        self.last_message_time = {}
 
         # A count of the number of ping messages we've sent to the node
         self.ping_counter = 1
@@ -524,10 +827,14 @@ class P2PInterface(P2PConnection):
                 msgtype = message.msgtype.decode('ascii')
                 self.message_count[msgtype] += 1
                 self.last_message[msgtype] = message
+                self.last_message_time[msgtype] = time.time()
                 getattr(self, 'on_' + msgtype)(message)
             except Exception:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                # Wake up the test logic waiting for this message
+                p2p_condition.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -607,7 +914,7 @@ class P2PInterface(P2PConnection):
                 assert self.is_connected
             return test_function_in()
 
-        wait_until_helper_internal(test_function, timeout=timeout, lock=p2p_lock, timeout_factor=self.timeout_factor, check_interval=check_interval)
+        wait_until_helper_internal(test_function, timeout=timeout, condition=p2p_condition, timeout_factor=self.timeout_factor, check_interval=check_interval)
 
     def wait_for_connect(self, *, timeout=60):
         test_function = lambda: self.is_connected
@@ -622,6 +929,11 @@ class P2PInterface(P2PConnection):
             return self.is_connected and self.last_message.get('version') and not self.supports_v2_p2p
         self.wait_until(test_function, timeout=timeout, check_connected=False)
 
+    @property
+    def handshake_time(self):
+        """Seconds from setting up the connection until the verack was received"""
+        return self.last_message_time["verack"] - self.time_connect
+
     # Message receiving helper methods
 
     def wait_for_tx(self, txid, *, timeout=60):
@@ -726,12 +1038,64 @@ class P2PInterface(P2PConnection):
         self.ping_counter += 1
 
 
+def sync_with_ping_many(p2ps, *, timeout=60):
+    """Call sync_with_ping() on many connections at once.
+
+    The pings are sent to all connections before waiting for any pong, so
+    that the node processes them concurrently. Returns the round trip time
+    (in seconds) of the last ping of each connection."""
+    time_sent = []
+    for p2p in p2ps:
+        p2p.send_without_ping(msg_ping(nonce=0))
+        time_sent.append(time.time())
+        p2p.send_without_ping(msg_ping(nonce=p2p.ping_counter))
+
+    def test_function():
+        for p2p in p2ps:
+            assert p2p.is_connected
+            if not (p2p.last_message.get("pong") and p2p.last_message["pong"].nonce == p2p.ping_counter):
+                return False
+        return True
+
+    timeout_factor = p2ps[0].timeout_factor if p2ps else 1
+    wait_until_helper_internal(test_function, timeout=timeout, condition=p2p_condition, timeout_factor=timeout_factor)
+    with p2p_lock:
+        round_trip_times = [p2p.last_message_time["pong"] - t for p2p, t in zip(p2ps, time_sent)]
+    for p2p in p2ps:
+        p2p.ping_counter += 1
+    return round_trip_times
+
+
+def latency_stats(latencies):
+    """Summarize latencies (in seconds) as their count, minimum, mean,
+    median, 90th percentile and maximum."""
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "min": latencies[0],
+        "mean": sum(latencies) / len(latencies),
+        "median": latencies[len(latencies) // 2],
+        "p90": latencies[(len(latencies) * 9) // 10],
+        "max": latencies[-1],
+    }
+
+
 # One lock for synchronizing all data access between the network event loop (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
 # P2PConnection acquires this lock whenever delivering a message to a P2PInterface.
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
 p2p_lock = threading.Lock()
+# Notified (by the network thread, while holding p2p_lock) whenever a message
+# has been delivered to a P2PInterface or a connection was opened or closed,
+# so that P2PInterface.wait_until() can wake up right away.
+p2p_condition = threading.Condition(p2p_lock)
+# The P2PMetrics of every P2PConnection created by this process, including
+# the ones that were disconnected since, see dump_p2p_metrics(). None (and no
+# metrics are collected) until enable_p2p_metrics() is called.
+p2p_metrics: Optional[list[P2PMetrics]] = None
 
 
 class NetworkThread(threading.Thread):
@@ -759,6 +1123,18 @@ class NetworkThread(threading.Thread):
         # Safe to remove event loop.
         NetworkThread.network_event_loop = None
 
+    @classmethod
+    def create_connections(cls, p2ps):
+        """Open the outgoing TCP connections of many P2PConnections (which
+        must have been set up with peer_connect()) concurrently, with a
+        single wakeup of the event loop."""
+        loop = cls.network_event_loop
+
+        def create_all():
+            for p2p in p2ps:
+                loop.create_task(loop.create_connection(lambda p2p=p2p: p2p, host=p2p.dstaddr, port=p2p.dstport))
+        loop.call_soon_threadsafe(create_all)
+
     @classmethod
     def listen(cls, p2p, callback, port=None, addr=None, idx=1):
         """ Ensure a listening server is running on the given port, and run the
@@ -836,21 +1212,94 @@ class P2PDataStore(P2PInterface):
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
         self.getdata_requests = []
+        self._reset_block_index()
+
+    # Index of the blocks in block_store for serving getheaders requests
+    # without walking back through the whole chain. The height of a block is
+    # counted from the first of its ancestors whose parent is not in the store.
+    # The index is built on demand and kept up to date by send_blocks_and_test().
+
+    def _reset_block_index(self):
+        self._indexed_block_store = self.block_store
+        # block hash -> height, for all indexed blocks (including forks)
+        self._block_height = {}
+        # block hash -> serialized header, followed by the (zero) transaction count
+        self._serialized_headers = {}
+        # parents of the blocks at height 0, which are not in the store
+        self._missing_parents = set()
+        # hashes of the ancestors of self._chain[-1] (the tip), by height
+        self._chain = []
+
+    def _index_block(self, block_hash):
+        """Index a stored block, and all its ancestors that aren't indexed yet."""
+        if self._indexed_block_store is not self.block_store:
+            # the store was replaced by the test
+            self._reset_block_index()
+        to_index = []
+        while block_hash in self.block_store and block_hash not in self._block_height:
+            if block_hash in self._missing_parents:
+                # a block was added below the start of an indexed chain, so
+                # all heights change
+                self._reset_block_index()
+                return self._index_block(to_index[0] if to_index else block_hash)
+            to_index.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+        height = self._block_height.get(block_hash)
+        if height is None:
+            height = -1
+            if to_index:
+                self._missing_parents.add(block_hash)
+        for block_hash in reversed(to_index):
+            height += 1
+            self._block_height[block_hash] = height
+            self._serialized_headers[block_hash] = CBlockHeader.serialize(self.block_store[block_hash]) + b"\x00"
+
+    def _update_chain(self):
+        """Make self._chain end at last_block_hash."""
+        tip = self.last_block_hash
+        if any(block_hash in self.block_store for block_hash in self._missing_parents):
+            # the test added a block below the start of an indexed chain
+            self._reset_block_index()
+        # also reindexes the store if the test replaced it
+        self._index_block(tip)
+        if self._chain and self._chain[-1] == tip:
+            return
+        # walk back to the fork point with the previous chain
+        branch = []
+        block_hash = tip
+        height = self._block_height[tip]
+        while height >= 0 and not (height < len(self._chain) and self._chain[height] == block_hash):
+            branch.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+            height -= 1
+        del self._chain[height + 1:]
+        self._chain.extend(reversed(branch))
+
+    def _chain_height(self, block_hash):
+        """Return the height of a block in the chain of last_block_hash, or -1 if it isn't in it."""
+        height = self._block_height.get(block_hash, -1)
+        if height >= 0 and height < len(self._chain) and self._chain[height] == block_hash:
+            return height
+        return -1
 
     def on_getdata(self, message):
         """Check for the tx/block in our stores and if found, reply with MSG_TX or MSG_BLOCK."""
         for inv in message.inv:
             self.getdata_requests.append(inv.hash)
             invtype = inv.type & MSG_TYPE_MASK
-            if (invtype == MSG_TX or invtype == MSG_WTX) and inv.hash in self.tx_store.keys():
+            if (invtype == MSG_TX or invtype == MSG_WTX) and inv.hash in self.tx_store:
                 self.send_without_ping(msg_tx(self.tx_store[inv.hash]))
-            elif invtype == MSG_BLOCK and inv.hash in self.block_store.keys():
+            elif invtype == MSG_BLOCK and inv.hash in self.block_store:
                 self.send_without_ping(msg_block(self.block_store[inv.hash]))
             else:
                 logger.debug('getdata message type {} received.'.format(hex(inv.type)))
 
     def on_getheaders(self, message):
-        """Search back through our block store for the locator, and reply with a headers message if found."""
+        """Look up the locator in our block store, and reply with a headers message if found.
+
+        The headers are sent from the last locator block (or the hashstop
+        block, if it comes later, or the first stored block) in the chain of
+        the most recently added block, up to that block."""
 
         locator, hash_stop = message.locator, message.hashstop
 
@@ -858,27 +1307,22 @@ class P2PDataStore(P2PInterface):
         if not self.block_store:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        while headers_list[-1].hash_int not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.hash_int == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(hex(prev_block_hash)))
-                break
+        self._update_chain()
+        tip_height = len(self._chain) - 1
+        start = 0
+        for block_hash in locator.vHave:
+            start = max(start, self._chain_height(block_hash))
+        stop_height = self._chain_height(hash_stop)
+        if stop_height < tip_height:
+            start = max(start, stop_height)
 
         # Truncate the list if there are too many headers
-        headers_list = headers_list[:-MAX_HEADERS_RESULTS - 1:-1]
-        response = msg_headers(headers_list)
-
-        if response is not None:
-            self.send_without_ping(response)
+        chain = self._chain[start:start + MAX_HEADERS_RESULTS]
+        response = msg_preserialized_headers(
+            [self.block_store[block_hash] for block_hash in chain],
+            [self._serialized_headers[block_hash] for block_hash in chain],
+        )
+        self.send_without_ping(response)
 
     def send_blocks_and_test(self, blocks, node, *, success=True, force_send=False, reject_reason=None, expect_disconnect=False, timeout=60, is_decoy=False):
         """Send blocks to test node and test whether the tip advances.
@@ -896,6 +1340,10 @@ class P2PDataStore(P2PInterface):
             for block in blocks:
                 self.block_store[block.hash_int] = block
                 self.last_block_hash = block.hash_int
+                # (re-)serialize the header, in case the block was modified since it was stored
+                self._serialized_headers.pop(block.hash_int, None)
+                self._block_height.pop(block.hash_int, None)
+                self._index_block(block.hash_int)
 
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
@@ -951,11 +1399,58 @@ class P2PDataStore(P2PInterface):
                 for tx in txs:
                     assert tx.txid_hex not in raw_mempool, "{} tx found in mempool".format(tx.txid_hex)
 
+class InventoryStore:
+    """Number of announcements of inventory hashes (txids or wtxids).
+
+    Hashes are kept in the order in which they were first announced, and
+    membership tests and updates are O(1). If max_size is set, the hashes that
+    were announced least recently are evicted once there are more of them.
+    The counters cover all announcements, including the evicted ones."""
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._counts = OrderedDict()
+        # total number of announcements, by inventory type
+        self.announcements = defaultdict(int)
+        # number of hashes that were evicted
+        self.evicted = 0
+
+    def add(self, inv_hash, inv_type):
+        self.announcements[inv_type] += 1
+        count = self._counts.get(inv_hash, 0)
+        self._counts[inv_hash] = count + 1
+        if self.max_size is not None:
+            self._counts.move_to_end(inv_hash)
+            if len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+                self.evicted += 1
+
+    def __getitem__(self, inv_hash):
+        return self._counts.get(inv_hash, 0)
+
+    def __contains__(self, inv_hash):
+        return inv_hash in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def keys(self):
+        return self._counts.keys()
+
+    def items(self):
+        return self._counts.items()
+
+
 class P2PTxInvStore(P2PInterface):
-    """A P2PInterface which stores a count of how many times each txid has been announced."""
-    def __init__(self, **kwargs):
+    """A P2PInterface which stores a count of how many times each txid has been announced.
+
+    At most max_invs txids are stored if it is set, see InventoryStore."""
+    def __init__(self, *, max_invs=None, **kwargs):
         super().__init__(**kwargs)
-        self.tx_invs_received = defaultdict(int)
+        self.tx_invs_received = InventoryStore(max_size=max_invs)
 
     def on_inv(self, message):
         super().on_inv(message) # Send getdata in response.
@@ -963,7 +1458,7 @@ class P2PTxInvStore(P2PInterface):
         for i in message.inv:
             if (i.type == MSG_TX) or (i.type == MSG_WTX):
                 # save txid
-                self.tx_invs_received[i.hash] += 1
+                self.tx_invs_received.add(i.hash, i.type)
 
     def get_invs(self):
         with p2p_lock:
@@ -973,8 +1468,9 @@ class P2PTxInvStore(P2PInterface):
         """Waits for the txns (list of txids) to complete initial broadcast.
         The mempool should mark unbroadcast=False for these transactions.
         """
-        # Wait until invs have been received (and getdatas sent) for each txid.
-        self.wait_until(lambda: set(self.tx_invs_received.keys()) == set([int(tx, 16) for tx in txns]), timeout=timeout)
+        txns = {int(tx, 16) for tx in txns}
+        # Wait until invs have been received (and getdatas sent) for each txid (and no others).
+        self.wait_until(lambda: len(self.tx_invs_received) == len(txns) and all(tx in self.tx_invs_received for tx in txns), timeout=timeout)
         # Flush messages and wait for the getdatas to be processed
         self.sync_with_ping()
 
@@ -1001,3 +1497,289 @@ def start_p2p_listener(network_thread, listener):
     wait_until_helper_internal(lambda: listen_port != 0)
 
     return listen_addr, listen_port
+
+
+class TestFrameworkP2P(unittest.TestCase):
+    class Receiver(P2PConnection):
+        def __init__(self):
+            super().__init__()
+            self.peer_connect_helper('0', 0, "regtest", 1)
+            self.received = []
+
+        def on_message(self, message):
+            self.received.append(message)
+
+    def check_receive(self, sender, receiver, messages):
+        for chunk_size in [1, 7, 4096, None]:
+            # (build the messages again, as v2 encryption keys change as they are used)
+            data = b"".join(sender.build_message(msg) for msg in messages)
+            chunk_size = chunk_size or len(data)
+            receiver.received = []
+            for i in range(0, len(data), chunk_size):
+                receiver.data_received(data[i:i + chunk_size])
+                # processed data is dropped once it makes up half of the buffer
+                self.assertLess(2 * receiver._recvpos, max(len(receiver.recvbuf), 1))
+            self.assertEqual([msg.serialize() for msg in receiver.received], [msg.serialize() for msg in messages])
+            self.assertEqual(len(receiver.recvbuf), 0)
+
+    def test_receive_v1(self):
+        sender = P2PConnection()
+        sender.peer_connect_helper('0', 0, "regtest", 1)
+        receiver = self.Receiver()
+        messages = [msg_ping(i) for i in range(100)] + [msg_inv([CInv(1, i) for i in range(1000)]), msg_verack()]
+        self.check_receive(sender, receiver, messages)
+        with self.assertRaises(ValueError), self.assertLogs(logger, "ERROR"):
+            receiver.data_received(sender.build_message(msg_ping(1))[:-1] + b"\xff")
+
+    def test_receive_v2(self):
+        sender = P2PConnection()
+        sender.v2_state = EncryptedP2PState(initiating=True, net="regtest")
+        receiver = self.Receiver()
+        receiver.v2_state = EncryptedP2PState(initiating=False, net="regtest")
+        for state in [sender.v2_state, receiver.v2_state]:
+            state.initialize_v2_transport(bytes(32))
+            state.tried_v2_handshake = True
+        # one short ID and one ASCII message type
+        messages = [msg_ping(i) for i in range(100)] + [msg_inv([CInv(1, i) for i in range(1000)]), msg_wtxidrelay()]
+        self.check_receive(sender, receiver, messages)
+
+    def test_wait_until(self):
+        p2p = P2PInterface()
+        p2p.peer_connect_helper('0', 0, "regtest", 1)
+        threading.Timer(0.1, p2p.on_message, [msg_pong(1)]).start()
+        start = time.time()
+        # woken up by the message, long before the next check
+        p2p.wait_until(lambda: "pong" in p2p.last_message, check_connected=False, timeout=30, check_interval=30)
+        self.assertLess(time.time() - start, 10)
+        with self.assertRaises(AssertionError), self.assertLogs("TestFramework.utils", "ERROR"):
+            p2p.wait_until(lambda: "ping" in p2p.last_message, check_connected=False, timeout=0.1)
+
+    def test_metrics(self):
+        # metrics are only collected after enable_p2p_metrics()
+        self.assertIsNone(P2PConnection().metrics)
+        with unittest.mock.patch(f"{__name__}.p2p_metrics", None):
+            enable_p2p_metrics()
+            sender = P2PConnection()
+            sender.peer_connect_helper('0', 0, "regtest", 1)
+            receiver = self.Receiver()
+            pings = [sender.build_message(msg_ping(i)) for i in range(3)]
+            receiver.data_received(b"".join(pings) + sender.build_message(msg_verack()))
+            metrics = receiver.metrics.to_dict()
+            self.assertEqual(metrics["send"], {})
+            self.assertEqual(sorted(metrics["receive"]), ["ping", "verack"])
+            self.assertEqual(metrics["receive"]["ping"]["count"], 3)
+            self.assertEqual(metrics["receive"]["ping"]["bytes"], sum(len(ping) for ping in pings))
+            self.assertEqual(metrics["receive"]["verack"]["bytes"], 24)
+            self.assertGreater(metrics["receive"]["ping"]["decode_time"], 0)
+            self.assertIn(receiver.metrics, p2p_metrics)
+
+            total = merge_p2p_metrics([metrics, metrics])
+            self.assertEqual(total["receive"]["ping"]["count"], 6)
+            self.assertEqual(total["receive"]["verack"]["bytes"], 48)
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "p2p_metrics.json")
+                dump_p2p_metrics(path)
+                with open(path) as f:
+                    dumped = json.load(f)
+            self.assertIn({"name": "Receiver", "peer": None, **metrics}, dumped["peers"])
+            self.assertGreaterEqual(dumped["total"]["receive"]["ping"]["count"], 3)
+
+    def test_latency_stats(self):
+        self.assertEqual(latency_stats([]), {"count": 0})
+        stats = latency_stats(i / 100 for i in range(20, 0, -1))
+        self.assertAlmostEqual(stats.pop("mean"), 0.105)
+        self.assertEqual(stats, {"count": 20, "min": 0.01, "median": 0.11, "p90": 0.19, "max": 0.2})
+
+    def test_message_cache(self):
+        class counted_ping(msg_ping):
+            __slots__ = ()
+            serializations = 0
+
+            def serialize(self):
+                counted_ping.serializations += 1
+                return super().serialize()
+
+        v1_sender = P2PConnection()
+        v1_sender.peer_connect_helper('0', 0, "regtest", 1)
+        v2_pairs = []
+        for _ in range(2):
+            sender = P2PConnection()
+            sender.v2_state = EncryptedP2PState(initiating=True, net="regtest")
+            receiver = self.Receiver()
+            receiver.v2_state = EncryptedP2PState(initiating=False, net="regtest")
+            for state in [sender.v2_state, receiver.v2_state]:
+                state.initialize_v2_transport(bytes(32))
+                state.tried_v2_handshake = True
+            v2_pairs.append((sender, receiver))
+
+        cache = MessageCache(max_messages=2)
+        messages = [counted_ping(1), counted_ping(2), msg_wtxidrelay()]
+        for msg in messages:
+            tmsg = v1_sender.build_message(msg, cache=cache)
+            self.assertEqual(tmsg, v1_sender.build_message(msg))
+            self.assertIs(v1_sender.build_message(msg, cache=cache), tmsg)
+            # the cached contents are encrypted separately for each peer
+            for sender, receiver in v2_pairs:
+                receiver.received = []
+                receiver.data_received(sender.build_message(msg, cache=cache))
+                self.assertEqual([m.serialize() for m in receiver.received], [msg.serialize()])
+        # once for each cached ping, once for the uncached v1 message and twice for the checks
+        self.assertEqual(counted_ping.serializations, 2 * (1 + 1 + 2))
+        self.assertEqual(len(cache._entries), 2)
+
+    def test_getheaders(self):
+        class DataStore(P2PDataStore):
+            def send_without_ping(self, message, is_decoy=False):
+                self.sent = message
+
+        def old_getheaders(store, locator, hash_stop):
+            # The implementation that walked back from the tip on every request
+            headers_list = [store.block_store[store.last_block_hash]]
+            while headers_list[-1].hash_int not in locator:
+                prev_block_hash = headers_list[-1].hashPrevBlock
+                if prev_block_hash in store.block_store:
+                    prev_block_header = CBlockHeader(store.block_store[prev_block_hash])
+                    headers_list.append(prev_block_header)
+                    if prev_block_header.hash_int == hash_stop:
+                        break
+                else:
+                    break
+            return msg_headers(headers_list[:-MAX_HEADERS_RESULTS - 1:-1]).serialize()
+
+        rng = random.Random(1)
+        store = DataStore()
+        blocks = []
+
+        def new_block(prev_hash):
+            block = CBlock()
+            block.hashPrevBlock = prev_hash
+            block.nNonce = len(blocks)
+            blocks.append(block)
+            return block
+
+        def store_block(block):
+            # as send_blocks_and_test() does
+            with p2p_lock:
+                store.block_store[block.hash_int] = block
+                store.last_block_hash = block.hash_int
+                store._index_block(block.hash_int)
+            return block.hash_int
+
+        def check_getheaders():
+            request = msg_getheaders()
+            request.locator.vHave = [rng.choice(blocks).hash_int for _ in range(rng.randrange(3))]
+            request.hashstop = rng.choice([0, rng.choice(blocks).hash_int])
+            store.on_getheaders(request)
+            self.assertEqual(store.sent.serialize(), old_getheaders(store, request.locator.vHave, request.hashstop))
+
+        # the parent of the first stored block is only stored at the end
+        genesis = new_block(0)
+        tip = store_block(new_block(genesis.hash_int))
+        for i in range(3000):
+            if rng.random() < 0.01:
+                # reorg to a fork of an earlier block
+                tip = store_block(new_block(rng.choice(blocks[1:]).hash_int))
+            else:
+                tip = store_block(new_block(tip))
+            if i % 97 == 0 or i > 2950:
+                for _ in range(3):
+                    check_getheaders()
+
+        # this changes the heights of all blocks
+        store_block(genesis)
+        store.last_block_hash = tip
+        for _ in range(10):
+            check_getheaders()
+        self.assertEqual(len(store._chain), store._block_height[tip] + 1)
+        self.assertEqual(store._chain[0], genesis.hash_int)
+
+        # the test replaces the store
+        store.block_store = {block.hash_int: block for block in blocks[:100]}
+        store.last_block_hash = blocks[99].hash_int
+        store.on_getheaders(msg_getheaders())
+        self.assertEqual(store.sent.serialize(), old_getheaders(store, [], 0))
+        self.assertLessEqual(len(store._block_height), 100)
+
+        # ... with only a part of the chain of the same tip
+        by_hash = {block.hash_int: block for block in blocks}
+        chain = [blocks[99]]
+        while chain[-1].hashPrevBlock in by_hash:
+            chain.append(by_hash[chain[-1].hashPrevBlock])
+        store.block_store = {block.hash_int: block for block in chain[:-10]}
+        store.on_getheaders(msg_getheaders())
+        self.assertEqual(store.sent.serialize(), old_getheaders(store, [], 0))
+        # and then adds a parent to it directly
+        store.block_store[chain[-10].hash_int] = chain[-10]
+        store.on_getheaders(msg_getheaders())
+        self.assertEqual(store.sent.serialize(), old_getheaders(store, [], 0))
+        self.assertEqual(store._chain[0], chain[-10].hash_int)
+
+    def test_send_many(self):
+        class Transport:
+            def __init__(self):
+                self.writes = []
+
+            def is_closing(self):
+                return False
+
+            def writelines(self, data):
+                self.writes.append(b"".join(data))
+
+        with unittest.mock.patch(f"{__name__}.p2p_metrics", []):
+            sender = P2PConnection()
+        sender.v2_state = EncryptedP2PState(initiating=True, net="regtest")
+        receiver = self.Receiver()
+        receiver.v2_state = EncryptedP2PState(initiating=False, net="regtest")
+        for state in [sender.v2_state, receiver.v2_state]:
+            state.initialize_v2_transport(bytes(32))
+            state.tried_v2_handshake = True
+        sender._transport = Transport()
+
+        loop = asyncio.new_event_loop()
+        NetworkThread.network_event_loop = loop
+        try:
+            messages = [msg_ping(i) for i in range(10)]
+            sender.send_without_ping(msg_verack())
+            sender.send_many(messages[:5])
+            with sender.batch_sends():
+                sender.send_without_ping(messages[5])
+                with sender.batch_sends():
+                    sender.send_many(messages[6:])
+            loop.call_soon(loop.stop)
+            loop.run_forever()
+        finally:
+            NetworkThread.network_event_loop = None
+            loop.close()
+        # one write for the single message and one for each batch
+        self.assertEqual(len(sender._transport.writes), 3)
+        for data in sender._transport.writes:
+            receiver.data_received(data)
+        self.assertEqual([msg.serialize() for msg in receiver.received], [msg.serialize() for msg in [msg_verack()] + messages])
+        self.assertEqual(sender.metrics.to_dict()["send"]["ping"]["count"], 10)
+
+        # a batch that can't be written as the connection was closed meanwhile
+        with self.assertRaisesRegex(IOError, "Not connected"):
+            with sender.batch_sends():
+                sender.send_without_ping(msg_ping(1))
+                sender._transport = None
+        self.assertIsNone(sender._send_batch)
+        # an empty batch is fine
+        with sender.batch_sends():
+            pass
+
+    def test_inventory_store(self):
+        invs = InventoryStore()
+        for i in [3, 1, 2, 1, 3, 1]:
+            invs.add(i, MSG_WTX)
+        self.assertEqual(list(invs), [3, 1, 2])
+        self.assertEqual([invs[i] for i in range(5)], [0, 3, 1, 2, 0])
+        self.assertEqual((len(invs), 2 in invs, 4 in invs), (3, True, False))
+
+        invs = InventoryStore(max_size=2)
+        for i in [1, 2, 1, 3, 4]:
+            invs.add(i, MSG_TX if i < 3 else MSG_WTX)
+        self.assertEqual(list(invs.items()), [(3, 1), (4, 1)])
+        self.assertEqual((invs.evicted, dict(invs.announcements)), (2, {MSG_TX: 3, MSG_WTX: 2}))
+        invs.add(3, MSG_WTX)
+        self.assertEqual(list(invs), [4, 3])
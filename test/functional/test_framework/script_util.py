@@ -5,15 +5,13 @@
 """Useful Script constants and utils."""
 import unittest
 
-from copy import deepcopy
-
 from test_framework.messages import (
     COutPoint,
     CTransaction,
     CTxIn,
     CTxInWitness,
     CTxOut,
-    ser_compact_size,
+    compact_size_len,
     sha256,
 )
 from test_framework.script import (
@@ -136,14 +134,22 @@ def script_to_p2sh_p2wsh_script(script):
     return script_to_p2sh_script(p2shscript)
 
 def bulk_vout(tx, target_vsize):
-    if target_vsize < tx.get_vsize():
-        raise RuntimeError(f"target_vsize {target_vsize} is less than transaction virtual size {tx.get_vsize()}")
-    # determine number of needed padding bytes
-    dummy_vbytes = target_vsize - tx.get_vsize()
-    # compensate for the increase of the compact-size encoded script length
-    # (note that the length encoding of the unpadded output script needs one byte)
-    dummy_vbytes -= len(ser_compact_size(dummy_vbytes)) - 1
-    tx.vout[-1].scriptPubKey = CScript([OP_RETURN] + [OP_1] * dummy_vbytes)
+    """Pad the last output's scriptPubKey with OP_1s so that tx reaches
+    target_vsize exactly. Non-witness bytes count as one vbyte each, so the
+    padding length is solved for directly from the current size."""
+    vsize = tx.get_vsize()
+    if target_vsize < vsize:
+        raise RuntimeError(f"target_vsize {target_vsize} is less than transaction virtual size {vsize}")
+    script_len = len(tx.vout[-1].scriptPubKey)
+    # serialized size of the padded output script, including its compact-size encoded length
+    target_field_size = compact_size_len(script_len) + script_len + target_vsize - vsize
+    for length_size in (1, 3, 5):
+        padded_len = target_field_size - length_size
+        if padded_len >= 1 and compact_size_len(padded_len) == length_size:
+            break
+    else:
+        raise RuntimeError(f"target_vsize {target_vsize} cannot be reached by padding the last output")
+    tx.vout[-1].scriptPubKey = CScript([OP_RETURN] + [OP_1] * (padded_len - 1))
     assert_equal(tx.get_vsize(), target_vsize)
 
 def output_key_to_p2tr_script(key):
@@ -202,7 +208,7 @@ def build_malleated_tx_package(*, parent: CTransaction, rebalance_parent_output_
     child_one.wit.vtxinwit.append(CTxInWitness())
     child_one.wit.vtxinwit[0].scriptWitness.stack = [b'Preimage', b'\x01', witness_script]
     # 2. Create another identical transaction with witness solving second branch
-    child_two = deepcopy(child_one)
+    child_two = CTransaction(child_one)
     child_two.wit.vtxinwit[0].scriptWitness.stack = [b'', witness_script]
     return parent, child_one, child_two
 
@@ -221,3 +227,24 @@ class TestFrameworkScriptUtil(unittest.TestCase):
         self.assertEqual(len(max_ms_script), 2 + 20*34 + 2 + 1)
         self.assertTrue(max_ms_script.startswith(bytes([1, 19])))  # using OP_PUSH1
         self.assertTrue(max_ms_script.endswith(bytes([1, 20, OP_CHECKMULTISIG])))
+
+    def test_bulk_vout(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(0, 0))]
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b'\x01' * 65]
+        tx.vout = [CTxOut(0, CScript([OP_RETURN]))]
+        base_vsize = tx.get_vsize()
+        # cover the script length encoding growing from 1 to 3 bytes
+        for delta in list(range(0, 300)) + [70000]:
+            if delta in (252, 253):
+                # the encoded length grows by two bytes, so these can't be hit
+                with self.assertRaises(RuntimeError):
+                    bulk_vout(tx, base_vsize + delta)
+                continue
+            bulk_vout(tx, base_vsize + delta)
+            self.assertEqual(tx.get_vsize(), base_vsize + delta)
+        # padding an already padded output works too
+        bulk_vout(tx, tx.get_vsize() + 10)
+        with self.assertRaises(RuntimeError):
+            bulk_vout(tx, tx.get_vsize() - 1)
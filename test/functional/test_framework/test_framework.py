@@ -25,7 +25,11 @@ import time
 from .address import create_deterministic_address_bcrt1_p2tr_op_true
 from . import coverage
 from .messages import CAddress
-from .p2p import NetworkThread
+from .p2p import (
+    NetworkThread,
+    dump_p2p_metrics,
+    enable_p2p_metrics,
+)
 from .test_node import TestNode
 from .util import (
     Binaries,
@@ -201,6 +205,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                             help="use BIP324 v2 connections between all nodes by default")
         parser.add_argument("--v1transport", dest="v1transport", default=False, action="store_true",
                             help="Explicitly use v1 transport (can be used to overwrite global --v2transport option)")
+        parser.add_argument("--p2pmetrics", dest="p2p_metrics",
+                            help="On exit, write the per-peer, per-msgtype P2P traffic and timing metrics of the test framework as JSON to this file")
         parser.add_argument("--test_methods", dest="test_methods", nargs='*',
                             help="Run specified test methods sequentially instead of the full test. Use only for methods that do not depend on any context set up in run_test or other methods.")
 
@@ -258,6 +264,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         random.seed(seed)
         self.log.info("PRNG seed is: {}".format(seed))
 
+        if self.options.p2p_metrics:
+            enable_p2p_metrics()
         self.log.debug('Setting up network thread')
         self.network_thread = NetworkThread()
         self.network_thread.start()
@@ -282,6 +290,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
 
         self.log.debug('Closing down network thread')
         self.network_thread.close(timeout=self.options.timeout_factor * 10)
+        if self.options.p2p_metrics:
+            dump_p2p_metrics(self.options.p2p_metrics)
         if self.success == TestStatus.FAILED:
             self.log.info("Not stopping nodes as test failed. The dangling processes will be cleaned up later.")
         else:
@@ -29,7 +29,13 @@ from .authproxy import (
 )
 from . import coverage
 from .messages import NODE_P2P_V2
-from .p2p import P2P_SERVICES, P2P_SUBVERSION
+from .p2p import (
+    P2P_SERVICES,
+    P2P_SUBVERSION,
+    NetworkThread,
+    p2p_condition,
+    sync_with_ping_many,
+)
 from .util import (
     MAX_NODES,
     assert_equal,
@@ -731,6 +737,22 @@ class TestNode():
             if assert_msg:
                 self._raise_assertion_error(assert_msg)
 
+    def _inbound_p2p_connect_kwargs(self, supports_v2_p2p, send_version, kwargs):
+        """Return the peer_connect() arguments of an inbound p2p connection,
+        see add_p2p_connection()."""
+        kwargs = dict(kwargs)
+        if 'dstport' not in kwargs:
+            kwargs['dstport'] = p2p_port(self.index)
+        if 'dstaddr' not in kwargs:
+            kwargs['dstaddr'] = '127.0.0.1'
+        if supports_v2_p2p is None:
+            supports_v2_p2p = self.use_v2transport
+
+        if self.use_v2transport:
+            kwargs['services'] = kwargs.get('services', P2P_SERVICES) | NODE_P2P_V2
+        supports_v2_p2p = self.use_v2transport and supports_v2_p2p
+        return dict(kwargs, send_version=send_version, net=self.chain, timeout_factor=self.timeout_factor, supports_v2_p2p=supports_v2_p2p)
+
     def add_p2p_connection(self, p2p_conn, *, wait_for_verack=True, send_version=True, supports_v2_p2p=None, wait_for_v2_handshake=True, expect_success=True, **kwargs):
         """Add an inbound p2p connection to the node.
 
@@ -744,23 +766,13 @@ class TestNode():
         - if TestNode advertises NODE_P2P_V2 service, (and if P2PConnections supports v2 P2P)
                 P2PConnection sends ellswift bytes and v2 P2P is followed
         """
-        if 'dstport' not in kwargs:
-            kwargs['dstport'] = p2p_port(self.index)
-        if 'dstaddr' not in kwargs:
-            kwargs['dstaddr'] = '127.0.0.1'
-        if supports_v2_p2p is None:
-            supports_v2_p2p = self.use_v2transport
-
-        if self.use_v2transport:
-            kwargs['services'] = kwargs.get('services', P2P_SERVICES) | NODE_P2P_V2
-        supports_v2_p2p = self.use_v2transport and supports_v2_p2p
-        p2p_conn.peer_connect(**kwargs, send_version=send_version, net=self.chain, timeout_factor=self.timeout_factor, supports_v2_p2p=supports_v2_p2p)()
+        p2p_conn.peer_connect(**self._inbound_p2p_connect_kwargs(supports_v2_p2p, send_version, kwargs))()
 
         self.p2ps.append(p2p_conn)
         if not expect_success:
             return p2p_conn
         p2p_conn.wait_until(lambda: p2p_conn.is_connected, check_connected=False)
-        if supports_v2_p2p and wait_for_v2_handshake:
+        if p2p_conn.supports_v2_p2p and wait_for_v2_handshake:
             p2p_conn.wait_until(lambda: p2p_conn.v2_state.tried_v2_handshake)
         if send_version:
             p2p_conn.wait_until(lambda: not p2p_conn.on_connection_send_msg)
@@ -790,6 +802,55 @@ class TestNode():
 
         return p2p_conn
 
+    def add_p2p_connections(self, p2p_conns, *, wait_for_verack=True, send_version=True, supports_v2_p2p=None, wait_for_v2_handshake=True, expect_success=True, timeout=60, **kwargs):
+        """Add many inbound p2p connections to the node at once.
+
+        Like add_p2p_connection(), but all connections are opened
+        concurrently on the network thread and their handshakes are waited
+        for together, which is much faster for a large number of peers.
+
+        With expect_success=False, the connections are returned right after
+        they were initiated, e.g. to test that the node evicts or rejects
+        some of them. Otherwise, once this returns, the handshake time of
+        each connection is available as p2p_conn.handshake_time.
+        """
+        p2p_conns = list(p2p_conns)
+        connect_kwargs = self._inbound_p2p_connect_kwargs(supports_v2_p2p, send_version, kwargs)
+        for p2p_conn in p2p_conns:
+            p2p_conn.peer_connect(**connect_kwargs)
+        NetworkThread.create_connections(p2p_conns)
+
+        self.p2ps.extend(p2p_conns)
+        if not expect_success:
+            return p2p_conns
+
+        # The same conditions as add_p2p_connection() waits for, for each connection
+        def connected(p2p_conn):
+            if not p2p_conn.is_connected:
+                return False
+            if p2p_conn.supports_v2_p2p and wait_for_v2_handshake and not p2p_conn.v2_state.tried_v2_handshake:
+                return False
+            if send_version and p2p_conn.on_connection_send_msg:
+                return False
+            # The verack is only received after the (v2 handshake and the) version message was sent
+            return not wait_for_verack or "verack" in p2p_conn.last_message
+        wait_until_helper_internal(lambda: all(connected(p2p_conn) for p2p_conn in p2p_conns),
+                                   timeout=timeout, condition=p2p_condition, timeout_factor=self.timeout_factor)
+        if wait_for_verack:
+            # See add_p2p_connection() for why this is done
+            sync_with_ping_many(p2p_conns, timeout=timeout)
+
+            peers = {(peer["addr"], peer["addrbind"]): peer for peer in self.getpeerinfo()}
+            for p2p_conn in p2p_conns:
+                sockname = p2p_conn._transport.get_extra_info("socket").getsockname()
+                our_addr_and_port = f"{sockname[0]}:{sockname[1]}"
+                dst_addr_and_port = f"{p2p_conn.dstaddr}:{p2p_conn.dstport}"
+                peer = peers.get((our_addr_and_port, dst_addr_and_port))
+                assert peer is not None, f"connection from {our_addr_and_port} to {dst_addr_and_port} not found in getpeerinfo"
+                assert_equal(peer["subver"], P2P_SUBVERSION)
+
+        return p2p_conns
+
     def add_outbound_p2p_connection(self, p2p_conn, *, wait_for_verack=True, wait_for_disconnect=False, p2p_idx, connection_type="outbound-full-relay", supports_v2_p2p=None, advertise_v2_p2p=None, **kwargs):
         """Add an outbound p2p connection from node. Must be an
         "outbound-full-relay", "block-relay-only", "addr-fetch" or "feeler" connection.
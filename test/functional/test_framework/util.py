@@ -425,9 +425,13 @@ def ensure_for(*, duration, f, check_interval=0.2):
         time.sleep(check_interval)
 
 
-def wait_until_helper_internal(predicate, *, timeout=60, lock=None, timeout_factor=1.0, check_interval=0.05):
+def wait_until_helper_internal(predicate, *, timeout=60, lock=None, timeout_factor=1.0, check_interval=0.05, condition=None):
     """Sleep until the predicate resolves to be True.
 
+    If a condition (threading.Condition) is given, the predicate is checked
+    while holding it, and re-checked as soon as the condition is notified, or
+    otherwise every check_interval seconds.
+
     Warning: Note that this method is not recommended to be used in tests as it is
     not aware of the context of the test framework. Using the `wait_until()` members
     from `BitcoinTestFramework` or `P2PInterface` class ensures the timeout is
@@ -437,15 +441,22 @@ def wait_until_helper_internal(predicate, *, timeout=60, lock=None, timeout_fact
     timeout = timeout * timeout_factor
     time_end = time.time() + timeout
 
-    while time.time() < time_end:
-        if lock:
-            with lock:
+    if condition is not None:
+        with condition:
+            while time.time() < time_end:
                 if predicate():
                     return
-        else:
-            if predicate():
-                return
-        time.sleep(check_interval)
+                condition.wait(min(check_interval, max(time_end - time.time(), 0)))
+    else:
+        while time.time() < time_end:
+            if lock:
+                with lock:
+                    if predicate():
+                        return
+            else:
+                if predicate():
+                    return
+            time.sleep(check_interval)
 
     # Print the cause of the timeout
     predicate_source = "''''\n" + inspect.getsource(predicate) + "'''"
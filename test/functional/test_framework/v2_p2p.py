@@ -270,16 +270,16 @@ class EncryptedP2PState:
         if self.contents_len == -1:
             if len(response) < LENGTH_FIELD_LEN:
                 return 0, None
-            enc_contents_len = response[:LENGTH_FIELD_LEN]
+            enc_contents_len = bytes(response[:LENGTH_FIELD_LEN])
             self.contents_len = int.from_bytes(self.peer['recv_L'].crypt(enc_contents_len), 'little')
-        response = response[LENGTH_FIELD_LEN:]
-        if len(response) < HEADER_LEN + self.contents_len + CHACHA20POLY1305_EXPANSION:
+        # response may be a memoryview of a larger receive buffer, only copy this packet out of it
+        length = LENGTH_FIELD_LEN + HEADER_LEN + self.contents_len + CHACHA20POLY1305_EXPANSION
+        if len(response) < length:
             return 0, None
-        aead_ciphertext = response[:HEADER_LEN + self.contents_len + CHACHA20POLY1305_EXPANSION]
+        aead_ciphertext = bytes(response[LENGTH_FIELD_LEN:length])
         plaintext = self.peer['recv_P'].decrypt(aad, aead_ciphertext)
         if plaintext is None:
             return -1, None  # disconnect
         header = plaintext[:HEADER_LEN]
-        length = LENGTH_FIELD_LEN + HEADER_LEN + self.contents_len + CHACHA20POLY1305_EXPANSION
         self.contents_len = -1
         return length, None if (header[0] & (1 << IGNORE_BIT_POS)) else plaintext[HEADER_LEN:]
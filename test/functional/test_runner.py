@@ -18,6 +18,7 @@ from concurrent import futures
 import configparser
 import csv
 import datetime
+import json
 import os
 import pathlib
 import platform
@@ -29,6 +30,7 @@ import sys
 import tempfile
 import re
 import logging
+from test_framework.p2p import merge_p2p_metrics
 from test_framework.util import (
     Binaries,
     export_env_build_path,
@@ -90,6 +92,7 @@ EXTENDED_SCRIPTS = [
     'feature_pruning.py',
     'feature_dbcrash.py',
     'feature_index_prune.py',
+    'p2p_many_inbound.py',
 ]
 
 # Special script to run each bench sanity check
@@ -478,6 +481,7 @@ def main():
     parser.add_argument("--nocleanup", dest="nocleanup", default=False, action="store_true",
                         help="Leave bitcoinds and test.* datadir on exit or error")
     parser.add_argument('--resultsfile', '-r', help='store test results (as CSV) to the provided file')
+    parser.add_argument('--p2pmetrics', help='store the P2P traffic and timing metrics of the test framework per test (as JSON) to the provided file and print a summary')
 
     args, unknown_args = parser.parse_known_args()
     # Fail on self-check warnings before running the tests.
@@ -518,6 +522,12 @@ def main():
         assert results_filepath.parent.exists(), "Results file parent directory does not exist"
         logging.debug("Test results will be written to " + str(results_filepath))
 
+    p2p_metrics_filepath = None
+    if args.p2pmetrics:
+        p2p_metrics_filepath = pathlib.Path(args.p2pmetrics)
+        assert p2p_metrics_filepath.parent.exists(), "P2P metrics file parent directory does not exist"
+        logging.debug("P2P metrics will be written to " + str(p2p_metrics_filepath))
+
     enable_bitcoind = config["components"].getboolean("ENABLE_BITCOIND")
 
     if not enable_bitcoind:
@@ -631,9 +641,10 @@ def main():
         failfast=args.failfast,
         use_term_control=args.ansi,
         results_filepath=results_filepath,
+        p2p_metrics_filepath=p2p_metrics_filepath,
     )
 
-def run_tests(*, test_list, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control, results_filepath=None):
+def run_tests(*, test_list, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control, results_filepath=None, p2p_metrics_filepath=None):
     args = args or []
 
     # Some optional Python dependencies (e.g. pycapnp) may emit warnings or fail under
@@ -687,6 +698,7 @@ def run_tests(*, test_list, build_dir, tmpdir, jobs=1, enable_coverage=False, ar
         test_list=test_list,
         flags=flags,
         use_term_control=use_term_control,
+        collect_p2p_metrics=p2p_metrics_filepath is not None,
     )
     start_time = time.time()
     test_results = []
@@ -734,6 +746,9 @@ def run_tests(*, test_list, build_dir, tmpdir, jobs=1, enable_coverage=False, ar
     print_results(test_results, max_len_name, runtime)
     if results_filepath:
         write_results(test_results, results_filepath, runtime)
+    if p2p_metrics_filepath:
+        print_p2p_metrics(test_results)
+        write_p2p_metrics(test_results, p2p_metrics_filepath)
 
     if coverage:
         coverage_passed = coverage.report_rpc_coverage()
@@ -788,11 +803,28 @@ def write_results(test_results, filepath, total_runtime):
             results_writer.writerow([test_result.name, test_result.status, str(test_result.time)])
         results_writer.writerow(['ALL', ("Passed" if all_passed else "Failed"), str(total_runtime)])
 
+
+def print_p2p_metrics(test_results, max_msgtypes=10):
+    """Print the msgtypes that took the test framework the most time to handle, over all tests."""
+    total = merge_p2p_metrics(r.p2p_metrics for r in test_results if r.p2p_metrics)
+    rows = [(direction, msgtype, stats) for direction, per_msgtype in total.items() for msgtype, stats in per_msgtype.items()]
+    rows.sort(key=lambda row: row[2]["decode_time"] + row[2]["handler_time"] + row[2]["send_wait"], reverse=True)
+    results = "\n" + BOLD[1] + "P2P %s | %s | %s | %s | %s | %s | %s\n\n" % ("DIRECTION", "MSGTYPE".ljust(12), "COUNT".rjust(9), "BYTES".rjust(12), "DECODE", "HANDLER", "SEND WAIT") + BOLD[0]
+    for direction, msgtype, stats in rows[:max_msgtypes]:
+        results += "    %s | %s | %9d | %12d | %.2f s | %.2f s | %.2f s\n" % (direction.ljust(9), msgtype.ljust(12), stats["count"], stats["bytes"], stats["decode_time"], stats["handler_time"], stats["send_wait"])
+    print(results)
+
+
+def write_p2p_metrics(test_results, filepath):
+    tests = {r.name: r.p2p_metrics for r in test_results if r.p2p_metrics}
+    with open(filepath, mode="w") as metrics_file:
+        json.dump({"tests": tests, "total": merge_p2p_metrics(tests.values())}, metrics_file, indent=1)
+
 class TestHandler:
     """
     Trigger the test scripts passed in via the list.
     """
-    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, use_term_control):
+    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, use_term_control, collect_p2p_metrics=False):
         assert num_tests_parallel >= 1
         self.executor = futures.ThreadPoolExecutor(max_workers=num_tests_parallel)
         self.num_jobs = num_tests_parallel
@@ -802,6 +834,7 @@ class TestHandler:
         self.flags = flags
         self.jobs = {}
         self.use_term_control = use_term_control
+        self.collect_p2p_metrics = collect_p2p_metrics
 
     def done(self):
         return not (self.jobs or self.test_list)
@@ -817,6 +850,9 @@ class TestHandler:
             test_argv = test.split()
             testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
+            if self.collect_p2p_metrics:
+                # (outside of the test directory, which is removed by the test on success)
+                tmpdir_arg.append("--p2pmetrics={}.p2p_metrics.json".format(testdir))
 
             def proc_wait(task):
                 task[2].wait()
@@ -868,7 +904,10 @@ class TestHandler:
                     clearline = '\r' + (' ' * dot_count) + '\r'
                     print(clearline, end='', flush=True)
                 dot_count = 0
-                ret.append((TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr, skip_reason))
+                test_result = TestResult(name, status, int(time.time() - start_time))
+                if self.collect_p2p_metrics:
+                    test_result.p2p_metrics = self.pop_p2p_metrics(testdir)
+                ret.append((test_result, testdir, stdout, stderr, skip_reason))
             if ret:
                 return ret
             if self.use_term_control:
@@ -876,12 +915,25 @@ class TestHandler:
             dot_count += 1
 
 
+    @staticmethod
+    def pop_p2p_metrics(testdir):
+        """Read (and remove) the total P2P metrics a test has written, if any."""
+        metrics_file = "{}.p2p_metrics.json".format(testdir)
+        if not os.path.isfile(metrics_file):
+            return None
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        os.remove(metrics_file)
+        return metrics["total"]
+
+
 class TestResult():
     def __init__(self, name, status, time):
         self.name = name
         self.status = status
         self.time = time
         self.padding = 0
+        self.p2p_metrics = None
 
     def sort_key(self):
         if self.status == "Passed":